@@ -0,0 +1,401 @@
+# coding=utf-8
+"""Replays Telegram updates through the bot's real handlers against a fake
+Telegram API and reports handler latency, database round trips and
+throughput.
+
+Point DATABASE_URL at a disposable database, since benchmark orders are
+written to it. `--init-schema` creates the base tables and a small menu if
+they are missing:
+
+    DATABASE_URL=postgres://localhost/spread_bench \\
+        python3 benchmark.py --init-schema --users 200
+
+With DB_BACKEND=sqlite it runs offline against a local SQLite file instead.
+"""
+
+# Import libraries
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from collections import Counter, OrderedDict
+from functools import wraps
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from tabulate import tabulate
+import metrics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# bot.py reads its configuration on import, so these have to come first
+BENCHMARK_ENV = {
+    'BOT_TOKEN': '123456:benchmark',
+    'SUPER_ADMIN': '[]',
+    'ADMIN_LIST': '[]',
+    'WEBHOOK_URL': 'http://localhost/',
+    'DB_SSLMODE': 'disable',
+    'OPERATING_DAYS': '[0, 1, 2, 3, 4, 5, 6]',
+    'OPENING_HOUR': '0',
+    'CLOSING_HOUR': '24',
+    'MENU_SNAPSHOT_PATH': '',
+    # Update IDs start over on every run
+    'DEDUP_STORE': 'memory',
+    # Every simulated user has to get a collection slot
+    'SLOT_CAPACITY': '1000000',
+    'BLOB_STORE_PATH': os.path.join(tempfile.gettempdir(), 'spread-blobs')
+}
+
+# Benchmark users get IDs no real Telegram user has
+FIRST_USER_ID = 2000000000
+
+# Keyboard labels that food_category() maps to each category
+CATEGORY_LABELS = {
+    'MONDAY': '😭 Monday',
+    'TUESDAY': '😞 Tuesday',
+    'WEDNESDAY': '😕 Wednesday',
+    'THURSDAY': '😬 Thursday',
+    'FRIDAY': '😍 Friday'
+}
+
+# Tables that predate the migrations, as shown in the README diagram
+BASE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS collection_time (time_options TEXT);",
+    "CREATE TABLE IF NOT EXISTS food_details (item_index INTEGER, category TEXT, name TEXT, price NUMERIC, image BYTEA);",
+    "CREATE TABLE IF NOT EXISTS offer_table (offer TEXT);",
+    "CREATE TABLE IF NOT EXISTS order_list (collection_time TEXT, user_id INTEGER, username TEXT, name TEXT, contact_number INTEGER, item_ordered TEXT, quantity INTEGER, location TEXT, remarks TEXT, status TEXT, receipt_image BYTEA);"
+]
+
+logger = logging.getLogger(__name__)
+
+
+# Stands in for telegram.utils.request.Request, answering every Bot API
+# call locally after `latency` seconds
+class FakeTelegram:
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+
+    def get(self, url, timeout=None):
+        return self.post(url, {}, timeout)
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        with self.lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Bench',
+                    'username': 'TheSpreadBot'}
+        if method == 'getFile':
+            return {'file_id': data['file_id'], 'file_path': 'receipt.jpg'}
+        if method not in ('sendMessage', 'sendPhoto', 'sendDocument',
+                          'editMessageText'):
+            return True
+        message_id = next(self.message_ids)
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'chat': {'id': int(data.get('chat_id', 0)),
+                            'type': 'private'}}
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': 'photo-{}'.format(message_id),
+                                 'width': 1, 'height': 1}]
+        return message
+
+
+# Counts the errors the Dispatcher logs instead of passing to error handlers
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+# Serves the receipt downloads of the bot's Downloader
+class ReceiptServer(HTTPServer):
+    def __init__(self, receipt):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ReceiptHandler)
+        self.receipt = receipt
+
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class ReceiptHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.receipt)))
+        self.end_headers()
+        self.wfile.write(self.server.receipt)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UpdateFactory:
+    def __init__(self):
+        self.ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Bench',
+                'username': 'bench{}'.format(user_id)}
+
+    def message(self, user_id, text=None, photo=False):
+        message = {'message_id': next(self.ids), 'date': int(time.time()),
+                   'chat': {'id': user_id, 'type': 'private'},
+                   'from': self._user(user_id)}
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                        'length': len(text.split()[0])}]
+        if photo:
+            message['photo'] = [{'file_id': 'receipt-{}'.format(user_id),
+                                 'width': 1, 'height': 1}]
+        return {'update_id': next(self.ids), 'message': message}
+
+    def callback(self, user_id, data):
+        update_id = next(self.ids)
+        message = self.message(user_id, 'menu')['message']
+        return {'update_id': update_id,
+                'callback_query': {'id': str(update_id),
+                                   'from': self._user(user_id),
+                                   'chat_instance': 'benchmark',
+                                   'message': message, 'data': data}}
+
+
+# The updates of one user ordering an item and paying for it
+def lunch_order(factory, user_id, category, item, collection_time):
+    return [
+        factory.message(user_id, '/order'),
+        factory.message(user_id, CATEGORY_LABELS[category]),
+        factory.callback(user_id, item),
+        factory.message(user_id, '2'),
+        factory.message(user_id, 'Less spicy please'),
+        factory.message(user_id, '/cart'),
+        factory.message(user_id, '/pay'),
+        factory.message(user_id, 'Bench User {}'.format(user_id)),
+        factory.message(user_id, str(90000000 + user_id % 10000000)),
+        factory.message(user_id, collection_time),
+        factory.message(user_id, 'BIZ 2'),
+        factory.message(user_id, photo=True)
+    ]
+
+
+# Every user's step arrives before anyone's next one, which is the worst
+# interleaving the conversation states can see
+def lunch_rush(factory, users, menu, collection_time, seed):
+    rng = random.Random(seed)
+    scripts = []
+    for i in range(users):
+        category, item = rng.choice(menu)
+        scripts.append(lunch_order(factory, FIRST_USER_ID + i, category, item,
+                                   collection_time))
+    updates = []
+    for step in zip(*scripts):
+        step = list(step)
+        rng.shuffle(step)
+        updates.extend(step)
+    return updates
+
+
+def init_schema(bot):
+    # SQLite databases are created with the full schema
+    if bot.db.backend == 'postgres':
+        with bot.db.transaction() as cursor:
+            for stmt in BASE_SCHEMA:
+                cursor.execute(stmt)
+    bot.db.setup()
+    with bot.db.transaction() as cursor:
+        cursor.execute("SELECT count(*) FROM food_details;")
+        if cursor.fetchone()[0] == 0:
+            with open(os.path.join(HERE, 'images', 'qr_code.JPG'), 'rb') as f:
+                image = f.read()
+            sha256 = bot.blob_store.put(image)
+            for index, (name, price) in enumerate([
+                    ('Bench Laksa', '6.50'), ('Bench Chicken Rice', '5.00'),
+                    ('Bench Nasi Lemak', '5.50'), ('Bench Mee Goreng', '4.80')]):
+                cursor.execute("INSERT INTO food_details (item_index, category, name, price, image_sha256, image_size) VALUES (%s, %s, %s, %s, %s, %s);",
+                               (index, 'MONDAY', name, price, sha256,
+                                len(image)))
+        cursor.execute("SELECT count(*) FROM collection_time;")
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("INSERT INTO collection_time (time_options) VALUES ('12:00'), ('12:30'), ('13:00');")
+
+
+# Records which handler callback ended up handling each update
+def instrument(dispatcher, current):
+    def named(name, callback):
+        @wraps(callback)
+        def wrapped(*args, **kwargs):
+            current.handler = name
+            return callback(*args, **kwargs)
+
+        return wrapped
+
+    for group, handlers in dispatcher.handlers.items():
+        # Skip the schema gate, which sees every update
+        if group >= 0:
+            metrics.wrap_callbacks(handlers, named)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def report(samples, elapsed, workers, drained, statements_total, errors,
+           telegram):
+    rows = []
+    for name, results in sorted(samples.items()):
+        latencies = [x[0] * 1000 for x in results]
+        rows.append([name, len(results),
+                     percentile(latencies, 0.50),
+                     percentile(latencies, 0.95),
+                     percentile(latencies, 0.99),
+                     sum(x[1] for x in results) / float(len(results))])
+    print(tabulate(rows, headers=['handler', 'updates', 'p50 ms', 'p95 ms',
+                                  'p99 ms', 'db statements'],
+                   floatfmt='.2f'))
+    updates = sum(len(x) for x in samples.values())
+    print()
+    print('Processed {} updates in {:.2f}s ({:.1f} updates/s) on {} workers, '
+          '{} handler errors.'.format(updates, elapsed, updates / elapsed,
+                                      workers, errors))
+    print('Downloads and outgoing calls drained {:.2f}s later: {}.'.format(
+        drained, ', '.join('{} {}'.format(n, method) for method, n
+                           in sorted(telegram.calls.items()))))
+    print('{} database statements in total, {:.2f} per update including '
+          'background writes.'.format(statements_total,
+                                      statements_total / float(updates)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=100,
+                        help='users ordering at the same time')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='replay recorded updates, one JSON object per '
+                             'line, instead of a simulated lunch rush')
+    parser.add_argument('--workers', type=int,
+                        help='threads processing updates, defaults to '
+                             'UPDATE_WORKERS')
+    parser.add_argument('--api-latency', type=float, default=0.05,
+                        help='seconds each fake Bot API call takes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--init-schema', action='store_true',
+                        help='create the base tables and a menu if missing')
+    parser.add_argument('--keep-orders', action='store_true',
+                        help='leave the benchmark orders in the database')
+    args = parser.parse_args()
+
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+    # bot.py opens its images relative to the working directory
+    os.chdir(HERE)
+    logging.basicConfig(level=logging.WARNING)
+    import bot
+    import telegram
+    from dbhelper import statements
+
+    telegram_api = FakeTelegram(args.api_latency)
+    bot.bot._request = telegram_api
+    with open(os.path.join(HERE, 'images', 'qr_code.JPG'), 'rb') as f:
+        receipt_server = ReceiptServer(f.read())
+    threading.Thread(target=receipt_server.serve_forever, daemon=True).start()
+    bot.bot.base_file_url = receipt_server.url()
+
+    if args.init_schema:
+        init_schema(bot)
+    else:
+        bot.db.setup()
+    bot.rotate_orders()
+    bot.schema_ready.set()
+    bot.menu_cache.refresh()
+
+    dispatcher = bot.updater.dispatcher
+    bot.register_handlers(dispatcher)
+    current = threading.local()
+    instrument(dispatcher, current)
+    errors = []
+    dispatcher.add_error_handler(lambda b, update, error: errors.append(error))
+    uncaught = ErrorCounter()
+    logging.getLogger('telegram.ext.dispatcher').addHandler(uncaught)
+
+    # Updates are processed by the bot's own worker pool, one per chat at a
+    # time as in production. Latency counts from arrival, so it includes
+    # waiting for a worker.
+    samples = OrderedDict()
+    samples_lock = threading.Lock()
+    arrived = {}
+    process_update = dispatcher.process_update
+
+    def measured(update):
+        current.handler = None
+        count = statements.thread_count()
+        process_update(update)
+        with samples_lock:
+            samples.setdefault(current.handler or 'unhandled', []).append(
+                (time.perf_counter() - arrived[id(update)],
+                 statements.thread_count() - count))
+
+    dispatcher.process_update = measured
+    if args.workers:
+        bot.updates.workers = args.workers
+    bot.updates.install(dispatcher)
+
+    factory = UpdateFactory()
+    if args.replay:
+        with open(args.replay) as f:
+            raw_updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        menu = [(category, name) for category in CATEGORY_LABELS
+                for name in bot.menu_cache.category(category).names]
+        times = [slot for slot, _ in bot.slots.slots()
+                 if re.search('[0-2][0-9]:[0134][05]', slot)]
+        if not menu or not times:
+            parser.error('The database has no menu items or collection '
+                         'times, try --init-schema.')
+        raw_updates = lunch_rush(factory, args.users, menu, times[0],
+                                 args.seed)
+    updates = [telegram.Update.de_json(x, bot.bot) for x in raw_updates]
+
+    bot.state.start()
+    bot.outbox.start()
+    bot.updates.start()
+    statements_before = statements.total
+    started = time.perf_counter()
+    # Keep the handlers' order log out of the report
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        # Every user's updates arrive at once, like at the start of lunch
+        for update in updates:
+            arrived[id(update)] = time.perf_counter()
+            dispatcher.process_update(update)
+        bot.updates.stop(timeout=600)
+    elapsed = time.perf_counter() - started
+    bot.downloader.stop()
+    bot.outbox.stop(timeout=600)
+    bot.state.stop()
+    drained = time.perf_counter() - started - elapsed
+    report(samples, elapsed, bot.updates.workers, drained,
+           statements.total - statements_before,
+           len(errors) + uncaught.count, telegram_api)
+
+    if not args.keep_orders and not args.replay:
+        for i in range(args.users):
+            bot.db.delete_paid_user(FIRST_USER_ID + i)
+    receipt_server.shutdown()
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# These classes keep image blobs out of the order tables, addressed by the
+# SHA-256 hash of their content
+
+import hashlib
+import os
+import tempfile
+
+# Heroku dynos lose their filesystem on every restart, so deployments with a
+# database keep blobs in it unless told otherwise
+BLOB_STORE = os.environ.get('BLOB_STORE', 'postgres'
+                            if os.environ.get('DATABASE_URL') else 'local')
+BLOB_STORE_PATH = os.environ.get('BLOB_STORE_PATH', './blobs')
+
+
+class BlobStore:
+    @staticmethod
+    def key_for(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def put(self, data):
+        raise NotImplementedError
+
+    # Raises KeyError if no blob is stored under `key`
+    def get(self, key):
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root=BLOB_STORE_PATH):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key[2:])
+
+    def put(self, data):
+        key = self.key_for(data)
+        path = self._path(key)
+        if os.path.exists(path):
+            return key
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so readers never see partial blobs
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+        return key
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+
+# For hosts without a persistent filesystem, such as Heroku dynos
+class PostgresBlobStore(BlobStore):
+    def __init__(self, db):
+        self.db = db
+
+    def put(self, data):
+        key = self.key_for(data)
+        self.db.add_blob(key, data)
+        return key
+
+    def get(self, key):
+        data = self.db.check_blob(key)
+        if data is None:
+            raise KeyError(key)
+        return bytes(data)
+
+
+def open_blob_store(db):
+    if BLOB_STORE == 'local':
+        # Heroku sets DYNO on every dyno
+        if os.environ.get('DYNO'):
+            raise ValueError('BLOB_STORE {!r} would lose every blob when '
+                             'the dyno restarts.'.format(BLOB_STORE))
+        return LocalBlobStore()
+    if BLOB_STORE == 'postgres':
+        return PostgresBlobStore(db)
+    raise ValueError('Unknown BLOB_STORE {!r}.'.format(BLOB_STORE))
+
+
+# Move images still stored inline in the order and menu tables into `store`
+def externalize_images(db, store):
+    for category, image in db.inline_menu_images():
+        db.externalize_menu_image(store.put(bytes(image)), len(image),
+                                  category)
+    while True:
+        rows = db.inline_receipt_images()
+        if not rows:
+            break
+        for order_id, image in rows:
+            db.externalize_receipt_image(store.put(bytes(image)), len(image),
+                                         order_id)
@@ -0,0 +1,53 @@
+# These classes track how far the bot has booted and how long each step took
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class BootTracker:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        # Phase name -> seconds taken, in the order the phases finished
+        self.phases = OrderedDict()
+        self.failed = None
+        self.ready = threading.Event()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.failed = '{}: {}'.format(name, e)
+            logger.exception('Boot phase %s failed.', name)
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            with self.lock:
+                self.phases[name] = elapsed
+            logger.info('Boot phase %s took %.3fs', name, elapsed)
+
+    def mark_ready(self):
+        self.ready.set()
+        logger.info('Bot ready %.3fs after start (%s)', self.uptime(),
+                    ', '.join('{} {:.3f}s'.format(name, elapsed)
+                              for name, elapsed in self.report()['phases']))
+
+    def uptime(self):
+        return time.monotonic() - self.started
+
+    def report(self):
+        with self.lock:
+            phases = list(self.phases.items())
+        return {
+            'ready': self.ready.is_set(),
+            'failed': self.failed,
+            'uptime': self.uptime(),
+            'phases': phases
+        }
@@ -4,71 +4,159 @@
 provide its Telegram Bot services - @TheSpreadBot"""
 
 # Import libraries
-import sys
+import html
 import logging
 import os
-import math
+import re
+import secrets
+import signal
+import threading
+from functools import partial
 from decimal import Decimal
 from io import BytesIO
 from datetime import datetime
 from functools import wraps
-from tabulate import tabulate
-from PIL import Image
-import requests
 import ast
 import telegram
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, \
-    CallbackQueryHandler, PreCheckoutQueryHandler, ConversationHandler
+    CallbackQueryHandler, PreCheckoutQueryHandler, ConversationHandler, \
+    TypeHandler, DispatcherHandlerStop
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, \
     KeyboardButton, ReplyKeyboardMarkup, LabeledPrice
-from dbhelper import DBHelper
+from telegram.utils.request import Request
+from tabulate import tabulate
+from dbhelper import open_db, statements, business_day
+from outbox import Outbox, QueuedBot, OUTBOX_WORKERS, OUTBOX_GLOBAL_RATE
+from blobstore import open_blob_store, externalize_images
+from photocache import PhotoCache
+from downloads import Downloader
+import imaging
+from paynow import PaymentQR
+from slots import SlotScheduler
+import prep
+import exports
+from ingest import ChatWorkerPool, ConcurrentConversationHandler
+from dedup import open_dedup
+from sharding import ShardRouter, SHARDS
+import sharding
+from menucache import MenuCache
+from drafts import DraftStore, DraftOrder
+from statestore import StatePersistence, open_state_store
+from boot import BootTracker
+import webserver
+import metrics
+
+# Nothing below talks to the network until main() starts the bot
+boot = BootTracker()
+# Set once migrations have run, so updates never see an outdated schema
+schema_ready = threading.Event()
 
 # Initialize global variables
+# Process to stop when booting fails, which is the router when sharded
+supervisor_pid = os.getpid()
 BOT_TOKEN = os.environ['BOT_TOKEN']
 SUPER_ADMIN = ast.literal_eval(os.environ['SUPER_ADMIN'])
 ADMIN_LIST = ast.literal_eval(os.environ['ADMIN_LIST'])
-bot = telegram.Bot(token=BOT_TOKEN)
-# Create the EventHandler and pass it the bot's token.
-updater = Updater(token=BOT_TOKEN)
-db = DBHelper()
+# Outgoing calls are queued and delivered within Telegram's flood limits
+outbox = Outbox()
+bot = QueuedBot(BOT_TOKEN, outbox,
+                request=Request(con_pool_size=OUTBOX_WORKERS + 8))
+# Create the EventHandler and pass it the bot.
+updater = Updater(bot=bot)
+# Processes updates in parallel across chats, in order within each chat
+updates = ChatWorkerPool()
+db = open_db()
+metrics.instrument_db(db)
+blob_store = open_blob_store(db)
+photo_cache = PhotoCache(db, blob_store)
+menu_cache = MenuCache(db)
+state = StatePersistence(open_state_store(db))
+drafts = DraftStore(state.mapping('drafts'))
+# Where each "Next page" button continues, since filters do not fit into
+# Telegram's 64 bytes of callback data
+order_pages = state.mapping('order_pages')
+# Receipts and menu photos are fetched off the dispatcher thread
+downloader = Downloader()
+payment_qr = PaymentQR()
+slots = SlotScheduler(db)
+prep_schedule = prep.PrepSchedule()
+dedup = open_dedup(db)
+# Abandoned carts give up their collection slot
+drafts.on_expire(lambda draft: slots.release(draft.user_id))
+menu_cache.subscribe(photo_cache.invalidate)
+
+# Sampled whenever /metrics is scraped
+metrics.registry.gauge('bot_update_queue_depth',
+                       'Updates waiting to be processed.',
+                       lambda: updater.update_queue.qsize() +
+                       updates.pending())
+duplicate_updates = metrics.registry.counter(
+    'bot_duplicate_updates_total',
+    'Updates dropped because they had already been processed.')
+rejected_updates = metrics.registry.counter(
+    'bot_webhook_rejected_total',
+    'Webhook deliveries refused because too many updates were queued.')
+metrics.registry.gauge('bot_outbox_pending',
+                       'Outgoing calls waiting to be delivered.',
+                       outbox.pending)
+metrics.registry.gauge('bot_downloads_pending',
+                       'Photo downloads queued or in progress.',
+                       downloader.pending)
+metrics.registry.gauge('bot_state_pending_writes',
+                       'State changes waiting to be persisted.',
+                       lambda: len(state.writer.pending))
+metrics.registry.gauge('bot_db_pool_in_use',
+                       'Database connections checked out of the pool.',
+                       lambda: db.stats()['in_use'])
+metrics.registry.gauge('bot_db_pool_wait_seconds_max',
+                       'Longest wait for a pooled database connection.',
+                       lambda: db.stats()['wait_max'])
+metrics.registry.gauge('bot_db_statements_total',
+                       'Statements sent to the database.',
+                       lambda: statements.total, kind='counter')
+metrics.registry.gauge('bot_uptime_seconds',
+                       'Seconds since the bot process started.',
+                       boot.uptime)
 
 PORT = int(os.environ.get('PORT', '5000'))
+ORDER_PAGE_SIZE = int(os.environ.get('ORDER_PAGE_SIZE', '10'))
+# Seconds a /vieworderlist "Next page" button keeps working
+ORDER_PAGE_TTL = float(os.environ.get('ORDER_PAGE_TTL', '86400'))
 WEBHOOK_URL = os.environ['WEBHOOK_URL']
+# Weekdays (Monday is 0) and hours of the day when orders are taken
+OPERATING_DAYS = ast.literal_eval(os.environ.get('OPERATING_DAYS',
+                                                 '[0, 1, 2, 3, 4]'))
+OPERATING_HOURS = range(int(os.environ.get('OPENING_HOUR', '8')),
+                        int(os.environ.get('CLOSING_HOUR', '21')))
+# Seconds an update may wait for migrations before it is handled anyway
+BOOT_SCHEMA_TIMEOUT = float(os.environ.get('BOOT_SCHEMA_TIMEOUT', '30'))
+# Days of orders kept in order_list, including today, and in order_history
+# after that (0 keeps them forever)
+ORDER_RETENTION_DAYS = int(os.environ.get('ORDER_RETENTION_DAYS', '7'))
+ORDER_HISTORY_DAYS = int(os.environ.get('ORDER_HISTORY_DAYS', '365'))
+# Daily partitions of order_list created in advance
+ORDER_PARTITIONS_AHEAD = int(os.environ.get('ORDER_PARTITIONS_AHEAD', '7'))
+# Local time of day at which old orders are archived
+ORDER_ROTATION_TIME = datetime.strptime(
+    os.environ.get('ORDER_ROTATION_TIME', '03:00'), '%H:%M').time()
+# Chats that prep sheets are pushed to before each collection time
+PREP_CHAT_IDS = ast.literal_eval(os.environ.get('PREP_CHAT_IDS',
+                                                repr(ADMIN_LIST)))
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s -'
                            '%(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Callback data prefix of the /vieworderlist "Next page" button
+ORDER_PAGE_CALLBACK = '#vol'
+# Callback data prefix of the "Full receipt" button under a thumbnail
+RECEIPT_CALLBACK = '#rcpt'
+
 # For ConversationHandler purposes
 QUANTITY, REMARKS, FULL_NAME, CONTACT_NUMBER, LOCATION, COLLECTION_TIME, \
  RECEIPT_IMAGE, EDIT_MENU = range(8)
 
-# Global variables to store the menu (and for InlineButtons)
-monday_list = [db.check_menu('MONDAY')]
-tuesday_list = [db.check_menu('TUESDAY')]
-wednesday_list = [db.check_menu('WEDNESDAY')]
-thursday_list = [db.check_menu('THURSDAY')]
-friday_list = [db.check_menu('FRIDAY')]
-
-# Menu strings
-monday_menu = '\r\n'.join(['<pre>• ' + str(monday_list[0][0][i]) + ' - $' +
-                           str(monday_list[0][1][i]) + '</pre>'
-                           for i in range(len(monday_list[0][0]))])
-tuesday_menu = '\r\n'.join(['<pre>• ' + str(tuesday_list[0][0][i]) + ' - $' +
-                            str(tuesday_list[0][1][i]) + '</pre>'
-                            for i in range(len(tuesday_list[0][0]))])
-wednesday_menu = '\r\n'.join(['<pre>• ' + str(wednesday_list[0][0][i]) + ' - $'
-                              + str(wednesday_list[0][1][i]) + '</pre>'
-                              for i in range(len(wednesday_list[0][0]))])
-thursday_menu = '\r\n'.join(['<pre>• ' + str(thursday_list[0][0][i]) + ' - $' +
-                             str(thursday_list[0][1][i]) + '</pre>'
-                             for i in range(len(thursday_list[0][0]))])
-friday_menu = '\r\n'.join(['<pre>• ' + str(friday_list[0][0][i]) + ' - $' +
-                           str(friday_list[0][1][i]) + '</pre>'
-                           for i in range(len(friday_list[0][0]))])
-
-
 # Start to define functions
 
 # Only accessible if `user_id` is in `SUPER_ADMIN`
@@ -106,9 +194,7 @@ def operating_time(func):
         user_id = update.effective_user.id
         weekday = datetime.now().weekday()
         hour = datetime.now().hour
-        operating_days = list(range(0, 5))
-        operating_hours = list(range(8, 21))
-        if weekday not in operating_days or hour not in operating_hours:
+        if weekday not in OPERATING_DAYS or hour not in OPERATING_HOURS:
             reply_markup = telegram.ReplyKeyboardRemove()
             print('Out of operating time request by user {}.'
                   .format(user_id))
@@ -133,36 +219,272 @@ def root(bot, update):
                           'Thank you!')
 
 
+# Summarize the collected metrics in chat
+@restricted
+def stats(bot, update):
+    headers = ['', 'calls', 'errors', 'avg ms', 'p95 ms']
+    handlers = [[name, calls, errors, avg * 1000, p95 * 1000]
+                for name, calls, errors, avg, p95
+                in metrics.summary_rows(metrics.handler_seconds,
+                                        metrics.handler_errors)]
+    queries = [[name, calls, errors, avg * 1000, p95 * 1000]
+               for name, calls, errors, avg, p95
+               in metrics.summary_rows(metrics.db_seconds,
+                                       metrics.db_errors)]
+    prepared = [[name, calls, errors, avg * 1000, p95 * 1000]
+                for name, calls, errors, avg, p95
+                in metrics.summary_rows(metrics.statement_seconds,
+                                        metrics.statement_errors)]
+    updates = metrics.update_seconds.summary().get((), (0, 0.0, 0.0))
+    update_db = metrics.update_db_seconds.summary().get((), (0, 0.0, 0.0))
+    pool = db.stats()
+    text = ('Up {:.0f}s, {} updates processed, {:.1f}ms average of which '
+            '{:.1f}ms in the database.\r\n'
+            'Queued: {} updates, {} outgoing calls, {} state writes.\r\n'
+            'Database pool: {}/{} in use, {:.1f}ms longest wait, {} timeouts.'
+            .format(boot.uptime(), updates[0],
+                    updates[1] / updates[0] * 1000 if updates[0] else 0.0,
+                    update_db[1] / update_db[0] * 1000 if update_db[0] else 0.0,
+                    updater.update_queue.qsize() + updates.pending(),
+                    outbox.pending(),
+                    len(state.writer.pending), pool['in_use'], pool['size'],
+                    pool['wait_max'] * 1000, pool['timeouts']))
+    for title, rows in [('Slowest handlers', handlers),
+                        ('Slowest queries', queries),
+                        ('Slowest statements', prepared)]:
+        if rows:
+            text += '\r\n\r\n{}:\r\n<pre>{}</pre>'.format(
+                title, html.escape(tabulate(rows, headers=headers,
+                                            floatfmt='.1f')))
+    bot.send_message(chat_id=update.message.chat_id, text=text,
+                     parse_mode='HTML')
+
+
+def rotate_orders():
+    created, archived, dropped = db.rotate_orders(ORDER_PARTITIONS_AHEAD,
+                                                  ORDER_RETENTION_DAYS,
+                                                  ORDER_HISTORY_DAYS)
+    logger.info('Rotated orders: %d partitions created, %d archived, '
+                '%d dropped.', len(created), len(archived), len(dropped))
+    return created, archived, dropped
+
+
+# Archive old orders every night
+def rotate_orders_job(bot, job):
+    rotate_orders()
+
+
+# Orders are archived automatically, so this only runs the rotation early
 @restricted
 def purge(bot, update):
-    db.purge_order_list()
+    created, archived, dropped = rotate_orders()
     bot.send_message(chat_id=update.message.chat_id,
-                     text='Order list has been successfully purged!\r\n\r\n'
-                          'Please purge the order list daily so as to '
-                          'prevent too much lag. Thank you!')
+                     text='Orders older than {} days have been archived.'
+                          '\r\n\r\n'
+                          'Partitions created: {}\r\n'
+                          'Partitions archived: {}\r\n'
+                          'Partitions dropped: {}\r\n\r\n'
+                          'This also happens automatically every day at '
+                          '{:%H:%M}.'.format(ORDER_RETENTION_DAYS,
+                                             len(created), len(archived),
+                                             len(dropped),
+                                             ORDER_ROTATION_TIME))
+
+
+def send_prep(bot, chat_id, collection_time=None):
+    messages = prep.render(db.prep_totals(collection_time))
+    if not messages:
+        bot.send_message(chat_id=chat_id,
+                         text='There are no paid orders {}yet.'
+                              .format('for {} '.format(collection_time)
+                                      if collection_time else ''))
+    for text in messages:
+        bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML')
 
 
+# /prep [<collection_time>]
 @restricted
-def vieworderlist(bot, update):
-    order_list = db.retrieve_current_orders()
+def prep_sheet(bot, update, args):
+    send_prep(bot, update.message.chat_id, ' '.join(args) or None)
+
+
+# Push the prep sheet of each collection time shortly before it starts
+def push_prep(bot, job):
+    now = datetime.now()
+    if now.weekday() not in OPERATING_DAYS:
+        return
+    for collection_time in prep_schedule.due(
+            [slot for slot, _ in slots.slots()], now):
+        # Slots nobody has paid for need no sheet
+        messages = prep.render(db.prep_totals(collection_time))
+        for chat_id in PREP_CHAT_IDS:
+            for text in messages:
+                bot.send_message(chat_id=chat_id, text=text,
+                                 parse_mode='HTML')
+
+
+def send_export(bot, chat_id, start, end, fmt):
+    try:
+        output, count = exports.export(db.export_orders(start, end), fmt)
+    except Exception:
+        logger.exception('Order export failed.')
+        bot.send_message(chat_id=chat_id,
+                         text='Sorry, the export failed. Please try again '
+                              'later.')
+        return
+    if count == 0:
+        output.close()
+        bot.send_message(chat_id=chat_id,
+                         text='There are no orders from {} to {}.'
+                              .format(start, end))
+        return
+    bot.send_document(chat_id=chat_id, document=output,
+                      filename='orders_{}_{}.{}'.format(start, end, fmt),
+                      caption='{} order lines from {} to {}.'
+                              .format(count, start, end),
+                      on_sent=lambda message: output.close(),
+                      on_error=lambda error: output.close())
+
+
+# /exportorders [<from> [<to>]] [csv|xlsx], with dates as YYYY-MM-DD
+@restricted
+def export_orders(bot, update, args):
+    chat_id = update.message.chat_id
+    fmt = 'csv'
+    dates = []
+    try:
+        for arg in args:
+            if arg.lower() in exports.FORMATS:
+                fmt = arg.lower()
+            else:
+                dates.append(datetime.strptime(arg, '%Y-%m-%d').date())
+    except ValueError:
+        dates = None
+    if dates is None or len(dates) > 2:
+        bot.send_message(chat_id=chat_id,
+                         text='Usage: /exportorders [<from> [<to>]] '
+                              '[csv|xlsx], with dates as YYYY-MM-DD.')
+        return
+    start = dates[0] if dates else business_day()
+    end = dates[-1] if dates else start
+    if start > end:
+        start, end = end, start
+    bot.send_chat_action(chat_id=chat_id,
+                         action=telegram.ChatAction.UPLOAD_DOCUMENT)
+    # Weeks of orders take a while, so keep the dispatcher free meanwhile
+    threading.Thread(target=send_export, args=(bot, chat_id, start, end, fmt),
+                     name='export', daemon=True).start()
+
+
+# Send one page of paid orders, followed by a button for the next page
+def send_orders_page(bot, chat_id, after=None, collection_time=None,
+                     location=None):
     reply_markup = telegram.ReplyKeyboardRemove()
-    for i in order_list:
-        collection_time = str(i[0])
-        user_id = str(i[1])
-        contact_number = str(i[4])
-        item_ordered = str(i[5])
-        quantity = str(i[6])
-        location = str(i[7])
-        remarks = str(i[8])
-        receipt = BytesIO(i[10])
+    last_key = None
+    has_more = False
+    sent = 0
+    for i in db.paid_orders(ORDER_PAGE_SIZE + 1, after, collection_time,
+                            location):
+        if sent == ORDER_PAGE_SIZE:
+            has_more = True
+            break
+        last_key = (str(i[1]), i[0])
+        collection_time_value = str(i[1])
+        user_id = str(i[2])
+        contact_number = str(i[3])
+        item_ordered = str(i[4])
+        quantity = str(i[5])
+        location_value = str(i[6])
+        remarks = str(i[7])
+        caption = '{} - {}, {}: {} x{} at {}. {}'.format(
+            collection_time_value, user_id, contact_number, item_ordered,
+            quantity, location_value, remarks)
+        sent += 1
+        # Receipts are only fetched from the blob store when displayed, and
+        # only as thumbnails unless older orders have none
+        photo_markup = reply_markup
+        if i[9] is not None:
+            button = InlineKeyboardButton(
+                'Full receipt',
+                callback_data='|'.join([RECEIPT_CALLBACK, str(i[0])]))
+            photo_markup = InlineKeyboardMarkup([[button]])
+        try:
+            receipt = BytesIO(blob_store.get(i[9] or i[8]))
+        except (KeyError, TypeError):
+            bot.send_message(chat_id=chat_id,
+                             text=caption + ' (receipt image unavailable)',
+                             reply_markup=reply_markup,
+                             disable_notification=True)
+            continue
         receipt.seek(0)
-        bot.send_photo(chat_id=update.effective_user.id,
-                       caption='{} - {}, {}: {} x{} at {}. {}'
-                               .format(collection_time, user_id, contact_number, item_ordered, quantity, location, remarks),
+        bot.send_photo(chat_id=chat_id,
+                       caption=caption,
                        photo=receipt,
-                       reply_markup=reply_markup,
+                       reply_markup=photo_markup,
                        disable_notification=True)
 
+    if not sent and after is None:
+        bot.send_message(chat_id=chat_id,
+                         text='There are no paid orders to display.')
+    elif has_more:
+        token = secrets.token_urlsafe(12)
+        order_pages[token] = {'after': list(last_key),
+                              'collection_time': collection_time,
+                              'location': location}
+        callback_data = '|'.join([ORDER_PAGE_CALLBACK, token])
+        button = InlineKeyboardButton('Next page',
+                                      callback_data=callback_data)
+        bot.send_message(chat_id=chat_id,
+                         text='More orders are available.',
+                         reply_markup=InlineKeyboardMarkup([[button]]),
+                         disable_notification=True)
+
+
+# /vieworderlist [<collection_time>] [<location>]
+@restricted
+def vieworderlist(bot, update, args):
+    collection_time = None
+    if args and re.match('^[0-2][0-9]:[0-5][0-9]$', args[0]):
+        collection_time = args[0]
+        args = args[1:]
+    location = ' '.join(args) or None
+    send_orders_page(bot, update.effective_user.id,
+                     collection_time=collection_time, location=location)
+
+
+@restricted
+def vieworderlist_page(bot, update):
+    query = update.callback_query
+    bot.answer_callback_query(query.id)
+    page = order_pages.get(query.data.split('|', 1)[1])
+    if page is None:
+        bot.send_message(chat_id=update.effective_user.id,
+                         text='This order list has expired. Please use '
+                              '/vieworderlist again.')
+        return
+    after_time, after_id = page['after']
+    send_orders_page(bot, update.effective_user.id,
+                     after=(after_time, after_id),
+                     collection_time=page['collection_time'],
+                     location=page['location'])
+
+
+# Send the full-size receipt of an order shown as a thumbnail
+@restricted
+def view_receipt(bot, update):
+    query = update.callback_query
+    bot.answer_callback_query(query.id)
+    order_id = int(query.data.split('|')[1])
+    try:
+        receipt = BytesIO(blob_store.get(db.check_receipt(order_id)))
+    except (KeyError, TypeError):
+        bot.send_message(chat_id=update.effective_user.id,
+                         text='This receipt is no longer available.')
+        return
+    receipt.seek(0)
+    bot.send_photo(chat_id=update.effective_user.id, photo=receipt,
+                   reply_to_message_id=query.message.message_id)
+
 
 @restricted
 def editmenu(bot, update):
@@ -178,14 +500,27 @@ def menu_editor(bot, update):
         bot.send_message(chat_id=update.message.chat_id,
                          text='Please follow the aforementioned message format!')
     else:
-        item_image = bot.get_file(update.message.photo[-1].file_id)['file_path']
-        response = requests.get(item_image)
+        chat_id = update.message.chat_id
         category = str(update.message.caption.split(' - ')[0]).upper()
         name = str(" ".join(w.capitalize() for w in str(update.message.caption.split(' - ')[1]).split()))
         price = Decimal('{}'.format(update.message.caption.split(' - ')[2])).__round__(2)
-        db.edit_menu(name, response.content, price, category)
-        bot.send_message(chat_id=update.message.chat_id,
-                        text='{}\'s menu has been updated!'.format(category.capitalize()))
+
+        # Runs on a download worker once the photo has been fetched
+        def save_menu_item(image):
+            image = imaging.normalize(image).image
+            image_sha256 = blob_store.put(image)
+            db.edit_menu(name, image_sha256, len(image), price, category)
+            menu_cache.refresh()
+            bot.send_message(chat_id=chat_id,
+                             text='{}\'s menu has been updated!'.format(category.capitalize()))
+
+        def download_failed(error):
+            bot.send_message(chat_id=chat_id,
+                             text='The photo could not be downloaded. Please '
+                                  'use /editmenu to try again.')
+
+        downloader.download(bot, update.message.photo[-1].file_id,
+                            save_menu_item, download_failed)
 
         return ConversationHandler.END
 
@@ -239,10 +574,13 @@ def start(bot, update):
     if user_id in ADMIN_LIST:
         bot.send_message(chat_id=update.message.chat_id,
                          text='These are the possible admin commands:\r\n\r\n'
-                              '• /purge to purge the order list.\r\n'
+                              '• /purge to archive old orders now.\r\n'
                               '• /editmenu to edit the menu options.\r\n'
                               '• /deletepaiduser <user_id> to delete the delivered orders of a specific user.\r\n'
-                              '• /vieworderlist to display the current order list.\r\n')
+                              '• /vieworderlist [<time>] [<location>] to display the current order list.\r\n'
+                              '• /prep [<time>] to see the item totals to prepare.\r\n'
+                              '• /exportorders [<from> [<to>]] [csv|xlsx] to download the orders placed between two dates.\r\n'
+                              '• /stats to see how the bot is performing.\r\n')
 
 
 def terms(bot, update):
@@ -300,23 +638,14 @@ def menu(bot, update):
                           '<b>WEDNESDAY</b>\r\n{}\r\n\r\n'
                           '<b>THURSDAY</b>\r\n{}\r\n\r\n'
                           '<b>FRIDAY</b>\r\n{}\r\n\r\n'
-                     .format(str(monday_menu), str(tuesday_menu),
-                             str(wednesday_menu), str(thursday_menu),
-                             str(friday_menu)),
+                     .format(menu_cache.category('MONDAY').html,
+                             menu_cache.category('TUESDAY').html,
+                             menu_cache.category('WEDNESDAY').html,
+                             menu_cache.category('THURSDAY').html,
+                             menu_cache.category('FRIDAY').html),
                      reply_markup=reply_markup)
 
 
-# Build the inline menu
-def build_menu(buttons, n_cols, header_buttons=None,
-               footer_buttons=None):
-    menu = [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
-    if header_buttons:
-        menu.insert(0, header_buttons)
-    if footer_buttons:
-        menu.append(footer_buttons)
-    return menu
-
-
 # Function for ordering food
 @operating_time
 def order(bot, update):
@@ -344,105 +673,27 @@ def order(bot, update):
 # Function to ask user about category of food he/she wants to order
 def food_category(bot, update):
     if update.message.text == '😭 Monday':
-        monday(bot, update)
+        show_category(bot, update, 'MONDAY')
     elif update.message.text == '😞 Tuesday':
-        tuesday(bot, update)
+        show_category(bot, update, 'TUESDAY')
     elif update.message.text == '😕 Wednesday':
-        wednesday(bot, update)
+        show_category(bot, update, 'WEDNESDAY')
     elif update.message.text == '😬 Thursday':
-        thursday(bot, update)
+        show_category(bot, update, 'THURSDAY')
     elif update.message.text == '😍 Friday':
-        friday(bot, update)
-
-
-def monday(bot, update):
-    monday = db.check_photo("MONDAY")[0]
-    bio = BytesIO(monday)
-    bio.seek(0)
-    button_list = [InlineKeyboardButton(str(i), callback_data=str(i))
-                   for i in monday_list[0][0]]
-    reply_markup = telegram.ReplyKeyboardRemove()
-    bot.send_message(chat_id=update.message.chat_id,
-                     text='You have selected the Monday category.',
-                     reply_markup=reply_markup)
-    bot.send_photo(chat_id=update.effective_user.id,
-                   photo=bio)
-    reply_markup = InlineKeyboardMarkup(build_menu(button_list, n_cols=2))
-    bot.send_message(chat_id=update.message.chat_id,
-                     text='Monday\'s menu is:',
-                     reply_markup=reply_markup)
-
-
-def tuesday(bot, update):
-    tuesday = db.check_photo("TUESDAY")[0]
-    bio = BytesIO(tuesday)
-    bio.seek(0)
-    button_list = [InlineKeyboardButton(str(i), callback_data=str(i))
-                   for i in tuesday_list[0][0]]
-    reply_markup = telegram.ReplyKeyboardRemove()
-    bot.send_message(chat_id=update.message.chat_id,
-                     text='You have selected the Tuesday category.',
-                     reply_markup=reply_markup)
-    bot.send_photo(chat_id=update.effective_user.id,
-                   photo=bio)
-    reply_markup = InlineKeyboardMarkup(build_menu(button_list, n_cols=2))
-    bot.send_message(chat_id=update.message.chat_id,
-                     text='Tuesday\'s menu is:',
-                     reply_markup=reply_markup)
-
-
-def wednesday(bot, update):
-    wednesday = db.check_photo("WEDNESDAY")[0]
-    bio = BytesIO(wednesday)
-    bio.seek(0)
-    button_list = [InlineKeyboardButton(str(i), callback_data=str(i))
-                   for i in wednesday_list[0][0]]
-    reply_markup = telegram.ReplyKeyboardRemove()
-    bot.send_message(chat_id=update.message.chat_id,
-                     text='You have selected the Wednesday category.',
-                     reply_markup=reply_markup)
-    bot.send_photo(chat_id=update.effective_user.id,
-                   photo=bio)
-    reply_markup = InlineKeyboardMarkup(build_menu(button_list, n_cols=2))
-    bot.send_message(chat_id=update.message.chat_id,
-                     text='Wednesday\'s menu is:',
-                     reply_markup=reply_markup)
-
-
-def thursday(bot, update):
-    thursday = db.check_photo("THURSDAY")[0]
-    bio = BytesIO(thursday)
-    bio.seek(0)
-    button_list = [InlineKeyboardButton(str(i), callback_data=str(i))
-                   for i in thursday_list[0][0]]
-    reply_markup = telegram.ReplyKeyboardRemove()
-    bot.send_message(chat_id=update.message.chat_id,
-                     text='You have selected the Thursday category.',
-                     reply_markup=reply_markup)
-    bot.send_photo(chat_id=update.effective_user.id,
-                   photo=bio)
-    reply_markup = InlineKeyboardMarkup(build_menu(button_list, n_cols=2))
-    bot.send_message(chat_id=update.message.chat_id,
-                     text='Thursday\'s menu is:',
-                     reply_markup=reply_markup)
+        show_category(bot, update, 'FRIDAY')
 
 
-def friday(bot, update):
-    friday = db.check_photo("FRIDAY")[0]
-    bio = BytesIO(friday)
-    bio.seek(0)
-    button_list = [InlineKeyboardButton(str(i), callback_data=str(i))
-                   for i in friday_list[0][0]]
+def show_category(bot, update, category):
     reply_markup = telegram.ReplyKeyboardRemove()
     bot.send_message(chat_id=update.message.chat_id,
-                     text='You have selected the Friday category.',
+                     text='You have selected the {} category.'
+                     .format(category.capitalize()),
                      reply_markup=reply_markup)
-    bot.send_photo(chat_id=update.effective_user.id,
-                   photo=bio)
-    reply_markup = InlineKeyboardMarkup(build_menu(button_list, n_cols=2))
+    photo_cache.send(bot, update.effective_user.id, category)
     bot.send_message(chat_id=update.message.chat_id,
-                     text='Friday\'s menu is:',
-                     reply_markup=reply_markup)
+                     text='{}\'s menu is:'.format(category.capitalize()),
+                     reply_markup=menu_cache.category(category).keyboard)
 
 
 # Function to choose quantity
@@ -452,7 +703,9 @@ def quantity(bot, update):
     user_id = update.effective_user.id
     username = update.effective_user.username
     first_name = update.effective_user.first_name
-    db.add_order(user_id, username, first_name, query.data)
+    draft = drafts.get_or_create(user_id, username, first_name)
+    draft.add_line(query.data)
+    drafts.update(draft)
     bot.answer_callback_query(query.id)
     bot.edit_message_text(chat_id=query.message.chat_id,
                           text='Please enter the quantity for the item'
@@ -467,9 +720,17 @@ def quantity(bot, update):
 def remarks(bot, update):
     try:
         quantity = int(update.message.text)
+        # Largest value the order_list.quantity column can hold
+        if quantity > 2147483647:
+            raise OverflowError
         user_id = update.effective_user.id
-        item_ordered = str(db.select_latest_item(user_id))[2:-2]
-        db.add_quantity(quantity, user_id, item_ordered)
+        draft = drafts.get(user_id)
+        if draft is None or draft.latest_line() is None:
+            return order_expired(bot, update)
+        line = draft.latest_line()
+        line.quantity = quantity
+        drafts.update(draft)
+        item_ordered = line.item
         bot.send_message(chat_id=update.message.chat_id,
                          text='You have ordered {} {}.'.format(quantity,
                                                                item_ordered))
@@ -508,8 +769,20 @@ def remarks(bot, update):
 def time_select(bot, update):
     user_id = update.effective_user.id
     contact_number = int(update.message.text)
-    db.add_contact_number(contact_number, user_id)
-    time_options = db.time_list()
+    draft = drafts.get(user_id)
+    if draft is None:
+        return order_expired(bot, update)
+    draft.contact_number = contact_number
+    drafts.update(draft)
+    # Only slots the kitchen still has room in are offered
+    time_options = [[slot] for slot in slots.available()]
+    if not time_options:
+        bot.send_message(chat_id=update.message.chat_id,
+                         text='Sorry, all times of collection are fully '
+                              'booked. Please try /pay again later.',
+                         reply_markup=telegram.ReplyKeyboardRemove())
+
+        return ConversationHandler.END
     reply_keyboard = telegram.ReplyKeyboardMarkup(time_options)
     bot.send_chat_action(chat_id=update.effective_user.id,
                          action=telegram.ChatAction.TYPING)
@@ -524,12 +797,12 @@ def time_select(bot, update):
 # Function to add delivery location (if applicable)
 @operating_time
 def locator(bot, update):
-    time_options = db.time_list()
-    time = update.effective_message.text
+    time = str(update.effective_message.text)
     user_id = update.effective_user.id
-    reply_keyboard = telegram.ReplyKeyboardMarkup(time_options)
     reply_markup = telegram.ReplyKeyboardRemove()
-    if [str(time)] not in time_options:
+    if not slots.is_slot(time):
+        reply_keyboard = telegram.ReplyKeyboardMarkup(
+            [[slot] for slot in slots.available()])
         bot.send_chat_action(chat_id=update.effective_user.id,
                              action=telegram.ChatAction.TYPING)
         bot.send_message(chat_id=update.message.chat_id,
@@ -538,7 +811,20 @@ def locator(bot, update):
                               ' for all of your orders.',
                          reply_markup=reply_keyboard)
     else:
-        db.add_time(time, user_id)
+        draft = drafts.get(user_id)
+        if draft is None:
+            return order_expired(bot, update)
+        if not slots.reserve(user_id, time):
+            reply_keyboard = telegram.ReplyKeyboardMarkup(
+                [[slot] for slot in slots.available()])
+            bot.send_message(chat_id=update.message.chat_id,
+                             text='Sorry, {} has just been fully booked. '
+                                  'Please select another time of '
+                                  'collection.'.format(time),
+                             reply_markup=reply_keyboard)
+            return
+        draft.collection_time = time
+        drafts.update(draft)
         bot.send_chat_action(chat_id=update.effective_user.id,
                              action=telegram.ChatAction.TYPING)
         bot.send_message(chat_id=update.message.chat_id,
@@ -575,9 +861,14 @@ def end_order(bot, update):
                             'person nicely as he/she is literally your boss.' \
                             ' Thank you!)'
 
-    item_ordered = str(db.select_latest_item(user_id))[2:-2]
-    db.add_remarks(remarks, user_id, item_ordered)
-    latest_item_quantity = str(db.select_latest_quantity(user_id))[1:-1]
+    draft = drafts.get(user_id)
+    if draft is None or draft.latest_line() is None:
+        return order_expired(bot, update)
+    line = draft.latest_line()
+    line.remarks = remarks
+    drafts.update(draft)
+    item_ordered = line.item
+    latest_item_quantity = line.quantity
     print(str(datetime.now()) + ' - User {} ordered {}x {}.'
           .format(user_id, latest_item_quantity, item_ordered))
     reply_markup = telegram.ReplyKeyboardRemove()
@@ -592,24 +883,50 @@ def end_order(bot, update):
     return ConversationHandler.END
 
 
+# The draft order was abandoned and expired during the conversation
+def order_expired(bot, update):
+    reply_markup = telegram.ReplyKeyboardRemove()
+    bot.send_message(chat_id=update.message.chat_id,
+                     text='Your cart is currently empty. '
+                          'Please order an item first.',
+                     reply_markup=reply_markup)
+
+    return ConversationHandler.END
+
+
 def fallback(bot, update):
     bot.send_message(chat_id=update.message.chat_id,
                      text='Please complete your previous order first.')
 
 
+# Price the user's draft order against the current menu
+def draft_cart(user_id):
+    draft = drafts.get(user_id)
+    if draft is None:
+        return DraftOrder(user_id).cart(menu_cache.prices())
+    return draft.cart(menu_cache.prices())
+
+
+# Render the lines of a cart as a bulleted list
+def format_cart(user_cart):
+    return '\r\n'.join(['• ' + str(item) + ' x' + str(int(quantity)) +
+                         ' - $' + str(Decimal('{}'.format(str(line_total)))
+                                      .__round__(2))
+                         for item, quantity, line_total in
+                         zip(user_cart.items, user_cart.quantities,
+                             user_cart.line_totals)])
+
+
 # Function for checking the user's current cart
 @operating_time
 def cart(bot, update):
     user_id = update.effective_user.id
-    item_list = db.check_order(user_id)
-    total_price = Decimal('{}'.format(str(sum(item_list[2])))).__round__(2)
+    user_cart = draft_cart(user_id)
+    total_price = Decimal('{}'.format(str(user_cart.total))).__round__(2)
 
     try:
-        cart_list = '\r\n'.join(['• ' + str(item_list[0][i]) + ' x' +
-                                 str(int(item_list[1][i])) + ' - $' + str(
-            Decimal('{}'.format(str(item_list[2][i]))).__round__(2))
-                                 for i in range(len(item_list[0]))])
-        if not item_list[0]:
+        cart_list = format_cart(user_cart)
+        if not user_cart.items:
             bot.send_message(chat_id=update.message.chat_id,
                              text='Your cart is currently empty. '
                                   'Please order an item first.')
@@ -633,15 +950,16 @@ def cart(bot, update):
 # TODO: Make this not cancel current orders when cancelling /editmenu
 def cancel(bot, update):
     user_id = update.effective_user.id
-    item_list = db.check_order(user_id)
+    user_cart = draft_cart(user_id)
     reply_markup = telegram.ReplyKeyboardRemove()
-    if not item_list[0]:
+    if not user_cart.items:
         bot.send_message(chat_id=update.message.chat_id,
                          text='Your cart is currently empty. '
                               'Please order an item first.',
                          reply_markup=reply_markup)
     else:
-        db.delete_order(user_id)
+        drafts.discard(user_id)
+        slots.release(user_id)
         print(str(datetime.now()) + ' - User {} cancelled his/her '
                                     'order.'.format(user_id))
         bot.send_message(chat_id=update.message.chat_id,
@@ -667,9 +985,9 @@ def offers(bot, update):
 @operating_time
 def fullname_entry(bot, update):
     user_id = update.effective_user.id
-    item_list = db.check_order(user_id)
+    user_cart = draft_cart(user_id)
     reply_markup = telegram.ReplyKeyboardRemove()
-    if not item_list[0]:
+    if not user_cart.items:
         bot.send_chat_action(chat_id=update.effective_user.id,
                              action=telegram.ChatAction.TYPING)
         bot.send_message(chat_id=update.message.chat_id,
@@ -692,7 +1010,11 @@ def fullname_entry(bot, update):
 def contact_number_entry(bot, update):
     full_name = str(update.message.text)
     user_id = update.effective_user.id
-    db.add_full_name(full_name, user_id)
+    draft = drafts.get(user_id)
+    if draft is None:
+        return order_expired(bot, update)
+    draft.full_name = full_name
+    drafts.update(draft)
     reply_markup = telegram.ReplyKeyboardRemove()
     bot.send_chat_action(chat_id=update.effective_user.id,
                          action=telegram.ChatAction.TYPING)
@@ -709,16 +1031,17 @@ def start_payment(bot, update):
     location = str(update.message.text)
     user_id = update.effective_user.id
     chat_id = update.effective_message.chat_id
-    db.add_location(location, user_id)
+    draft = drafts.get(user_id)
+    if draft is None:
+        return order_expired(bot, update)
+    draft.location = location
+    drafts.update(draft)
     # Price in dollars
-    total_price = Decimal('{}'.format(str(sum(db.check_order(user_id)[2])))).__round__(2)
-    item_list = db.check_order(user_id)
-
-    cart_list = '\r\n'.join(['• ' + str(item_list[0][i]) + ' x' +
-                             str(int(item_list[1][i])) + ' - $' +
-                             str(Decimal('{}'.format(str(item_list[2][i]))).__round__(2))
-                             for i in range(len(item_list[0]))])
-    if not item_list[0]:
+    prices = menu_cache.prices()
+    user_cart = draft.cart(prices)
+    total_price = Decimal('{}'.format(str(user_cart.total))).__round__(2)
+
+    if not draft.payable_lines(prices):
         bot.send_message(chat_id=chat_id,
                          text='Your cart is currently empty. '
                               'Please order an item first.')
@@ -726,20 +1049,24 @@ def start_payment(bot, update):
         return ConversationHandler.END
 
     else:
+        cart_list = format_cart(user_cart)
+        reference = payment_qr.reference(draft)
         reply_markup = telegram.ReplyKeyboardRemove()
         bot.send_chat_action(chat_id=chat_id,
                              action=telegram.ChatAction.TYPING)
         bot.send_message(parse_mode='HTML', chat_id=chat_id,
                          text='<b>The Spread Bot - Payment Invoice</b>'
                               '\r\n\r\n{}\r\n\r\n'
-                              'Total Payable: <b>${}</b>\r\n\r\n'
+                              'Total Payable: <b>${}</b>\r\n'
+                              'Reference: <b>{}</b>\r\n\r\n'
                               'Please pay using the following '
                               'dynamically-generated QR Code. '
                               'You may use PayLah for payment method.'
-                         .format(str(cart_list), str(total_price)),
+                         .format(str(cart_list), str(total_price),
+                                 html.escape(reference)),
                          reply_markup=reply_markup)
-        # TODO: Implement dynamic QR Code generation function here and send to user
-        bot.send_photo(chat_id=chat_id, photo=open('./images/qr_code.JPG', 'rb'))
+        # The QR code carries the exact amount and reference
+        payment_qr.send(bot, chat_id, total_price, reference)
         bot.send_message(chat_id=chat_id,
                          text='After payment, please take a screenshot '
                               'of your receipt/successful payment page '
@@ -756,31 +1083,131 @@ def start_payment(bot, update):
 # Add receipt screenshot to database and end transaction
 @operating_time
 def end_payment(bot, update):
-    receipt_image = bot.get_file(update.message.photo[-1].file_id)['file_path']
-    response = requests.get(receipt_image)
     user_id = update.effective_user.id
-    db.add_receipt_image(response.content, user_id)
-    db.paid_payment_status(user_id)
-    print(str(datetime.now()) + ' - User {} has paid for their order.'.format(user_id))
-    bot.send_message(chat_id=update.message.chat_id,
-                     text='Thank you for your payment! Please show your '
-                          'proof of transaction to the waiter at The Spread '
-                          'as proof to collect your order. After collecting '
-                          'your order, please allow the waiter to delete the '
-                          'screenshot. Have a nice day ahead and enjoy your '
-                          'meal!\r\n\r\nWARNING: Do not delete the image '
-                          'yourself before collecting your order, as it will'
-                          ' render your order invalid!')
+    chat_id = update.message.chat_id
+    draft = drafts.get(user_id)
+    if draft is None:
+        return order_expired(bot, update)
+    prices = menu_cache.prices()
+    if not draft.payable_lines(prices):
+        bot.send_message(chat_id=chat_id,
+                         text='None of the items in your cart are on the '
+                              'menu any more. Please order an item first.')
+
+        return ConversationHandler.END
+    # Taken out of the store now, so the user can start a new order while
+    # the receipt is still downloading
+    drafts.discard(user_id)
+
+    # Runs on a download worker once the receipt has been fetched
+    def place_order(receipt):
+        receipt = imaging.normalize(receipt)
+        receipt_sha256 = blob_store.put(receipt.image)
+        thumb_sha256 = blob_store.put(receipt.thumbnail)
+        # The whole order is written in one transaction once it is paid for
+        db.place_order(draft, prices, receipt_sha256, len(receipt.image),
+                       thumb_sha256)
+        print(str(datetime.now()) + ' - User {} has paid for their order.'.format(user_id))
+        bot.send_message(chat_id=chat_id,
+                         text='Thank you for your payment! Please show your '
+                              'proof of transaction to the waiter at The Spread '
+                              'as proof to collect your order. After collecting '
+                              'your order, please allow the waiter to delete the '
+                              'screenshot. Have a nice day ahead and enjoy your '
+                              'meal!\r\n\r\nWARNING: Do not delete the image '
+                              'yourself before collecting your order, as it will'
+                              ' render your order invalid!')
+
+    def download_failed(error):
+        # Put the order back unless a new one has been started since
+        if drafts.get(user_id) is None:
+            drafts.update(draft)
+        bot.send_message(chat_id=chat_id,
+                         text='Your receipt could not be received. Please '
+                              'use /pay to send it again.')
+
+    bot.send_chat_action(chat_id=chat_id,
+                         action=telegram.ChatAction.TYPING)
+    downloader.download(bot, update.message.photo[-1].file_id, place_order,
+                        download_failed)
 
     return ConversationHandler.END
 
 
-def main():
-    # Get the dispatcher to register handlers
-    dp = updater.dispatcher
+# Drop abandoned draft orders and stale order list pages
+def maintain_drafts(bot, job):
+    drafts.expire()
+    order_pages.expire(ORDER_PAGE_TTL)
+
+
+# Holds updates back until the database schema is up to date
+def wait_for_schema(bot, update):
+    if not schema_ready.wait(BOOT_SCHEMA_TIMEOUT):
+        logger.warning('Handling update %s before migrations finished.',
+                       update.update_id)
+
+
+# Refuse webhook deliveries while the workers are too far behind
+def admit_update(pool=updates):
+    if pool.full():
+        rejected_updates.inc()
+        return False
+    return True
+
 
+# Drop updates that Telegram delivered more than once
+def drop_duplicates(bot, update):
+    if not dedup.claim(update.update_id):
+        duplicate_updates.inc()
+        logger.info('Dropping duplicate update %s.', update.update_id)
+        raise DispatcherHandlerStop
+
+
+def maintain_dedup(bot, job):
+    dedup.expire()
+
+
+def healthz():
+    report = boot.report()
+    report['status'] = 'ready' if report['ready'] else \
+        'failed' if report['failed'] else 'starting'
+    return webserver.json_response(200 if report['ready'] else 503, report)
+
+
+# Runs the slow startup work once the webhook is already listening.
+# `on_ready` is called once the bot can handle updates.
+def warm_up(register_webhook=True, on_ready=None):
+    try:
+        with boot.phase('migrations'):
+            db.setup()
+        # Today's orders need a partition to go into
+        with boot.phase('order rotation'):
+            rotate_orders()
+        schema_ready.set()
+        # Catch up with menu edits made while the bot was down
+        with boot.phase('menu'):
+            menu_cache.refresh()
+            # Only a shared database can be edited by other processes
+            if db.backend == 'postgres':
+                menu_cache.listen()
+        if register_webhook:
+            with boot.phase('webhook registration'):
+                updater.bot.set_webhook(WEBHOOK_URL + BOT_TOKEN)
+    except Exception:
+        # Shut down through updater.idle() so the dyno gets restarted
+        os.kill(supervisor_pid, signal.SIGTERM)
+        return
+    boot.mark_ready()
+    if on_ready is not None:
+        on_ready()
+    # One-off move of legacy inline images, which may take a while
+    with boot.phase('image externalization'):
+        externalize_images(db, blob_store)
+
+
+def register_handlers(dp):
     # Add conversation handler for /order command
-    order_conv_handler = ConversationHandler(
+    order_conv_handler = ConcurrentConversationHandler(
         entry_points=[CallbackQueryHandler(quantity)],
 
         states={
@@ -804,6 +1231,9 @@ def main():
                    CommandHandler('vieworderlist', fallback),
                    CommandHandler('editmenu', fallback),
                    CommandHandler('deletepaiduser', fallback),
+                   CommandHandler('stats', fallback),
+                   CommandHandler('prep', fallback),
+                   CommandHandler('exportorders', fallback),
                    CommandHandler('root', fallback)],
 
         per_message=False,
@@ -811,7 +1241,7 @@ def main():
         allow_reentry=False
     )
 
-    payment_conv_handler = ConversationHandler(
+    payment_conv_handler = ConcurrentConversationHandler(
         entry_points=[CommandHandler('pay', fullname_entry)],
 
         states={
@@ -847,6 +1277,9 @@ def main():
                    CommandHandler('vieworderlist', fallback),
                    CommandHandler('editmenu', fallback),
                    CommandHandler('deletepaiduser', fallback),
+                   CommandHandler('stats', fallback),
+                   CommandHandler('prep', fallback),
+                   CommandHandler('exportorders', fallback),
                    CommandHandler('root', fallback)],
 
         per_message=False,
@@ -854,7 +1287,7 @@ def main():
         allow_reentry=False
     )
 
-    editmenu_conv_handler = ConversationHandler(
+    editmenu_conv_handler = ConcurrentConversationHandler(
         entry_points=[CommandHandler('editmenu', editmenu)],
 
         states={
@@ -874,6 +1307,9 @@ def main():
                    CommandHandler('vieworderlist', fallback),
                    CommandHandler('editmenu', fallback),
                    CommandHandler('deletepaiduser', fallback),
+                   CommandHandler('stats', fallback),
+                   CommandHandler('prep', fallback),
+                   CommandHandler('exportorders', fallback),
                    CommandHandler('root', fallback)],
 
         per_message=False,
@@ -881,10 +1317,27 @@ def main():
         allow_reentry=False
     )
 
+    # Must come before the order ConversationHandler, whose entry point
+    # accepts any callback query
+    dp.add_handler(CallbackQueryHandler(vieworderlist_page,
+                                        pattern='^' + ORDER_PAGE_CALLBACK))
+    dp.add_handler(CallbackQueryHandler(view_receipt,
+                                        pattern='^' + RECEIPT_CALLBACK))
+    # Conversation states live in the state store, so they survive
+    # restarts and are shared between bot processes
+    order_conv_handler.conversations = state.mapping('conversation:order')
+    payment_conv_handler.conversations = \
+        state.mapping('conversation:payment')
+    editmenu_conv_handler.conversations = \
+        state.mapping('conversation:editmenu')
+
     dp.add_handler(order_conv_handler)
     dp.add_handler(payment_conv_handler)
     dp.add_handler(editmenu_conv_handler)
 
+    dp.add_handler(TypeHandler(telegram.Update, wait_for_schema), group=-2)
+    dp.add_handler(TypeHandler(telegram.Update, drop_duplicates), group=-1)
+
     # Simple start function
     dp.add_handler(CommandHandler('start', start))
     dp.add_handler(CommandHandler('help', start))
@@ -897,30 +1350,156 @@ def main():
     # This command will not be in the list of commands
     dp.add_handler(CommandHandler('purge', purge))
     # This command will not be in the list of commands
-    dp.add_handler(CommandHandler('vieworderlist', vieworderlist))
+    dp.add_handler(CommandHandler('vieworderlist', vieworderlist,
+                                  pass_args=True))
+    # This command will not be in the list of commands
+    dp.add_handler(CommandHandler('prep', prep_sheet, pass_args=True))
+    # This command will not be in the list of commands
+    dp.add_handler(CommandHandler('exportorders', export_orders,
+                                  pass_args=True))
     # This command will not be in the list of commands
     dp.add_handler(CommandHandler('deletepaiduser', delete_paid, pass_args=True))
     # This command will not be in the list of commands
     dp.add_handler(CommandHandler('root', root))
+    dp.add_handler(CommandHandler('stats', stats))
 
     dp.add_handler(MessageHandler(Filters.text, food_category), group=0)
 
-    # Setup database
-    db.setup()
-
     # Log all errors
     dp.add_error_handler(error)
 
-    # Start the bot
+
+# Starts everything needed to handle updates. Scheduled jobs only run in
+# one process, so they are not repeated by every shard.
+def start_services(run_jobs=True):
+    # Get the dispatcher to register handlers
+    register_handlers(updater.dispatcher)
+    metrics.instrument_dispatcher(updater.dispatcher)
+    # The dispatcher thread only hands updates over to the workers
+    updates.install(updater.dispatcher)
+
+    if run_jobs:
+        updater.job_queue.run_repeating(maintain_drafts, interval=60,
+                                        first=60)
+        updater.job_queue.run_daily(rotate_orders_job, ORDER_ROTATION_TIME)
+        updater.job_queue.run_repeating(push_prep, interval=60, first=60)
+    updater.job_queue.run_repeating(maintain_dedup, interval=300, first=300)
+
+    # Serve the last known menu until the database has been read
+    with boot.phase('menu snapshot'):
+        menu_cache.load_snapshot()
+
+    state.start()
+    # Cached states are only used while other processes' writes are heard
+    state.listen()
+    outbox.start()
+    updates.start()
+
+
+# Finish queued updates and downloads, flush queued messages and state, then
+# release pooled database connections
+def stop_services():
+    updates.stop()
+    downloader.stop()
+    outbox.stop()
+    state.stop()
+    db.close()
+
+
+# Entry point of each worker process when sharded
+def run_shard(shard, queue, ready):
+    # The router stops the workers once it has stopped taking updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sharding.handle_sigterm()
+    # Telegram's limit applies to the bot, not to each process
+    outbox.set_global_rate(OUTBOX_GLOBAL_RATE / sharding.SHARDS)
+    start_services(run_jobs=shard == 0)
+    updater.job_queue.start()
+    threading.Thread(target=updater.dispatcher.start, name='dispatcher',
+                     daemon=True).start()
+    threading.Thread(target=warm_up,
+                     kwargs={'register_webhook': False,
+                             'on_ready': ready.set},
+                     name='warm-up', daemon=True).start()
+    try:
+        sharding.serve(queue, updater.bot, updater.update_queue)
+        updater.dispatcher.stop()
+        updater.job_queue.stop()
+        stop_services()
+    except sharding.StopTimeout:
+        # Unsent messages are lost either way, but conversations are not
+        logger.warning('Shard %s ran out of time to stop.', shard)
+        state.stop()
+        db.close()
+
+
+# Restart the dyno if a worker process has died
+def watch_shards(bot, job):
+    dead = job.context.dead()
+    if dead:
+        logger.error('Shards %s exited, shutting down.', dead)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+# The router is ready once every worker has run its migrations and warmed
+# up, and Telegram knows the webhook
+def register_webhook(router):
+    try:
+        with boot.phase('shard warm-up'):
+            router.wait_ready()
+        with boot.phase('webhook registration'):
+            updater.bot.set_webhook(WEBHOOK_URL + BOT_TOKEN)
+    except Exception:
+        os.kill(os.getpid(), signal.SIGTERM)
+        return
+    boot.mark_ready()
+
+
+# Receives the webhook and passes each update on to the worker process
+# owning its user
+def run_router():
+    router = ShardRouter()
+    with boot.phase('shards'):
+        router.start(run_shard)
+    updater.dispatcher.process_update = router.route
+    updater.job_queue.run_repeating(watch_shards, interval=5, first=5,
+                                    context=router)
+
+    webserver.add_route('/healthz', healthz)
+    webserver.set_admission(partial(admit_update, router))
+    webserver.install()
+    with boot.phase('webhook bind'):
+        updater.start_webhook(listen='0.0.0.0', port=PORT,
+                              url_path=BOT_TOKEN)
+    threading.Thread(target=register_webhook, args=(router,),
+                     name='warm-up', daemon=True).start()
+    updater.idle()
+    router.stop()
+
+
+def main():
+    if SHARDS > 1:
+        run_router()
+        return
+
+    start_services()
     # updater.start_polling(timeout=0)
 
-    updater.start_webhook(listen='0.0.0.0', port=PORT, url_path=BOT_TOKEN)
-    updater.bot.set_webhook(WEBHOOK_URL + BOT_TOKEN)
+    # Bind the port straight away and finish booting in the background
+    webserver.add_route('/healthz', healthz)
+    webserver.add_route('/metrics', metrics.metrics_route)
+    webserver.set_admission(admit_update)
+    webserver.install()
+    with boot.phase('webhook bind'):
+        updater.start_webhook(listen='0.0.0.0', port=PORT,
+                              url_path=BOT_TOKEN)
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
+    stop_services()
 
 
 if __name__ == '__main__':
@@ -1,153 +1,612 @@
 # This class serves the SQL commands
 
 # Production mode
+import itertools
+import json
 import os
-import psycopg2
+import re
+import time
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+import metrics
+from migrations import migrate
 
-DATABASE_URL = os.environ['DATABASE_URL']
+# Either `postgres`, or `sqlite` for a single process on one machine
+DB_BACKEND = os.environ.get('DB_BACKEND', 'postgres')
+# Only needed by the `postgres` backend
+DATABASE_URL = os.environ.get('DATABASE_URL')
+# Heroku Postgres requires SSL, a local database usually does not offer it
+DB_SSLMODE = os.environ.get('DB_SSLMODE', 'require')
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+# Connections idle for longer than this many seconds are pinged before reuse
+DB_HEALTH_CHECK_INTERVAL = float(os.environ.get('DB_HEALTH_CHECK_INTERVAL',
+                                                '30'))
+# Set to 0 behind a transaction-mode pooler such as PgBouncer, which does
+# not keep prepared statements between transactions
+DB_PREPARE = bool(int(os.environ.get('DB_PREPARE', '1')))
+# NOTIFY channel announcing committed menu edits
+MENU_CHANNEL = 'menu_changed'
+# NOTIFY channel announcing state keys written by another process, and how
+# many keys each notification lists within Postgres's 8000 byte payloads
+STATE_CHANNEL = 'state_changed'
+STATE_NOTIFY_KEYS = 100
+# Arbitrary key for the advisory lock that serializes order rotations
+ROTATION_LOCK_ID = 7243002
 
-class DBHelper:
+
+# Orders are filed under the local date they were placed on, which relies
+# on TZ being set to Singapore time
+def business_day():
+    return date.today()
+
+
+# Rows that place_order() inserts for each line of a paid draft order. Only
+# the lines priced into the total at `prices` reach the kitchen.
+def _order_rows(draft, prices, receipt_sha256, receipt_size,
+                receipt_thumb_sha256):
+    day = business_day()
+    return [(day, draft.user_id, draft.username, draft.full_name,
+             draft.contact_number, line.item, line.quantity, draft.location,
+             line.remarks, draft.collection_time, 'PAID', receipt_sha256,
+             receipt_size, receipt_thumb_sha256)
+            for line in draft.payable_lines(prices)]
+
+
+# Upper bound of a range partition, or None for DEFAULT or MAXVALUE
+def _upper_bound(bound):
+    match = re.search(r"TO \('(\d{4}-\d{2}-\d{2})'\)", bound)
+    if match is None:
+        return None
+    return datetime.strptime(match.group(1), '%Y-%m-%d').date()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Counts statements sent to the database, in total and per thread
+class StatementCounter:
     def __init__(self):
-        self.conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        self.cursor = self.conn.cursor()
+        self.lock = threading.Lock()
+        self.total = 0
+        self.local = threading.local()
+
+    def add(self):
+        with self.lock:
+            self.total += 1
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def thread_count(self):
+        return getattr(self.local, 'count', 0)
+
+
+statements = StatementCounter()
+
+
+# Hot statements run on every conversation step, executed by name. Postgres
+# then parses and plans each of them once per connection.
+STATEMENTS = {
+    'check_full_menu': "SELECT category, name, price, version FROM food_details ORDER BY id ASC;",
+    'check_photo_file_id': "SELECT version, image_file_id FROM food_details WHERE category IN (%s) ORDER BY id ASC LIMIT 1;",
+    'check_slots': "SELECT time_options, capacity FROM collection_time ORDER BY id ASC;",
+    'slot_usage': "SELECT collection_time, count(*) FROM (SELECT user_id, collection_time FROM order_list WHERE business_day = (%s) AND status = 'PAID' UNION SELECT user_id, collection_time FROM slot_reservations WHERE reserved_at > now() - make_interval(secs => %s)) AS booked GROUP BY collection_time;",
+    'lock_slot': "SELECT id FROM collection_time WHERE time_options = (%s) FOR UPDATE;",
+    'count_slot': "SELECT count(*) FROM (SELECT user_id FROM order_list WHERE business_day = (%s) AND status = 'PAID' AND collection_time = (%s) UNION SELECT user_id FROM slot_reservations WHERE collection_time = (%s) AND reserved_at > now() - make_interval(secs => %s)) AS booked WHERE user_id <> (%s);",
+    'reserve_slot': "INSERT INTO slot_reservations (user_id, collection_time) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET collection_time = EXCLUDED.collection_time, reserved_at = now();",
+    'release_slot': "DELETE FROM slot_reservations WHERE user_id = (%s);",
+    'check_receipt': "SELECT receipt_sha256 FROM order_list WHERE id = (%s);",
+    'check_blob': "SELECT data FROM blob_store WHERE sha256 = (%s);",
+    'check_state': "SELECT value FROM bot_state WHERE namespace = (%s) AND key = (%s);",
+    'claim_update': "INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING;"
+}
+
+
+# The PREPARE and EXECUTE commands for each statement in `statements`
+class StatementCatalog:
+    def __init__(self, statements):
+        self.sql = dict(statements)
+        self.prepare = {}
+        self.execute = {}
+        for name, sql in self.sql.items():
+            numbers = itertools.count(1)
+            body = re.sub(r'%s', lambda match: '${}'.format(next(numbers)),
+                          sql.rstrip(';'))
+            params = next(numbers) - 1
+            self.prepare[name] = 'PREPARE {} AS {};'.format(name, body)
+            self.execute[name] = 'EXECUTE {}{};'.format(
+                name, '({})'.format(', '.join(['%s'] * params))
+                if params else '')
+
+
+catalog = StatementCatalog(STATEMENTS)
+
+
+class DBHelper:
+    backend = 'postgres'
+
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        # Opened on first use, so creating a DBHelper never blocks on the
+        # network
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        # ThreadedConnectionPool raises instead of blocking when it is
+        # exhausted, so callers queue up on this semaphore first
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.last_used = {}
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.in_use = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.reconnects = 0
+        self.timeouts = 0
+
+    def _open_pool(self):
+        # psycopg2 is only imported by this backend, so the sqlite one runs
+        # without it
+        from psycopg2.pool import ThreadedConnectionPool
+        from pgconnection import CountingCursor, PreparingConnection
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadedConnectionPool(
+                    self.minconn, self.maxconn, DATABASE_URL,
+                    sslmode=DB_SSLMODE, cursor_factory=CountingCursor,
+                    connection_factory=PreparingConnection)
+        return self.pool
+
+    def _healthy(self, conn):
+        import psycopg2
+        if conn.closed:
+            return False
+        last_used = self.last_used.get(id(conn))
+        if last_used is None or \
+                time.monotonic() - last_used < DB_HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self.last_used.pop(id(conn), None)
+        self.pool.putconn(conn, close=True)
+
+    def _acquire(self):
+        started = time.monotonic()
+        if not self.slots.acquire(timeout=DB_POOL_TIMEOUT):
+            with self.stats_lock:
+                self.timeouts += 1
+            raise PoolTimeout('No database connection available after {}s.'
+                              .format(DB_POOL_TIMEOUT))
+        waited = time.monotonic() - started
+        try:
+            pool = self._open_pool()
+            conn = pool.getconn()
+            # Heroku Postgres drops idle links, so replace dead ones here
+            if not self._healthy(conn):
+                self._discard(conn)
+                conn = pool.getconn()
+                with self.stats_lock:
+                    self.reconnects += 1
+        except Exception:
+            self.slots.release()
+            raise
+        with self.stats_lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return conn
+
+    def _release(self, conn, broken=False):
+        try:
+            if broken or conn.closed:
+                self._discard(conn)
+            else:
+                self.last_used[id(conn)] = time.monotonic()
+                self.pool.putconn(conn)
+        finally:
+            with self.stats_lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    # Hands out a pooled connection for the duration of one operation.
+    # Naming the cursor makes it server-side, so rows are streamed in
+    # batches of `itersize` instead of being fetched all at once.
+    @contextmanager
+    def transaction(self, name=None, itersize=2000):
+        import psycopg2
+        conn = self._acquire()
+        broken = False
+        try:
+            with conn.cursor(name=name) as cursor:
+                cursor.itersize = itersize
+                yield cursor
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except BaseException:
+            # Also covers consumers abandoning a streaming generator early
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn, broken)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'size': self.maxconn,
+                'in_use': self.in_use,
+                'checkouts': self.checkouts,
+                'wait_avg': self.wait_total / self.checkouts
+                if self.checkouts else 0.0,
+                'wait_max': self.wait_max,
+                'reconnects': self.reconnects,
+                'timeouts': self.timeouts,
+                'statements': statements.total
+            }
 
     def setup(self):
-        self.conn.commit()
+        with self.transaction() as cursor:
+            migrate(cursor)
 
-    def check_menu(self, category):
-        stmt = "SELECT name, price FROM food_details WHERE category IN (%s) ORDER BY ctid ASC;"
-        args = (category,)
-        self.cursor.execute(stmt, args)
-        name_list = [x[0] for x in self.cursor.fetchall()]
-        self.cursor.execute(stmt, args)
-        price_list = [x[1] for x in self.cursor.fetchall()]
-        return [name_list, price_list]
+    def close(self):
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+
+    # Dedicated connection outside the pool that waits for notifications
+    def listen(self, channel):
+        import psycopg2
+        from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+        conn = psycopg2.connect(DATABASE_URL, sslmode=DB_SSLMODE)
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            cursor.execute("LISTEN {};".format(channel))
+        return conn
+
+    # Runs the catalogued statement `name` and records its timing
+    def _run(self, cursor, name, args=()):
+        started = time.perf_counter()
+        try:
+            self._send(cursor, name, args)
+        except Exception:
+            metrics.statement_errors.inc(name)
+            raise
+        finally:
+            metrics.statement_seconds.observe(time.perf_counter() - started,
+                                              name)
+
+    # Prepares the statement the first time this connection runs it.
+    # Prepared statements outlive a rolled back transaction.
+    def _send(self, cursor, name, args):
+        if not DB_PREPARE:
+            cursor.execute(catalog.sql[name], args)
+            return
+        prepared = cursor.connection.prepared
+        if name not in prepared:
+            cursor.execute(catalog.prepare[name])
+            prepared.add(name)
+        cursor.execute(catalog.execute[name], args)
+
+    def check_full_menu(self):
+        with self.transaction() as cursor:
+            self._run(cursor, 'check_full_menu')
+            return cursor.fetchall()
 
     def check_photo(self, category):
-        stmt = "SELECT image FROM food_details WHERE category IN (%s) ORDER BY ctid ASC;"
+        stmt = "SELECT image_sha256 FROM food_details WHERE category IN (%s) ORDER BY id ASC;"
         args = (category,)
-        self.cursor.execute(stmt, args)
-        return [x[0] for x in self.cursor.fetchall()]
-
-    def edit_menu(self, name, image, price, category):
-        stmt = "UPDATE food_details SET name = (%s), image = (%s), price = (%s) WHERE category IN (%s);"
-        args = (name, image, price, category)
-        self.cursor.execute(stmt, args)
-        self.conn.commit()
-
-    def time_list(self):
-        stmt = "SELECT time_options FROM collection_time ORDER BY ctid ASC;"
-        self.cursor.execute(stmt)
-        return [[x[0]] for x in self.cursor.fetchall()]
-
-    def add_time(self, collection_time, user_id):
-        stmt = "UPDATE order_list SET collection_time = (%s) WHERE user_id IN (%s) AND status = 'PENDING';"
-        args = (collection_time, user_id)
-        self.cursor.execute(stmt, args)
-        self.conn.commit()
-
-    def add_order(self, user_id, username, name, item_ordered):
-        stmt = "INSERT INTO order_list (user_id, username, name, item_ordered, status) VALUES (%s, %s, %s, %s, 'PENDING');"
-        args = (user_id, username, name, item_ordered)
-        self.cursor.execute(stmt, args)
-        self.conn.commit()
-
-    def select_latest_item(self, user_id):
-        stmt = "SELECT item_ordered FROM order_list WHERE user_id IN (%s) ORDER BY ctid DESC LIMIT 1;"
-        args = (user_id,)
-        self.cursor.execute(stmt, args)
-        return [x[0] for x in self.cursor.fetchall()]
+        with self.transaction() as cursor:
+            cursor.execute(stmt, args)
+            return [x[0] for x in cursor.fetchall()]
 
-    def select_latest_quantity(self, user_id):
-        stmt = "SELECT quantity FROM order_list WHERE user_id IN (%s) ORDER BY ctid DESC LIMIT 1;"
-        args = (user_id,)
-        self.cursor.execute(stmt, args)
-        return [x[0] for x in self.cursor.fetchall()]
-
-    def add_quantity(self, quantity, user_id, item_ordered):
-        stmt = "UPDATE order_list SET quantity = (%s) WHERE user_id IN (%s) AND status = 'PENDING' AND item_ordered = (%s) AND ctid = (SELECT MAX(ctid) FROM order_list);"
-        args = (quantity, user_id, item_ordered)
-        self.cursor.execute(stmt, args)
-        self.conn.commit()
-
-    def add_location(self, location, user_id):
-        stmt = "UPDATE order_list SET location = (%s) WHERE user_id IN (%s) AND status = 'PENDING';"
-        args = (location, user_id)
-        self.cursor.execute(stmt, args)
-        self.conn.commit()
-
-    def add_remarks(self, remarks, user_id, item_ordered):
-        stmt = "UPDATE order_list SET remarks = (%s) WHERE user_id IN (%s) AND status = 'PENDING' AND item_ordered = (%s) AND ctid = (SELECT MAX(ctid) FROM order_list);"
-        args = (remarks, user_id, item_ordered)
-        self.cursor.execute(stmt, args)
-        self.conn.commit()
-
-    def delete_order(self, user_id):
-        stmt = "DELETE FROM order_list WHERE user_id IN (%s) AND status = 'PENDING';"
-        args = (user_id,)
-        self.cursor.execute(stmt, args)
-        self.conn.commit()
-
-    def add_full_name(self, full_name, user_id):
-        stmt = "UPDATE order_list SET name = (%s) WHERE user_id IN (%s) AND status = 'PENDING';"
-        args = (full_name, user_id)
-        self.cursor.execute(stmt, args)
-        self.conn.commit()
-
-    def add_contact_number(self, contact_number, user_id):
-        stmt = "UPDATE order_list SET contact_number = (%s) WHERE user_id IN (%s) AND status = 'PENDING';"
-        args = (contact_number, user_id)
-        self.cursor.execute(stmt, args)
-        self.conn.commit()
-
-    def add_receipt_image(self, receipt_image, user_id):
-        stmt = "UPDATE order_list SET receipt_image = (%s) WHERE user_id IN (%s) AND status = 'PENDING';"
-        args = (receipt_image, user_id)
-        self.cursor.execute(stmt, args)
-        self.conn.commit()
-
-    def check_order(self, user_id):
-        stmt = "SELECT item_ordered, quantity FROM order_list WHERE user_id IN (%s) AND status = 'PENDING' ORDER BY ctid ASC;"
+    def check_photo_file_id(self, category):
+        args = (category,)
+        with self.transaction() as cursor:
+            self._run(cursor, 'check_photo_file_id', args)
+            return cursor.fetchone()
+
+    def add_photo_file_id(self, file_id, category, version):
+        stmt = "UPDATE food_details SET image_file_id = (%s) WHERE category IN (%s) AND version = (%s);"
+        args = (file_id, category, version)
+        with self.transaction() as cursor:
+            cursor.execute(stmt, args)
+
+    def edit_menu(self, name, image_sha256, image_size, price, category):
+        stmt = "UPDATE food_details SET name = (%s), image = NULL, image_sha256 = (%s), image_size = (%s), price = (%s), version = version + 1, image_file_id = NULL WHERE category IN (%s);"
+        args = (name, image_sha256, image_size, price, category)
+        # Delivered to every listening process once the edit commits
+        notify_stmt = "SELECT pg_notify(%s, %s);"
+        notify_args = (MENU_CHANNEL, category)
+        with self.transaction() as cursor:
+            cursor.execute(stmt, args)
+            cursor.execute(notify_stmt, notify_args)
+
+    def check_slots(self):
+        with self.transaction() as cursor:
+            self._run(cursor, 'check_slots')
+            return cursor.fetchall()
+
+    # Paid orders and live reservations per collection time, counting each
+    # user once. Reservations older than `max_age` seconds are ignored.
+    def slot_usage(self, max_age):
+        args = (business_day(), max_age)
+        with self.transaction() as cursor:
+            self._run(cursor, 'slot_usage', args)
+            return dict(cursor.fetchall())
+
+    # Returns whether the user now holds a place in the slot
+    def reserve_slot(self, user_id, collection_time, capacity, max_age):
+        lock_args = (collection_time,)
+        count_args = (business_day(), collection_time, collection_time,
+                      max_age, user_id)
+        args = (user_id, collection_time)
+        with self.transaction() as cursor:
+            # Locking the slot serializes reservations for it across
+            # processes
+            self._run(cursor, 'lock_slot', lock_args)
+            self._run(cursor, 'count_slot', count_args)
+            if cursor.fetchone()[0] >= capacity:
+                return False
+            self._run(cursor, 'reserve_slot', args)
+            return True
+
+    def release_slot(self, user_id):
         args = (user_id,)
-        self.cursor.execute(stmt, args)
-        item_list = [x[0] for x in self.cursor.fetchall()]
-        self.cursor.execute(stmt, args)
-        quantity_list = [y[1] for y in self.cursor.fetchall()]
-        price_list = []
-        for i in item_list:
-            next_stmt = "SELECT price FROM food_details WHERE name IN (%s);"
-            next_args = (i,)
-            self.cursor.execute(next_stmt, next_args)
-            price_list.append(list(z[0] for z in
-                                   self.cursor.fetchall()))
-        flattened_list = [val for sublist in price_list for val in sublist]
-        per_element_list = [a * b for a, b in zip(quantity_list,
-                                                  flattened_list)]
-        return [item_list, quantity_list, per_element_list]
+        with self.transaction() as cursor:
+            self._run(cursor, 'release_slot', args)
 
     def check_offer(self):
         stmt = "SELECT offer FROM offer_table;"
-        self.cursor.execute(stmt)
-        return [x[0] for x in self.cursor.fetchall()]
+        with self.transaction() as cursor:
+            cursor.execute(stmt)
+            return [x[0] for x in cursor.fetchall()]
 
-    def paid_payment_status(self, user_id):
-        stmt = "UPDATE order_list SET status = 'PAID' WHERE user_id IN (%s);"
-        args = (user_id,)
-        self.cursor.execute(stmt, args)
-        self.conn.commit()
+    # Writes every line of a paid draft order in a single transaction
+    def place_order(self, draft, prices, receipt_sha256, receipt_size,
+                    receipt_thumb_sha256=None):
+        from psycopg2.extras import execute_values
+        stmt = "INSERT INTO order_list (business_day, user_id, username, name, contact_number, item_ordered, quantity, location, remarks, collection_time, status, receipt_sha256, receipt_size, receipt_thumb_sha256) VALUES %s;"
+        rows = _order_rows(draft, prices, receipt_sha256, receipt_size,
+                           receipt_thumb_sha256)
+        # The paid order takes over the place its reservation was holding
+        release_args = (draft.user_id,)
+        with self.transaction() as cursor:
+            execute_values(cursor, stmt, rows)
+            self._run(cursor, 'release_slot', release_args)
 
     def delete_paid_user(self, user_id):
-        stmt = "DELETE FROM order_list WHERE user_id IN (%s) AND status = 'PAID';"
-        args = (user_id,)
-        self.cursor.execute(stmt, args)
-        self.conn.commit()
-
-    def retrieve_current_orders(self):
-        stmt = "SELECT * FROM order_list WHERE status = 'PAID' ORDER BY collection_time ASC;"
-        self.cursor.execute(stmt)
-        return [x for x in self.cursor.fetchall()]
-
-    def purge_order_list(self):
-        stmt = "DELETE FROM order_list;"
-        self.cursor.execute(stmt)
-        self.conn.commit()
+        stmt = "DELETE FROM order_list WHERE business_day = (%s) AND user_id IN (%s) AND status = 'PAID';"
+        args = (business_day(), user_id)
+        with self.transaction() as cursor:
+            cursor.execute(stmt, args)
+
+    # Streams today's paid orders in (collection_time, id) order, starting
+    # after the `after` key of the previous page
+    def paid_orders(self, limit, after=None, collection_time=None,
+                    location=None):
+        conditions = ["business_day = (%s)", "status = 'PAID'"]
+        args = [business_day()]
+        if after is not None:
+            conditions.append("(collection_time, id) > (%s, %s)")
+            args.extend(after)
+        if collection_time is not None:
+            conditions.append("collection_time = (%s)")
+            args.append(collection_time)
+        if location is not None:
+            conditions.append("location = (%s)")
+            args.append(location)
+        args.append(limit)
+        stmt = "SELECT id, collection_time, user_id, contact_number, item_ordered, quantity, location, remarks, receipt_sha256, receipt_thumb_sha256 FROM order_list WHERE {} ORDER BY collection_time ASC, id ASC LIMIT %s;".format(' AND '.join(conditions))
+        with self.transaction(name='paid_orders', itersize=limit) as cursor:
+            cursor.execute(stmt, args)
+            for row in cursor:
+                yield row
+
+    # Today's paid quantity of each item per collection time and location,
+    # with the distinct remarks and their quantities. Rows with a location
+    # of None hold the totals of a collection time across all locations.
+    def prep_totals(self, collection_time=None):
+        conditions = ["business_day = (%s)", "status = 'PAID'"]
+        args = [business_day()]
+        if collection_time is not None:
+            conditions.append("collection_time = (%s)")
+            args.append(collection_time)
+        stmt = "SELECT collection_time, CASE WHEN GROUPING(location) = 0 THEN coalesce(location, '') END AS location_total, item_ordered, sum(quantity), CASE WHEN GROUPING(location) = 0 THEN string_agg(quantity || 'x ' || remarks, '; ' ORDER BY remarks) FILTER (WHERE remarks <> 'N/A') END FROM (SELECT collection_time, location, item_ordered, remarks, sum(quantity) AS quantity FROM order_list WHERE {} GROUP BY collection_time, location, item_ordered, remarks) AS lines GROUP BY GROUPING SETS ((collection_time, location, item_ordered), (collection_time, item_ordered)) ORDER BY collection_time ASC, location_total ASC NULLS FIRST, item_ordered ASC;".format(' AND '.join(conditions))
+        with self.transaction() as cursor:
+            cursor.execute(stmt, args)
+            return cursor.fetchall()
+
+    # Streams the orders placed between `start` and `end`, both inclusive,
+    # including archived ones. Receipt images stay in the blob store.
+    def export_orders(self, start, end, itersize=2000):
+        columns = "business_day, id, created_at, collection_time, location, user_id, username, name, contact_number, item_ordered, quantity, remarks, status, receipt_sha256"
+        stmt = "SELECT {0} FROM order_list WHERE business_day BETWEEN (%s) AND (%s) UNION ALL SELECT {0} FROM order_history WHERE business_day BETWEEN (%s) AND (%s) ORDER BY business_day ASC, id ASC;".format(columns)
+        args = (start, end, start, end)
+        with self.transaction(name='export_orders',
+                              itersize=itersize) as cursor:
+            cursor.execute(stmt, args)
+            for row in cursor:
+                yield row
+
+    def check_receipt(self, order_id):
+        args = (order_id,)
+        with self.transaction() as cursor:
+            self._run(cursor, 'check_receipt', args)
+            row = cursor.fetchone()
+            return row[0] if row is not None else None
+
+    # Partitions of `table` as (name, partition bound expression)
+    def _partitions(self, cursor, table):
+        stmt = "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = (%s)::regclass ORDER BY c.relname;"
+        args = (table,)
+        cursor.execute(stmt, args)
+        return cursor.fetchall()
+
+    def _create_order_partition(self, cursor, name, day):
+        bounds = (day, day + timedelta(days=1))
+        stray_stmt = "SELECT EXISTS (SELECT 1 FROM order_list_default WHERE business_day >= (%s) AND business_day < (%s));"
+        cursor.execute(stray_stmt, bounds)
+        stray = cursor.fetchone()[0]
+        # Orders that fell into the default partition have to move into the
+        # new one, which cannot be created while they are there
+        if stray:
+            cursor.execute("ALTER TABLE order_list DETACH PARTITION order_list_default;")
+        stmt = "CREATE TABLE {} PARTITION OF order_list FOR VALUES FROM (%s) TO (%s);".format(name)
+        cursor.execute(stmt, bounds)
+        if stray:
+            cursor.execute("INSERT INTO order_list SELECT * FROM order_list_default WHERE business_day >= (%s) AND business_day < (%s);", bounds)
+            cursor.execute("DELETE FROM order_list_default WHERE business_day >= (%s) AND business_day < (%s);", bounds)
+            cursor.execute("ALTER TABLE order_list ATTACH PARTITION order_list_default DEFAULT;")
+
+    # Creates the daily partitions of order_list up to `days_ahead` days
+    # from today and moves partitions older than `retention_days` into
+    # order_history, which drops those older than `history_days` unless it
+    # is 0. Partitions move by detaching and attaching them, so no rows are
+    # copied or deleted.
+    def rotate_orders(self, days_ahead, retention_days, history_days):
+        today = business_day()
+        created, archived, dropped = [], [], []
+        with self.transaction() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s);",
+                           (ROTATION_LOCK_ID,))
+            # Days up to here already have a partition, such as the one the
+            # rows from before partitioning were attached as
+            uppers = [_upper_bound(bound) for _, bound in
+                      self._partitions(cursor, 'order_list')]
+            covered_until = max([upper for upper in uppers
+                                 if upper is not None], default=today)
+            for offset in range(days_ahead + 1):
+                day = today + timedelta(days=offset)
+                if day < covered_until:
+                    continue
+                name = 'order_list_p{:%Y%m%d}'.format(day)
+                self._create_order_partition(cursor, name, day)
+                created.append(name)
+            # First day that stays in order_list, which always keeps today
+            keep_from = today - timedelta(days=max(retention_days, 1) - 1)
+            for name, bound in self._partitions(cursor, 'order_list'):
+                upper = _upper_bound(bound)
+                if upper is not None and upper <= keep_from:
+                    cursor.execute("ALTER TABLE order_list DETACH PARTITION {};".format(name))
+                    cursor.execute("ALTER TABLE order_history ATTACH PARTITION {} {};".format(name, bound))
+                    archived.append(name)
+            if history_days:
+                drop_before = today - timedelta(days=history_days)
+                for name, bound in self._partitions(cursor, 'order_history'):
+                    upper = _upper_bound(bound)
+                    if upper is not None and upper <= drop_before:
+                        cursor.execute("DROP TABLE {};".format(name))
+                        dropped.append(name)
+        return created, archived, dropped
+
+    def add_blob(self, sha256, data):
+        stmt = "INSERT INTO blob_store (sha256, data) VALUES (%s, %s) ON CONFLICT (sha256) DO NOTHING;"
+        args = (sha256, data)
+        with self.transaction() as cursor:
+            cursor.execute(stmt, args)
+
+    def check_blob(self, sha256):
+        args = (sha256,)
+        with self.transaction() as cursor:
+            self._run(cursor, 'check_blob', args)
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def inline_menu_images(self):
+        stmt = "SELECT category, image FROM food_details WHERE image IS NOT NULL;"
+        with self.transaction() as cursor:
+            cursor.execute(stmt)
+            return cursor.fetchall()
+
+    def externalize_menu_image(self, image_sha256, image_size, category):
+        stmt = "UPDATE food_details SET image = NULL, image_sha256 = (%s), image_size = (%s) WHERE category IN (%s);"
+        args = (image_sha256, image_size, category)
+        with self.transaction() as cursor:
+            cursor.execute(stmt, args)
+
+    def inline_receipt_images(self, limit=20):
+        stmt = "SELECT id, receipt_image FROM order_list WHERE receipt_image IS NOT NULL LIMIT %s;"
+        args = (limit,)
+        with self.transaction() as cursor:
+            cursor.execute(stmt, args)
+            return cursor.fetchall()
+
+    def externalize_receipt_image(self, receipt_sha256, receipt_size, order_id):
+        stmt = "UPDATE order_list SET receipt_image = NULL, receipt_sha256 = (%s), receipt_size = (%s) WHERE id = (%s);"
+        args = (receipt_sha256, receipt_size, order_id)
+        with self.transaction() as cursor:
+            cursor.execute(stmt, args)
+
+    def check_state(self, namespace, key):
+        args = (namespace, key)
+        with self.transaction() as cursor:
+            self._run(cursor, 'check_state', args)
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    # `changes` is a list of (namespace, key, value), where None deletes.
+    # Unless `source` is None, the changed keys are announced on
+    # STATE_CHANNEL on behalf of `source`.
+    def write_states(self, changes, source=None):
+        from psycopg2.extras import execute_values, Json
+        upsert_stmt = "INSERT INTO bot_state (namespace, key, value) VALUES %s ON CONFLICT (namespace, key) DO UPDATE SET value = EXCLUDED.value, updated_at = now();"
+        delete_stmt = "DELETE FROM bot_state b USING (VALUES %s) AS d (namespace, key) WHERE b.namespace = d.namespace AND b.key = d.key;"
+        upserts = [(namespace, key, Json(value))
+                   for namespace, key, value in changes if value is not None]
+        deletes = [(namespace, key)
+                   for namespace, key, value in changes if value is None]
+        keys = [[namespace, key] for namespace, key, _ in changes]
+        notify_stmt = "SELECT pg_notify(%s, %s);"
+        with self.transaction() as cursor:
+            if upserts:
+                execute_values(cursor, upsert_stmt, upserts)
+            if deletes:
+                execute_values(cursor, delete_stmt, deletes)
+            if source is not None:
+                for i in range(0, len(keys), STATE_NOTIFY_KEYS):
+                    notify_args = (STATE_CHANNEL, json.dumps(
+                        [source, keys[i:i + STATE_NOTIFY_KEYS]]))
+                    cursor.execute(notify_stmt, notify_args)
+
+    # Returns False if another process has already claimed `update_id`
+    def claim_update(self, update_id):
+        args = (update_id,)
+        with self.transaction() as cursor:
+            self._run(cursor, 'claim_update', args)
+            return cursor.rowcount == 1
+
+    def expire_updates(self, max_age):
+        stmt = "DELETE FROM processed_updates WHERE seen_at < now() - make_interval(secs => %s);"
+        args = (max_age,)
+        with self.transaction() as cursor:
+            cursor.execute(stmt, args)
+
+    def expire_states(self, namespace, max_age):
+        stmt = "DELETE FROM bot_state WHERE namespace = (%s) AND updated_at < now() - make_interval(secs => %s) RETURNING key, value;"
+        args = (namespace, max_age)
+        with self.transaction() as cursor:
+            cursor.execute(stmt, args)
+            return cursor.fetchall()
+
+
+def open_db():
+    if DB_BACKEND == 'postgres':
+        return DBHelper()
+    if DB_BACKEND == 'sqlite':
+        # Imported here since it builds on this module
+        from sqlitehelper import SQLiteHelper
+        return SQLiteHelper()
+    raise ValueError('Unknown DB_BACKEND {!r}.'.format(DB_BACKEND))
@@ -0,0 +1,59 @@
+# This class remembers recently processed update IDs, so updates that
+# Telegram delivers more than once are only handled once
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Either `memory`, or `postgres` to also share the IDs between processes
+DEDUP_STORE = os.environ.get('DEDUP_STORE', 'memory')
+# Seconds an update ID is remembered, and how many are kept in memory
+DEDUP_WINDOW = float(os.environ.get('DEDUP_WINDOW', '3600'))
+DEDUP_CACHE_SIZE = int(os.environ.get('DEDUP_CACHE_SIZE', '10000'))
+
+
+class UpdateDedup:
+    def __init__(self, db=None, window=DEDUP_WINDOW, size=DEDUP_CACHE_SIZE):
+        # Only consulted for IDs this process has not seen
+        self.db = db
+        self.window = window
+        self.size = size
+        self.lock = threading.Lock()
+        # update_id -> time first seen, oldest first
+        self.seen = OrderedDict()
+
+    def _trim(self, now):
+        while self.seen:
+            update_id, seen_at = next(iter(self.seen.items()))
+            if len(self.seen) <= self.size and now - seen_at < self.window:
+                break
+            del self.seen[update_id]
+
+    # Returns True the first time it is called with `update_id`
+    def claim(self, update_id):
+        now = time.monotonic()
+        with self.lock:
+            self._trim(now)
+            if update_id in self.seen:
+                return False
+            self.seen[update_id] = now
+        # If the database fails, the dispatcher logs it and handles the
+        # update anyway
+        if self.db is not None:
+            return self.db.claim_update(update_id)
+        return True
+
+    def expire(self):
+        with self.lock:
+            self._trim(time.monotonic())
+        if self.db is not None:
+            self.db.expire_updates(self.window)
+
+
+def open_dedup(db):
+    if DEDUP_STORE == 'postgres':
+        return UpdateDedup(db)
+    if DEDUP_STORE == 'memory':
+        return UpdateDedup()
+    raise ValueError('Unknown DEDUP_STORE {!r}.'.format(DEDUP_STORE))
@@ -0,0 +1,123 @@
+# This class downloads Telegram files on a worker pool, so handlers can hand
+# a photo off and move on
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from telegram.error import NetworkError, BadRequest
+
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '4'))
+# Seconds to wait for a connection or for the next chunk of a file
+DOWNLOAD_TIMEOUT = float(os.environ.get('DOWNLOAD_TIMEOUT', '20'))
+# Files larger than this many bytes are refused
+DOWNLOAD_MAX_BYTES = int(os.environ.get('DOWNLOAD_MAX_BYTES',
+                                        str(10 * 1024 * 1024)))
+DOWNLOAD_MAX_RETRIES = int(os.environ.get('DOWNLOAD_MAX_RETRIES', '3'))
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+class Downloader:
+    def __init__(self, workers=DOWNLOAD_WORKERS, timeout=DOWNLOAD_TIMEOUT,
+                 max_bytes=DOWNLOAD_MAX_BYTES, retries=DOWNLOAD_MAX_RETRIES):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.retries = retries
+        # One keep-alive connection per worker, reused across downloads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='download')
+        self.lock = threading.Lock()
+        self.size = 0
+
+    def pending(self):
+        return self.size
+
+    # Streams `url` into memory, refusing anything over `max_bytes`
+    def fetch(self, url):
+        with self.session.get(url, stream=True,
+                              timeout=self.timeout) as response:
+            response.raise_for_status()
+            length = response.headers.get('Content-Length')
+            if length is not None and int(length) > self.max_bytes:
+                raise DownloadTooLarge('File is {} bytes.'.format(length))
+            data = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                data += chunk
+                if len(data) > self.max_bytes:
+                    raise DownloadTooLarge('File is over {} bytes.'
+                                           .format(self.max_bytes))
+            return bytes(data)
+
+    # File URLs contain the bot token, which must not end up in the logs
+    @staticmethod
+    def _describe(bot, error):
+        return str(error).replace(bot.token, '<token>')
+
+    @staticmethod
+    def _retriable(error):
+        if isinstance(error, BadRequest):
+            return False
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and \
+                error.response.status_code >= 500
+        return True
+
+    def _fetch_with_retries(self, bot, file_id):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                url = bot.get_file(file_id)['file_path']
+                return self.fetch(url)
+            except (requests.RequestException, NetworkError) as e:
+                if attempt >= self.retries or not self._retriable(e):
+                    raise
+                logger.warning('Download of %s failed, retrying: %s',
+                               file_id, self._describe(bot, e))
+                time.sleep(2 ** attempt)
+
+    def _run(self, bot, file_id, on_done, on_error):
+        try:
+            data = self._fetch_with_retries(bot, file_id)
+            on_done(data)
+        except Exception as e:
+            # Saving the file counts as part of the download, so callers
+            # have a single place to recover from
+            logger.warning('Dropping download of %s: %s', file_id,
+                           self._describe(bot, e))
+            if on_error is not None:
+                on_error(e)
+
+    def _finished(self, future):
+        with self.lock:
+            self.size -= 1
+        error = future.exception()
+        if error is not None:
+            logger.error('Download callback failed.', exc_info=error)
+
+    # Downloads a Telegram file in the background and calls `on_done` with
+    # its content, or `on_error` with the exception if fetching the file or
+    # `on_done` fails
+    def download(self, bot, file_id, on_done, on_error=None):
+        with self.lock:
+            self.size += 1
+        future = self.executor.submit(self._run, bot, file_id, on_done,
+                                      on_error)
+        future.add_done_callback(self._finished)
+
+    # Waits for queued downloads and their callbacks to finish
+    def stop(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
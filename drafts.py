@@ -0,0 +1,136 @@
+# These classes hold a user's order in memory until it is paid for, so the
+# conversation steps do not touch the database
+
+import os
+import secrets
+import time
+from collections import namedtuple
+
+# Seconds of inactivity after which a draft counts as abandoned
+DRAFT_TTL = float(os.environ.get('DRAFT_TTL', '14400'))
+
+# Order lines of a user, priced against the current menu
+Cart = namedtuple('Cart', ['items', 'quantities', 'unit_prices',
+                           'line_totals', 'total'])
+
+
+class DraftLine:
+    def __init__(self, item, quantity=None, remarks=None):
+        self.item = item
+        self.quantity = quantity
+        self.remarks = remarks
+
+
+class DraftOrder:
+    FIELDS = ['user_id', 'username', 'name', 'full_name', 'contact_number',
+              'collection_time', 'location', 'updated_at', 'order_code']
+
+    def __init__(self, user_id, username=None, name=None):
+        self.user_id = user_id
+        self.username = username
+        self.name = name
+        self.full_name = None
+        self.contact_number = None
+        self.collection_time = None
+        self.location = None
+        self.lines = []
+        self.updated_at = time.time()
+        # Tells this order's payment apart from the customer's others
+        self.order_code = secrets.token_hex(3).upper()
+
+    def touch(self):
+        self.updated_at = time.time()
+
+    def add_line(self, item):
+        line = DraftLine(item)
+        self.lines.append(line)
+        self.touch()
+        return line
+
+    def latest_line(self):
+        return self.lines[-1] if self.lines else None
+
+    # Lines that are paid for, which excludes items no longer on the menu
+    # and lines still waiting for a quantity
+    def payable_lines(self, prices):
+        return [line for line in self.lines
+                if line.item in prices and line.quantity is not None]
+
+    # `prices` maps item names to unit prices; items no longer on the menu
+    # are left out
+    def cart(self, prices):
+        lines = [(line, prices[line.item]) for line in self.lines
+                 if line.item in prices]
+        line_totals = [line.quantity * price
+                       if line.quantity is not None else None
+                       for line, price in lines]
+        return Cart(items=[line.item for line, _ in lines],
+                    quantities=[line.quantity for line, _ in lines],
+                    unit_prices=[price for _, price in lines],
+                    line_totals=line_totals,
+                    total=sum(x for x in line_totals if x is not None))
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        data['lines'] = [vars(line) for line in self.lines]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        draft = cls(data['user_id'])
+        for field in cls.FIELDS:
+            # Drafts saved before a field existed keep its new default
+            setattr(draft, field, data.get(field, getattr(draft, field)))
+        draft.lines = [DraftLine(**line) for line in data.get('lines', [])]
+        return draft
+
+
+class DraftStore:
+    def __init__(self, drafts=None, ttl=DRAFT_TTL):
+        self.ttl = ttl
+        # user_id -> serialized draft, usually a PersistentDict so drafts
+        # survive restarts and are visible to every bot process
+        self.drafts = {} if drafts is None else drafts
+        # Called with each draft that expires unpaid
+        self.expiry_callbacks = []
+
+    def get(self, user_id):
+        data = self.drafts.get(user_id)
+        if data is None:
+            return None
+        draft = DraftOrder.from_dict(data)
+        if time.time() - draft.updated_at > self.ttl:
+            return None
+        return draft
+
+    # New drafts are only stored once they are passed to update()
+    def get_or_create(self, user_id, username=None, name=None):
+        draft = self.get(user_id)
+        if draft is None:
+            draft = DraftOrder(user_id, username, name)
+        return draft
+
+    def update(self, draft):
+        draft.touch()
+        self.drafts[draft.user_id] = draft.to_dict()
+
+    def discard(self, user_id):
+        return self.drafts.pop(user_id, None)
+
+    def on_expire(self, callback):
+        self.expiry_callbacks.append(callback)
+
+    def expire(self):
+        if hasattr(self.drafts, 'expire'):
+            expired = self.drafts.expire(self.ttl)
+        else:
+            now = time.time()
+            expired = [data for data in self.drafts.values()
+                       if now - data['updated_at'] > self.ttl]
+            for data in expired:
+                del self.drafts[data['user_id']]
+        expired = [DraftOrder.from_dict(data) for data in expired]
+        for draft in expired:
+            for callback in self.expiry_callbacks:
+                callback(draft)
+        return expired
@@ -0,0 +1,88 @@
+# These functions write streamed order rows to a CSV or XLSX file without
+# holding the rows in memory
+
+import codecs
+import csv
+import io
+import os
+from tempfile import SpooledTemporaryFile
+
+# Bytes of an export kept in memory before it is spilled to a temporary file
+EXPORT_SPOOL_BYTES = int(os.environ.get('EXPORT_SPOOL_BYTES',
+                                        str(1024 * 1024)))
+
+# Matches the columns selected by DBHelper.export_orders()
+COLUMNS = ['business_day', 'id', 'created_at', 'collection_time', 'location',
+           'user_id', 'username', 'name', 'contact_number', 'item_ordered',
+           'quantity', 'remarks', 'status', 'receipt_sha256']
+FORMATS = ('csv', 'xlsx')
+# Spreadsheets run cells starting with these as formulas
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+# Customers type their names, locations and remarks, which must open as
+# text rather than as formulas
+def _escape(value):
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+# Encodes the CSV a row at a time, since SpooledTemporaryFile can only be
+# wrapped in a TextIOWrapper from Python 3.11 on
+def _write_csv(rows, output):
+    line = io.StringIO()
+    writer = csv.writer(line)
+
+    def write(row):
+        writer.writerow(row)
+        output.write(line.getvalue().encode('utf-8'))
+        line.seek(0)
+        line.truncate()
+
+    # Lets Excel detect the encoding
+    output.write(codecs.BOM_UTF8)
+    write(COLUMNS)
+    count = 0
+    for row in rows:
+        write([_escape(value) for value in row])
+        count += 1
+    return count
+
+
+def _cell(value):
+    # Excel has no time zones, so store the local time
+    if hasattr(value, 'tzinfo') and value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return _escape(value)
+
+
+def _write_xlsx(rows, output):
+    # Only loaded when someone asks for a spreadsheet
+    from openpyxl import Workbook
+    # Write-only workbooks stream each row to disk as it is appended
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Orders')
+    sheet.append(COLUMNS)
+    count = 0
+    for row in rows:
+        sheet.append([_cell(value) for value in row])
+        count += 1
+    workbook.save(output)
+    return count
+
+
+# Writes `rows` in `fmt` to a temporary file. Returns the file, rewound,
+# and the number of rows written.
+def export(rows, fmt):
+    output = SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    try:
+        if fmt == 'xlsx':
+            count = _write_xlsx(rows, output)
+        else:
+            count = _write_csv(rows, output)
+    except BaseException:
+        output.close()
+        raise
+    output.seek(0)
+    return output, count
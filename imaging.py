@@ -0,0 +1,50 @@
+# These functions shrink incoming photos and strip their metadata before
+# they are stored
+
+import os
+from collections import namedtuple
+from io import BytesIO
+from PIL import Image, ImageOps
+
+# Longest side, in pixels, of stored photos and of their thumbnails
+IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', '1600'))
+THUMBNAIL_DIMENSION = int(os.environ.get('THUMBNAIL_DIMENSION', '320'))
+# JPEG quality, from 1 to 95
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', '80'))
+
+NormalizedImage = namedtuple('NormalizedImage', ['image', 'thumbnail'])
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def _encode(image, max_dimension, quality):
+    image = image.copy()
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    output = BytesIO()
+    # A fresh save carries no EXIF or other metadata over
+    image.save(output, format='JPEG', quality=quality, optimize=True,
+               progressive=True)
+    return output.getvalue()
+
+
+# Returns a downsampled JPEG of `data` and a thumbnail of it
+def normalize(data, max_dimension=IMAGE_MAX_DIMENSION,
+              thumbnail_dimension=THUMBNAIL_DIMENSION, quality=IMAGE_QUALITY):
+    try:
+        image = Image.open(BytesIO(data))
+        # Phones record rotation in EXIF, which is about to be dropped
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+    except (OSError, Image.DecompressionBombError) as e:
+        raise InvalidImage(str(e))
+    return NormalizedImage(image=_encode(image, max_dimension, quality),
+                           thumbnail=_encode(image, thumbnail_dimension,
+                                             quality))
@@ -0,0 +1,138 @@
+# These classes process incoming updates on a pool of workers, one update
+# per chat at a time, so slow handlers do not hold up other users
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from telegram.ext import ConversationHandler
+
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '8'))
+# Updates waiting to be processed beyond which the webhook asks Telegram to
+# deliver new ones later
+UPDATE_QUEUE_MAX = int(os.environ.get('UPDATE_QUEUE_MAX', '1000'))
+
+logger = logging.getLogger(__name__)
+
+
+# Updates from the same chat are processed in arrival order. Updates without
+# a chat, such as polling errors, each get a lane of their own.
+def chat_key(update):
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return user.id
+    return object()
+
+
+class ChatWorkerPool:
+    def __init__(self, workers=UPDATE_WORKERS, max_pending=UPDATE_QUEUE_MAX):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.process = None
+        self.cond = threading.Condition()
+        # chat key -> deque of pending updates, in arrival order
+        self.chats = {}
+        # Idle chats with pending updates, oldest first
+        self.ready = deque()
+        # Chats with an update being processed
+        self.busy = set()
+        self.size = 0
+        self.threads = []
+        self.running = False
+
+    # Takes over the updates the dispatcher thread would otherwise process
+    # itself. Call it after the dispatcher has been instrumented.
+    def install(self, dispatcher):
+        self.process = dispatcher.process_update
+        dispatcher.process_update = self.put
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='update-{}'.format(i),
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Waits up to `timeout` seconds for queued updates to be processed
+    def stop(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.size and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            self.running = False
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def pending(self):
+        return self.size
+
+    def full(self):
+        return self.size >= self.max_pending
+
+    def put(self, update):
+        key = chat_key(update)
+        with self.cond:
+            queue = self.chats.get(key)
+            if queue is None:
+                queue = self.chats[key] = deque()
+            queue.append(update)
+            self.size += 1
+            if len(queue) == 1 and key not in self.busy:
+                self.ready.append(key)
+                self.cond.notify()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while self.running and not self.ready:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                key = self.ready.popleft()
+                update = self.chats[key].popleft()
+                self.busy.add(key)
+            try:
+                self.process(update)
+            except Exception:
+                # The dispatcher already reports handler errors
+                logger.exception('Processing an update failed.')
+            with self.cond:
+                self.busy.discard(key)
+                self.size -= 1
+                if self.chats[key]:
+                    self.ready.append(key)
+                else:
+                    del self.chats[key]
+                self.cond.notify_all()
+
+
+# ConversationHandler passes the conversation and handler it picks in
+# check_update() to handle_update() through attributes, which workers
+# processing different chats would overwrite for each other
+class ConcurrentConversationHandler(ConversationHandler):
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        super(ConcurrentConversationHandler, self).__init__(*args, **kwargs)
+
+    @property
+    def current_conversation(self):
+        return getattr(self._local, 'conversation', None)
+
+    @current_conversation.setter
+    def current_conversation(self, value):
+        self._local.conversation = value
+
+    @property
+    def current_handler(self):
+        return getattr(self._local, 'handler', None)
+
+    @current_handler.setter
+    def current_handler(self, value):
+        self._local.handler = value
@@ -0,0 +1,170 @@
+# This class caches the weekly menu and everything rendered from it
+
+import json
+import logging
+import os
+import select
+import tempfile
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from decimal import Decimal
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from dbhelper import MENU_CHANNEL
+
+CATEGORIES = ['MONDAY', 'TUESDAY', 'WEDNESDAY', 'THURSDAY', 'FRIDAY']
+# Last menu seen, so a restarted bot can answer before the database does
+MENU_SNAPSHOT_PATH = os.environ.get('MENU_SNAPSHOT_PATH',
+                                    './menu_snapshot.json')
+
+logger = logging.getLogger(__name__)
+
+MenuCategory = namedtuple('MenuCategory', ['names', 'prices', 'version',
+                                           'html', 'keyboard'])
+MenuSnapshot = namedtuple('MenuSnapshot', ['version', 'categories',
+                                           'prices'])
+
+
+# Build the inline menu
+def build_menu(buttons, n_cols, header_buttons=None,
+               footer_buttons=None):
+    menu = [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
+    if header_buttons:
+        menu.insert(0, header_buttons)
+    if footer_buttons:
+        menu.append(footer_buttons)
+    return menu
+
+
+def render_category(names, prices, version):
+    html = '\r\n'.join(['<pre>• ' + str(name) + ' - $' + str(price) +
+                        '</pre>' for name, price in zip(names, prices)])
+    button_list = [InlineKeyboardButton(str(name), callback_data=str(name))
+                   for name in names]
+    keyboard = InlineKeyboardMarkup(build_menu(button_list, n_cols=2))
+    return MenuCategory(names=tuple(names), prices=tuple(prices),
+                        version=version, html=html, keyboard=keyboard)
+
+
+class MenuCache:
+    def __init__(self, db, snapshot_path=MENU_SNAPSHOT_PATH):
+        self.db = db
+        self.snapshot_path = snapshot_path
+        self.snapshot = MenuSnapshot(version=None, categories={
+            category: render_category([], [], 0) for category in CATEGORIES},
+            prices={})
+        self.refresh_lock = threading.Lock()
+        self.subscribers = []
+
+    # Reads are plain lookups on whichever snapshot is current
+    def category(self, category):
+        return self.snapshot.categories[category]
+
+    # Unit price of every item on the menu, by name
+    def prices(self):
+        return self.snapshot.prices
+
+    # Called with the name of every category whose version changed
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def refresh(self):
+        with self.refresh_lock:
+            rows = self.db.check_full_menu()
+            previous, changed = self._publish(rows)
+            if changed:
+                self._save_snapshot(rows)
+        self._notify(previous)
+        return self.snapshot
+
+    # Serves the menu saved by the last refresh, if any, until refresh()
+    # catches up with the database
+    def load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path) as f:
+                rows = [(category, name, Decimal(price), version)
+                        for category, name, price, version in json.load(f)]
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring unreadable menu snapshot: %s', e)
+            return False
+        with self.refresh_lock:
+            # A refresh may have won the race already
+            if self.snapshot.version is None:
+                self._publish(rows)
+        return True
+
+    def _save_snapshot(self, rows):
+        if not self.snapshot_path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump([(category, name, str(price), version)
+                           for category, name, price, version in rows], f)
+            os.replace(temp_path, self.snapshot_path)
+        except OSError as e:
+            logger.warning('Could not save menu snapshot: %s', e)
+
+    # Returns the replaced snapshot and whether the menu changed
+    def _publish(self, rows):
+        grouped = OrderedDict((category, ([], [], []))
+                              for category in CATEGORIES)
+        for category, name, price, version in rows:
+            names, prices, versions = grouped.setdefault(category,
+                                                         ([], [], []))
+            names.append(name)
+            prices.append(price)
+            versions.append(version)
+        categories = {category: render_category(names, prices,
+                                                sum(versions))
+                      for category, (names, prices, versions)
+                      in grouped.items()}
+        version = sum(c.version for c in categories.values())
+        previous = self.snapshot
+        if version == previous.version:
+            return previous, False
+        # Swapping the reference publishes the new menu atomically
+        prices = {name: price for c in categories.values()
+                  for name, price in zip(c.names, c.prices)}
+        self.snapshot = MenuSnapshot(version=version, categories=categories,
+                                     prices=prices)
+        logger.info('Menu cache refreshed to version %s', version)
+        return previous, True
+
+    def _notify(self, previous):
+        for category, rendered in self.snapshot.categories.items():
+            old = previous.categories.get(category)
+            if old is None or old.version != rendered.version:
+                for callback in self.subscribers:
+                    callback(category)
+
+    def _listen_forever(self):
+        while True:
+            conn = None
+            try:
+                conn = self.db.listen(MENU_CHANNEL)
+                # Catch up on anything missed while disconnected
+                self.refresh()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        del conn.notifies[:]
+                        self.refresh()
+            except Exception as e:
+                logger.warning('Menu listener disconnected: %s', e)
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    # Refresh whenever any process commits a menu edit
+    def listen(self):
+        thread = threading.Thread(target=self._listen_forever,
+                                  name='menu-listener', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,299 @@
+# These classes collect counters and latency histograms and render them in
+# the Prometheus text exposition format
+
+import inspect
+import threading
+import time
+from functools import wraps
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           float('inf'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value)
+                                           .replace('\\', '\\\\')
+                                           .replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        # Label values -> count
+        self.values = {}
+
+    def inc(self, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + 1
+
+    def get(self, *label_values):
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            yield self.name, list(zip(self.labels, label_values)), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # Label values -> [per-bucket counts, sum]
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * len(self.buckets),
+                                                     0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+
+    # Returns {label values: (count, sum, estimated 95th percentile)}
+    def summary(self):
+        with self.lock:
+            values = {k: (list(v[0]), v[1]) for k, v in self.values.items()}
+        result = {}
+        for label_values, (counts, total) in values.items():
+            count = sum(counts)
+            seen = 0
+            p95 = self.buckets[-1]
+            for bound, n in zip(self.buckets, counts):
+                seen += n
+                if seen >= 0.95 * count:
+                    p95 = bound
+                    break
+            result[label_values] = (count, total, p95)
+        return result
+
+    def samples(self):
+        with self.lock:
+            values = sorted((k, (list(v[0]), v[1]))
+                            for k, v in self.values.items())
+        for label_values, (counts, total) in values:
+            labels = list(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield (self.name + '_bucket',
+                       labels + [('le', _format_value(bound))], cumulative)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+# Value read from `func` whenever the metrics are scraped
+class Gauge:
+    def __init__(self, name, help, func, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.kind = kind
+
+    def samples(self):
+        yield self.name, [], self.func()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=()):
+        return self._add(Histogram(name, help, labels))
+
+    def gauge(self, name, help, func, kind='gauge'):
+        return self._add(Gauge(name, help, func, kind))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                              _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+handler_seconds = registry.histogram(
+    'bot_handler_seconds', 'Time spent in each handler callback.',
+    ['handler'])
+handler_errors = registry.counter(
+    'bot_handler_errors_total', 'Exceptions raised by each handler callback.',
+    ['handler'])
+update_seconds = registry.histogram(
+    'bot_update_seconds', 'Time taken to process one update.')
+update_db_seconds = registry.histogram(
+    'bot_update_db_seconds', 'Database time spent while processing one '
+                             'update.')
+db_seconds = registry.histogram(
+    'bot_db_seconds', 'Time spent in each DBHelper method.', ['method'])
+db_errors = registry.counter(
+    'bot_db_errors_total', 'Exceptions raised by each DBHelper method.',
+    ['method'])
+statement_seconds = registry.histogram(
+    'bot_db_statement_seconds', 'Time spent executing each catalogued '
+                                'statement.', ['statement'])
+statement_errors = registry.counter(
+    'bot_db_statement_errors_total', 'Errors raised by each catalogued '
+                                     'statement.', ['statement'])
+
+# Database time of the update the current thread is processing
+_local = threading.local()
+
+
+def _observe_db(method, elapsed):
+    db_seconds.observe(elapsed, method)
+    _local.db_time = getattr(_local, 'db_time', 0.0) + elapsed
+
+
+def _timed_db_method(name, func):
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            db_errors.inc(name)
+            raise
+        finally:
+            _observe_db(name, time.perf_counter() - started)
+
+    return wrapped
+
+
+# Only time spent fetching rows counts, not the caller's work in between
+def _timed_db_generator(name, func):
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        rows = func(*args, **kwargs)
+        elapsed = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    break
+                except Exception:
+                    db_errors.inc(name)
+                    raise
+                finally:
+                    elapsed += time.perf_counter() - started
+                yield row
+        finally:
+            rows.close()
+            _observe_db(name, elapsed)
+
+    return wrapped
+
+
+# Times every public query method of a DBHelper instance
+def instrument_db(db, skip=('transaction', 'stats', 'close', 'listen')):
+    for name, func in inspect.getmembers(type(db), inspect.isfunction):
+        if name.startswith('_') or name in skip:
+            continue
+        if inspect.isgeneratorfunction(func):
+            wrapped = _timed_db_generator(name, getattr(db, name))
+        else:
+            wrapped = _timed_db_method(name, getattr(db, name))
+        setattr(db, name, wrapped)
+
+
+# Replaces the callback of every handler in `handlers`, including those
+# nested in ConversationHandlers, with `wrapper(name, callback)`
+def wrap_callbacks(handlers, wrapper):
+    for handler in handlers:
+        if hasattr(handler, 'states'):
+            wrap_callbacks(handler.entry_points, wrapper)
+            for state_handlers in handler.states.values():
+                wrap_callbacks(state_handlers, wrapper)
+            wrap_callbacks(handler.fallbacks, wrapper)
+        else:
+            handler.callback = wrapper(handler.callback.__name__,
+                                       handler.callback)
+
+
+def _timed_handler(name, callback):
+    @wraps(callback)
+    def wrapped(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
+
+    return wrapped
+
+
+# Times every registered handler and every update the dispatcher processes.
+# Call it once all handlers have been added.
+def instrument_dispatcher(dispatcher):
+    for handlers in dispatcher.handlers.values():
+        wrap_callbacks(handlers, _timed_handler)
+    process_update = dispatcher.process_update
+
+    @wraps(process_update)
+    def timed_process_update(update):
+        _local.db_time = 0.0
+        started = time.perf_counter()
+        try:
+            return process_update(update)
+        finally:
+            update_seconds.observe(time.perf_counter() - started)
+            update_db_seconds.observe(_local.db_time)
+
+    dispatcher.process_update = timed_process_update
+
+
+def metrics_route():
+    return (200, 'text/plain; version=0.0.4; charset=utf-8',
+            registry.render().encode('utf-8'))
+
+
+# Rows of (label, calls, errors, average seconds, 95th percentile seconds),
+# slowest in total first
+def summary_rows(histogram, errors, limit=10):
+    rows = [(label_values[0], count, errors.get(*label_values),
+             total / count if count else 0.0, p95, total)
+            for label_values, (count, total, p95)
+            in histogram.summary().items()]
+    rows.sort(key=lambda row: row[5], reverse=True)
+    return [row[:5] for row in rows[:limit]]
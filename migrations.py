@@ -0,0 +1,121 @@
+# These migrations bring the database schema up to date. Append new ones to
+# the end of the list and never edit one that has already been released.
+
+# Arbitrary key for the advisory lock that serializes concurrent migrations
+MIGRATION_LOCK_ID = 7243001
+
+MIGRATIONS = [
+    (1, 'Menu item versions and photo file IDs', [
+        "ALTER TABLE food_details ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;",
+        "ALTER TABLE food_details ADD COLUMN IF NOT EXISTS image_file_id TEXT;"
+    ]),
+    (2, 'Images kept in the blob store', [
+        "ALTER TABLE food_details ADD COLUMN IF NOT EXISTS image_sha256 TEXT;",
+        "ALTER TABLE food_details ADD COLUMN IF NOT EXISTS image_size INTEGER;",
+        "ALTER TABLE order_list ADD COLUMN IF NOT EXISTS receipt_sha256 TEXT;",
+        "ALTER TABLE order_list ADD COLUMN IF NOT EXISTS receipt_size INTEGER;",
+        "CREATE TABLE IF NOT EXISTS blob_store (sha256 TEXT PRIMARY KEY, data BYTEA NOT NULL);"
+    ]),
+    (3, 'Order IDs for paging paid orders', [
+        "ALTER TABLE order_list ADD COLUMN IF NOT EXISTS id BIGSERIAL;",
+        "CREATE INDEX IF NOT EXISTS order_list_paid_page_idx ON order_list (collection_time, id) WHERE status = 'PAID';"
+    ]),
+    # New serial columns are numbered in physical order, so sorting by them
+    # keeps the order that ORDER BY ctid used to give
+    (4, 'Surrogate keys, creation times and lookup indexes', [
+        "ALTER TABLE order_list ADD PRIMARY KEY (id);",
+        "ALTER TABLE order_list ADD COLUMN created_at TIMESTAMPTZ NOT NULL DEFAULT now();",
+        "CREATE INDEX order_list_user_status_idx ON order_list (user_id, status, id);",
+        "CREATE INDEX order_list_status_time_idx ON order_list (status, collection_time);",
+        "ALTER TABLE food_details ADD COLUMN id SERIAL PRIMARY KEY;",
+        "ALTER TABLE collection_time ADD COLUMN id SERIAL PRIMARY KEY;"
+    ]),
+    # Unpaid orders are kept in memory as drafts now, so these were abandoned
+    (5, 'Drop pending orders', [
+        "DELETE FROM order_list WHERE status = 'PENDING';"
+    ]),
+    (6, 'Persisted conversation states and draft orders', [
+        "CREATE TABLE bot_state (namespace TEXT NOT NULL, key TEXT NOT NULL, value JSONB NOT NULL, updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), PRIMARY KEY (namespace, key));",
+        "CREATE INDEX bot_state_updated_idx ON bot_state (namespace, updated_at);"
+    ]),
+    (7, 'Receipt thumbnails', [
+        "ALTER TABLE order_list ADD COLUMN receipt_thumb_sha256 TEXT;"
+    ]),
+    # A NULL capacity means the SLOT_CAPACITY default
+    (8, 'Collection slot capacities and reservations', [
+        "ALTER TABLE collection_time ADD COLUMN capacity INTEGER;",
+        "CREATE TABLE slot_reservations (user_id BIGINT PRIMARY KEY, collection_time TEXT NOT NULL, reserved_at TIMESTAMPTZ NOT NULL DEFAULT now());",
+        "CREATE INDEX slot_reservations_time_idx ON slot_reservations (collection_time, reserved_at);"
+    ]),
+    # The existing table becomes the partition of every day up to today, so
+    # no rows are copied. Daily partitions after that are created ahead of
+    # time by DBHelper.rotate_orders(), which also moves old ones into
+    # order_history.
+    (9, 'Orders partitioned by business day', [
+        "ALTER TABLE order_list ADD COLUMN business_day DATE;",
+        "UPDATE order_list SET business_day = (created_at AT TIME ZONE 'Asia/Singapore')::date;",
+        "ALTER TABLE order_list ALTER COLUMN business_day SET NOT NULL;",
+        "ALTER TABLE order_list RENAME TO order_list_legacy;",
+        # Partitions take the parent's (business_day, id) key on attaching
+        "ALTER TABLE order_list_legacy DROP CONSTRAINT order_list_pkey;",
+        "CREATE TABLE order_list (LIKE order_list_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (business_day);",
+        "ALTER TABLE order_list ALTER COLUMN business_day SET DEFAULT (now() AT TIME ZONE 'Asia/Singapore')::date;",
+        "ALTER SEQUENCE order_list_id_seq OWNED BY order_list.id;",
+        "ALTER TABLE order_list ADD PRIMARY KEY (business_day, id);",
+        "CREATE INDEX order_list_day_user_status_idx ON order_list (business_day, user_id, status, id);",
+        "CREATE INDEX order_list_day_status_time_idx ON order_list (business_day, status, collection_time);",
+        "CREATE INDEX order_list_day_paid_page_idx ON order_list (business_day, collection_time, id) WHERE status = 'PAID';",
+        "DO $$ BEGIN EXECUTE format('ALTER TABLE order_list ATTACH PARTITION order_list_legacy FOR VALUES FROM (MINVALUE) TO (%L);', (now() AT TIME ZONE 'Asia/Singapore')::date + 1); END $$;",
+        # Catches orders for days whose partition has not been created yet
+        "CREATE TABLE order_list_default PARTITION OF order_list DEFAULT;",
+        "CREATE TABLE order_history (LIKE order_list INCLUDING DEFAULTS) PARTITION BY RANGE (business_day);",
+        "ALTER TABLE order_history ALTER COLUMN id DROP DEFAULT;"
+    ]),
+    (10, 'Processed update IDs shared between bot processes', [
+        "CREATE TABLE processed_updates (update_id BIGINT PRIMARY KEY, seen_at TIMESTAMPTZ NOT NULL DEFAULT now());",
+        "CREATE INDEX processed_updates_seen_at_idx ON processed_updates (seen_at);"
+    ])
+]
+
+# SQLite databases start out with the schema that the Postgres migrations
+# above add up to. Later migrations go into both lists under the same
+# version.
+SQLITE_MIGRATIONS = [
+    # Prices are stored as text so they come back as exact Decimals
+    (10, 'Initial schema', [
+        "CREATE TABLE collection_time (id INTEGER PRIMARY KEY AUTOINCREMENT, time_options TEXT, capacity INTEGER);",
+        "CREATE TABLE food_details (id INTEGER PRIMARY KEY AUTOINCREMENT, item_index INTEGER, category TEXT, name TEXT, price DECIMAL TEXT, image BLOB, version INTEGER NOT NULL DEFAULT 1, image_file_id TEXT, image_sha256 TEXT, image_size INTEGER);",
+        "CREATE TABLE offer_table (offer TEXT);",
+        "CREATE TABLE order_list (id INTEGER PRIMARY KEY AUTOINCREMENT, business_day DATE NOT NULL, created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, collection_time TEXT, user_id INTEGER, username TEXT, name TEXT, contact_number INTEGER, item_ordered TEXT, quantity INTEGER, location TEXT, remarks TEXT, status TEXT, receipt_image BLOB, receipt_sha256 TEXT, receipt_size INTEGER, receipt_thumb_sha256 TEXT);",
+        "CREATE INDEX order_list_day_user_status_idx ON order_list (business_day, user_id, status, id);",
+        "CREATE INDEX order_list_day_status_time_idx ON order_list (business_day, status, collection_time);",
+        "CREATE INDEX order_list_day_paid_page_idx ON order_list (business_day, collection_time, id) WHERE status = 'PAID';",
+        "CREATE TABLE order_history (id INTEGER PRIMARY KEY, business_day DATE NOT NULL, created_at TIMESTAMP NOT NULL, collection_time TEXT, user_id INTEGER, username TEXT, name TEXT, contact_number INTEGER, item_ordered TEXT, quantity INTEGER, location TEXT, remarks TEXT, status TEXT, receipt_image BLOB, receipt_sha256 TEXT, receipt_size INTEGER, receipt_thumb_sha256 TEXT);",
+        "CREATE INDEX order_history_day_idx ON order_history (business_day);",
+        "CREATE TABLE blob_store (sha256 TEXT PRIMARY KEY, data BLOB NOT NULL);",
+        "CREATE TABLE bot_state (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (namespace, key));",
+        "CREATE INDEX bot_state_updated_idx ON bot_state (namespace, updated_at);",
+        "CREATE TABLE slot_reservations (user_id INTEGER PRIMARY KEY, collection_time TEXT NOT NULL, reserved_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP);",
+        "CREATE INDEX slot_reservations_time_idx ON slot_reservations (collection_time, reserved_at);",
+        "CREATE TABLE processed_updates (update_id INTEGER PRIMARY KEY, seen_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP);",
+        "CREATE INDEX processed_updates_seen_at_idx ON processed_updates (seen_at);"
+    ])
+]
+
+
+# Applies every pending migration inside the caller's transaction
+# Without `lock`, the caller has to keep concurrent migrations out itself
+def migrate(cursor, migrations=MIGRATIONS, lock=True):
+    if lock:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s);",
+                       (MIGRATION_LOCK_ID,))
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP);")
+    cursor.execute("SELECT version FROM schema_migrations;")
+    applied = set(x[0] for x in cursor.fetchall())
+    for version, name, statements in migrations:
+        if version in applied:
+            continue
+        for stmt in statements:
+            cursor.execute(stmt)
+        cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+                       (version, name))
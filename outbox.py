@@ -0,0 +1,287 @@
+# These classes queue outgoing Telegram calls and deliver them in the
+# background without exceeding Telegram's flood limits
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+import telegram
+from telegram.error import RetryAfter, NetworkError, BadRequest
+
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', '4'))
+# Messages per second across all chats, and the burst allowed on top
+OUTBOX_GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', '30'))
+# Messages per second to a single chat, and the burst allowed on top
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', '1'))
+OUTBOX_CHAT_BURST = float(os.environ.get('OUTBOX_CHAT_BURST', '3'))
+OUTBOX_MAX_RETRIES = int(os.environ.get('OUTBOX_MAX_RETRIES', '3'))
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    # Seconds until a token is available
+    def delay(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+# `fallback` returns the keyword arguments, callbacks included, to retry
+# with once Telegram rejects the call as a bad request
+class Job:
+    def __init__(self, func, args, kwargs, on_sent=None, on_error=None,
+                 chat_action=False, fallback=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.on_sent = on_sent
+        self.on_error = on_error
+        # Chat actions are not messages, so they skip the per-chat limit
+        self.chat_action = chat_action
+        self.fallback = fallback
+        self.attempts = 0
+        self._find_files()
+
+    # Each attempt reads its uploads to the end, so remember where they
+    # start
+    def _find_files(self):
+        self.files = [(value, value.tell())
+                      for value in itertools.chain(self.args,
+                                                   self.kwargs.values())
+                      if hasattr(value, 'read') and hasattr(value, 'seek')]
+
+    def use_fallback(self):
+        kwargs = self.fallback()
+        self.fallback = None
+        self.on_sent = kwargs.pop('on_sent', self.on_sent)
+        self.on_error = kwargs.pop('on_error', self.on_error)
+        self.kwargs.update(kwargs)
+        self._find_files()
+
+    def rewind(self):
+        for value, position in self.files:
+            value.seek(position)
+
+
+class Outbox:
+    def __init__(self, workers=OUTBOX_WORKERS, global_rate=OUTBOX_GLOBAL_RATE,
+                 chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.cond = threading.Condition()
+        # chat_id -> deque of pending jobs, in delivery order
+        self.chats = {}
+        self.buckets = {}
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        # Heap of (not_before, seq, chat_id) for idle chats with pending jobs
+        self.ready = []
+        self.seq = itertools.count()
+        # Chats with a job in flight, so their jobs never overtake each other
+        self.busy = set()
+        self.paused_until = 0.0
+        self.size = 0
+        self.threads = []
+        self.running = False
+
+    # Lowers the global rate when several processes send for the same bot
+    def set_global_rate(self, rate):
+        with self.cond:
+            self.global_bucket = TokenBucket(rate, rate)
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='outbox-{}'.format(i),
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Waits up to `timeout` seconds for queued jobs to be delivered
+    def stop(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.size and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            self.running = False
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def pending(self):
+        return self.size
+
+    def put(self, chat_id, job):
+        with self.cond:
+            queue = self.chats.get(chat_id)
+            if queue is None:
+                queue = self.chats[chat_id] = deque()
+            if job.chat_action and any(j.chat_action for j in queue):
+                # An undelivered chat action already covers this one
+                return
+            queue.append(job)
+            self.size += 1
+            if len(queue) == 1 and chat_id not in self.busy:
+                self._schedule(chat_id, time.monotonic())
+            self.cond.notify()
+
+    def _schedule(self, chat_id, not_before):
+        heapq.heappush(self.ready, (not_before, next(self.seq), chat_id))
+
+    # Pops the next deliverable job, or returns the seconds to wait for one
+    def _next(self, now):
+        while self.ready and self.ready[0][0] <= now:
+            _, _, chat_id = heapq.heappop(self.ready)
+            job = self.chats[chat_id][0]
+            delay = max(self.global_bucket.delay(now),
+                        self.paused_until - now)
+            if not job.chat_action:
+                bucket = self.buckets.get(chat_id)
+                if bucket is None:
+                    bucket = self.buckets[chat_id] = \
+                        TokenBucket(self.chat_rate, self.chat_burst)
+                delay = max(delay, bucket.delay(now))
+            if delay > 0:
+                self._schedule(chat_id, now + delay)
+                continue
+            self.global_bucket.take(now)
+            if not job.chat_action:
+                self.buckets[chat_id].take(now)
+            self.chats[chat_id].popleft()
+            self.busy.add(chat_id)
+            return chat_id, job
+        if self.ready:
+            return self.ready[0][0] - now
+        return None
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.running:
+                        return
+                    result = self._next(time.monotonic())
+                    if isinstance(result, tuple):
+                        break
+                    self.cond.wait(result)
+            chat_id, job = result
+            retry_at = self._deliver(job)
+            with self.cond:
+                self.busy.discard(chat_id)
+                queue = self.chats[chat_id]
+                if retry_at is not None:
+                    queue.appendleft(job)
+                else:
+                    self.size -= 1
+                if queue:
+                    self._schedule(chat_id, retry_at or time.monotonic())
+                else:
+                    del self.chats[chat_id]
+                    bucket = self.buckets.get(chat_id)
+                    if bucket is not None and bucket.full(time.monotonic()):
+                        del self.buckets[chat_id]
+                self.cond.notify_all()
+
+    # Returns the time to retry at if the job should be attempted again
+    def _deliver(self, job):
+        job.attempts += 1
+        try:
+            job.rewind()
+            result = job.func(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            # Flood limits apply to the whole bot, so hold every chat back
+            retry_at = time.monotonic() + e.retry_after
+            with self.cond:
+                self.paused_until = max(self.paused_until, retry_at)
+            logger.warning('Flood limit hit, pausing deliveries for %ss.',
+                           e.retry_after)
+            return retry_at
+        except NetworkError as e:
+            # Retried straight away, still ahead of the chat's later jobs
+            if isinstance(e, BadRequest) and job.fallback is not None:
+                job.use_fallback()
+                return time.monotonic()
+            # Covers timeouts too, but a bad request will never succeed
+            if not isinstance(e, BadRequest) and \
+                    job.attempts < OUTBOX_MAX_RETRIES:
+                return time.monotonic() + 2 ** job.attempts
+            self._fail(job, e)
+            return None
+        except Exception as e:
+            self._fail(job, e)
+            return None
+        if job.on_sent is not None:
+            try:
+                job.on_sent(result)
+            except Exception:
+                logger.exception('Outbox on_sent callback failed.')
+        return None
+
+    def _fail(self, job, error):
+        logger.warning('Dropping outgoing %s call: %s',
+                       getattr(job.func, '__name__', 'telegram'), error)
+        if job.on_error is not None:
+            try:
+                job.on_error(error)
+            except Exception:
+                logger.exception('Outbox on_error callback failed.')
+
+
+# Drop-in Bot whose send methods hand off to an Outbox and return at once.
+# Pass `on_sent` / `on_error` callbacks to observe the eventual outcome, and
+# a `fallback` as described for Job.
+class QueuedBot(telegram.Bot):
+    def __init__(self, token, outbox, **kwargs):
+        super(QueuedBot, self).__init__(token, **kwargs)
+        self.outbox = outbox
+
+    def _enqueue(self, func, args, kwargs, chat_action=False):
+        on_sent = kwargs.pop('on_sent', None)
+        on_error = kwargs.pop('on_error', None)
+        fallback = kwargs.pop('fallback', None)
+        chat_id = kwargs['chat_id'] if 'chat_id' in kwargs else args[0]
+        job = Job(func, args, kwargs, on_sent=on_sent, on_error=on_error,
+                  chat_action=chat_action, fallback=fallback)
+        self.outbox.put(chat_id, job)
+
+    def send_message(self, *args, **kwargs):
+        self._enqueue(super(QueuedBot, self).send_message, args, kwargs)
+
+    def send_photo(self, *args, **kwargs):
+        self._enqueue(super(QueuedBot, self).send_photo, args, kwargs)
+
+    def send_document(self, *args, **kwargs):
+        self._enqueue(super(QueuedBot, self).send_document, args, kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        self._enqueue(super(QueuedBot, self).edit_message_text, args,
+                      kwargs)
+
+    def send_chat_action(self, *args, **kwargs):
+        self._enqueue(super(QueuedBot, self).send_chat_action, args, kwargs,
+                      chat_action=True)
@@ -0,0 +1,140 @@
+# This class renders PayNow QR codes for the exact amount of an order and
+# caches both the images and their Telegram file IDs
+
+import os
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+from functools import lru_cache
+from io import BytesIO
+import qrcode
+
+# UEN or mobile number that payments go to. Without one the static QR code
+# image is sent instead.
+PAYNOW_PROXY = os.environ.get('PAYNOW_PROXY')
+# Either `UEN` or `MOBILE`
+PAYNOW_PROXY_TYPE = os.environ.get('PAYNOW_PROXY_TYPE', 'UEN')
+PAYNOW_MERCHANT_NAME = os.environ.get('PAYNOW_MERCHANT_NAME', 'The Spread')
+# Shown to the payer and on the payee's statement, formatted with `user_id`
+# and the draft's `order_code`. At most 25 characters are encoded.
+PAYNOW_REFERENCE = os.environ.get('PAYNOW_REFERENCE',
+                                  'SPREAD{user_id}-{order_code}')
+# Rendered QR codes and file IDs kept in memory
+PAYNOW_CACHE_SIZE = int(os.environ.get('PAYNOW_CACHE_SIZE', '256'))
+STATIC_QR_CODE_PATH = './images/qr_code.JPG'
+
+PROXY_TYPES = {'MOBILE': '0', 'UEN': '2'}
+
+
+def _field(tag, value):
+    return '{}{:02d}{}'.format(tag, len(value), value)
+
+
+# CRC-16/CCITT-FALSE, as required by the EMVCo QR specification
+def crc16(data):
+    crc = 0xFFFF
+    for byte in data.encode('utf-8'):
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+            crc &= 0xFFFF
+    return '{:04X}'.format(crc)
+
+
+# SGQR / PayNow payload for a fixed amount that the payer cannot edit
+def payload(amount, reference, proxy=PAYNOW_PROXY,
+            proxy_type=PAYNOW_PROXY_TYPE, merchant_name=PAYNOW_MERCHANT_NAME):
+    merchant_account = ''.join([
+        _field('00', 'SG.PAYNOW'),
+        _field('01', PROXY_TYPES[proxy_type]),
+        _field('02', proxy),
+        _field('03', '0')
+    ])
+    data = ''.join([
+        _field('00', '01'),
+        # Dynamic, since it is only meant to be paid once
+        _field('01', '12'),
+        _field('26', merchant_account),
+        _field('52', '0000'),
+        _field('53', '702'),
+        _field('54', '{:.2f}'.format(Decimal(amount))),
+        _field('58', 'SG'),
+        _field('59', merchant_name[:25]),
+        _field('60', 'Singapore'),
+        _field('62', _field('01', reference[:25]))
+    ]) + '6304'
+    return data + crc16(data)
+
+
+def render(data):
+    image = qrcode.make(data, error_correction=qrcode.constants.ERROR_CORRECT_M,
+                        box_size=8, border=4)
+    output = BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+
+class PaymentQR:
+    def __init__(self, cache_size=PAYNOW_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.render = lru_cache(maxsize=cache_size)(render)
+        self.lock = threading.Lock()
+        # (amount, reference) -> Telegram file_id, least recently used first
+        self.file_ids = OrderedDict()
+        self.static_image = None
+
+    # Differs for every order, so payments can be matched to them
+    def reference(self, draft):
+        return PAYNOW_REFERENCE.format(user_id=draft.user_id,
+                                       order_code=draft.order_code)
+
+    def _image(self, key):
+        if PAYNOW_PROXY is None:
+            # Read once, so later payments do not touch the disk
+            if self.static_image is None:
+                with open(STATIC_QR_CODE_PATH, 'rb') as f:
+                    self.static_image = f.read()
+            return self.static_image
+        return self.render(payload(*key))
+
+    def _key(self, amount, reference):
+        if PAYNOW_PROXY is None:
+            return None
+        return '{:.2f}'.format(Decimal(amount)), reference
+
+    def _store(self, key, message):
+        if message is None or not message.photo:
+            return
+        with self.lock:
+            self.file_ids[key] = message.photo[-1].file_id
+            self.file_ids.move_to_end(key)
+            while len(self.file_ids) > self.cache_size:
+                self.file_ids.popitem(last=False)
+
+    # Keyword arguments of send_photo() that upload the image itself
+    def _upload(self, key):
+        return {'photo': BytesIO(self._image(key)),
+                'on_sent': lambda message: self._store(key, message)}
+
+    # Sends the QR code for paying `amount`, reusing an earlier upload of
+    # the same code where possible
+    def send(self, bot, chat_id, amount, reference, caption=None):
+        key = self._key(amount, reference)
+        with self.lock:
+            file_id = self.file_ids.get(key)
+            if file_id is not None:
+                self.file_ids.move_to_end(key)
+        if file_id is None:
+            bot.send_photo(chat_id=chat_id, caption=caption,
+                           **self._upload(key))
+            return
+
+        # Telegram no longer knows this file, so upload it again in its
+        # place, before the chat's later messages
+        def fallback():
+            with self.lock:
+                self.file_ids.pop(key, None)
+            return self._upload(key)
+
+        bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption,
+                       fallback=fallback)
@@ -0,0 +1,23 @@
+# These classes extend the connections and cursors of the postgres backend,
+# which is the only part of the bot that needs psycopg2
+
+import psycopg2
+from dbhelper import statements
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        statements.add()
+        return super(CountingCursor, self).execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        statements.add()
+        return super(CountingCursor, self).executemany(query, vars_list)
+
+
+# Remembers which catalogued statements have been prepared on it, which are
+# gone once it is closed
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
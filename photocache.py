@@ -0,0 +1,59 @@
+# This class caches the Telegram file IDs of the menu photos
+
+from io import BytesIO
+
+
+class PhotoCache:
+    def __init__(self, db, blob_store):
+        self.db = db
+        self.blob_store = blob_store
+        # category -> current image version
+        self.versions = {}
+        # (category, version) -> Telegram file_id
+        self.file_ids = {}
+
+    def _lookup(self, category):
+        version = self.versions.get(category)
+        if version is not None and (category, version) in self.file_ids:
+            return version, self.file_ids[(category, version)]
+        row = self.db.check_photo_file_id(category)
+        if row is None:
+            return None, None
+        version, file_id = row
+        self.versions[category] = version
+        if file_id is not None:
+            self.file_ids[(category, version)] = file_id
+        return version, file_id
+
+    def _store(self, category, version, message):
+        if message is None or not message.photo:
+            return
+        file_id = message.photo[-1].file_id
+        self.file_ids[(category, version)] = file_id
+        self.db.add_photo_file_id(file_id, category, version)
+
+    # Keyword arguments of send_photo() that upload the image itself
+    def _upload(self, category, version):
+        image = self.blob_store.get(self.db.check_photo(category)[0])
+        return {'photo': BytesIO(image),
+                'on_sent': lambda message: self._store(category, version,
+                                                       message)}
+
+    # Sends through the outbox, so the file_id is recorded once delivered
+    def send(self, bot, chat_id, category):
+        version, file_id = self._lookup(category)
+        if file_id is None:
+            bot.send_photo(chat_id=chat_id, **self._upload(category, version))
+            return
+
+        # Telegram no longer knows this file, so upload it again in its
+        # place, before the chat's later messages
+        def fallback():
+            self.file_ids.pop((category, version), None)
+            return self._upload(category, version)
+
+        bot.send_photo(chat_id=chat_id, photo=file_id, fallback=fallback)
+
+    def invalidate(self, category):
+        version = self.versions.pop(category, None)
+        self.file_ids.pop((category, version), None)
@@ -0,0 +1,113 @@
+# These functions turn the aggregated order totals into kitchen prep
+# sheets and work out when each collection time's sheet is due
+
+import html
+import logging
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from tabulate import tabulate
+
+# Minutes before a collection time that its prep sheet is pushed
+PREP_LEAD_MINUTES = int(os.environ.get('PREP_LEAD_MINUTES', '30'))
+# Longest message Telegram accepts
+MESSAGE_LIMIT = 4096
+# Longest remarks cell, so one chatty order cannot widen the whole table
+REMARKS_WIDTH = int(os.environ.get('PREP_REMARKS_WIDTH', '60'))
+
+HEADERS = ['Location', 'Item', 'Qty', 'Remarks']
+# Hour, optional minutes and optional AM or PM at the start of a slot
+SLOT_START = re.compile(r'^\s*([0-2]?[0-9])(?:[:.]?([0-5][0-9]))?'
+                        r'\s*(?:([AaPp])\.?[Mm]\.?)?')
+
+logger = logging.getLogger(__name__)
+
+
+# Start of a collection time such as `12:30`, `12:30 - 13:00` or
+# `1.30pm - 2pm` on `day`, or None if it has no recognizable time
+def slot_start(slot, day):
+    match = SLOT_START.match(slot)
+    if match is None:
+        return None
+    hour, minute, meridiem = match.groups()
+    hour = int(hour)
+    if meridiem is None:
+        # A bare number is not a time
+        if minute is None or hour > 24:
+            return None
+    else:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem in 'Pp' else 0)
+    return datetime.combine(day, datetime.min.time()).replace(
+        hour=hour % 24, minute=int(minute or 0))
+
+
+def _shorten(text):
+    if text is None:
+        return ''
+    if len(text) <= REMARKS_WIDTH:
+        return text
+    return text[:REMARKS_WIDTH - 1] + '…'
+
+
+def _table(rows):
+    return '<pre>{}</pre>'.format(html.escape(tabulate(rows,
+                                                       headers=HEADERS)))
+
+
+# One or more HTML messages per collection time, given the rows of
+# DBHelper.prep_totals()
+def render(rows):
+    slots = {}
+    for collection_time, location, item, quantity, remarks in rows:
+        slots.setdefault(collection_time, []).append(
+            ['All' if location is None else location or '-', item, quantity,
+             _shorten(remarks)])
+    messages = []
+    for collection_time, table_rows in slots.items():
+        title = '<b>Prep for {}</b>\r\n'.format(html.escape(collection_time))
+        # Split long sheets between rows rather than mid-table
+        chunk = []
+        for row in table_rows:
+            if chunk and len(title) + len(_table(chunk + [row])) > \
+                    MESSAGE_LIMIT:
+                messages.append(title + _table(chunk))
+                chunk = []
+            chunk.append(row)
+        messages.append(title + _table(chunk))
+    return messages
+
+
+class PrepSchedule:
+    def __init__(self, lead_minutes=PREP_LEAD_MINUTES):
+        self.lead = timedelta(minutes=lead_minutes)
+        self.lock = threading.Lock()
+        # (day, collection time) of the sheets already pushed
+        self.pushed = set()
+        # Collection times already reported as unparseable
+        self.unparseable = set()
+
+    # Collection times whose prep sheet is due at `now` and has not been
+    # pushed yet. Marks them as pushed.
+    def due(self, slots, now):
+        today = now.date()
+        due = []
+        with self.lock:
+            self.pushed = set(key for key in self.pushed if key[0] == today)
+            for slot in slots:
+                start = slot_start(slot, today)
+                if start is None:
+                    if slot not in self.unparseable:
+                        self.unparseable.add(slot)
+                        logger.warning('No prep sheet for collection time '
+                                       '%r, which has no recognizable start.',
+                                       slot)
+                    continue
+                if (today, slot) in self.pushed:
+                    continue
+                if start - self.lead <= now < start:
+                    self.pushed.add((today, slot))
+                    due.append(slot)
+        return due
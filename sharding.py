@@ -0,0 +1,125 @@
+# This class runs the bot's handlers in several worker processes and routes
+# each update to the worker that owns its user
+
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import time
+from telegram import Update
+from telegram.error import TelegramError
+from ingest import UPDATE_QUEUE_MAX
+
+# Worker processes handling updates. With 1, everything runs in a single
+# process as before.
+SHARDS = int(os.environ.get('SHARDS', '1'))
+# Seconds the workers get to finish their queued updates, which has to leave
+# the router time to exit within Heroku's 30 second shutdown grace period
+SHARD_STOP_TIMEOUT = float(os.environ.get('SHARD_STOP_TIMEOUT', '20'))
+
+logger = logging.getLogger(__name__)
+
+
+# Every update of a user goes to the same worker, so their conversation
+# state, draft and update IDs are never split between processes
+def shard_for(update, shards):
+    user = update.effective_user
+    if user is None:
+        return 0
+    return user.id % shards
+
+
+class ShardRouter:
+    def __init__(self, shards=SHARDS, max_pending=UPDATE_QUEUE_MAX):
+        self.shards = shards
+        self.max_pending = max_pending
+        # Workers inherit the loaded bot instead of importing it again
+        self.context = multiprocessing.get_context('fork')
+        self.queues = []
+        # Set by each worker once it has warmed up
+        self.ready = []
+        self.processes = []
+
+    # Forks one process per shard running `target(shard, queue, ready)`,
+    # which sets the `ready` event once it can handle updates. Call it
+    # before starting any thread, which the children would not inherit.
+    def start(self, target):
+        for shard in range(self.shards):
+            queue = self.context.Queue()
+            ready = self.context.Event()
+            process = self.context.Process(target=target,
+                                           args=(shard, queue, ready),
+                                           name='shard-{}'.format(shard),
+                                           daemon=True)
+            process.start()
+            self.queues.append(queue)
+            self.ready.append(ready)
+            self.processes.append(process)
+
+    # Blocks until every worker is ready. Raises RuntimeError if one exits
+    # first.
+    def wait_ready(self, poll=1.0):
+        for shard, ready in enumerate(self.ready):
+            while not ready.wait(poll):
+                if not self.processes[shard].is_alive():
+                    raise RuntimeError('Shard {} exited before it was ready.'
+                                       .format(shard))
+
+    # Replaces Dispatcher.process_update in the router process
+    def route(self, update):
+        if isinstance(update, TelegramError):
+            logger.warning('Update error: %s', update)
+            return
+        self.queues[shard_for(update, self.shards)].put(update.to_dict())
+
+    def pending(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def full(self):
+        return self.pending() >= self.max_pending
+
+    # Shards whose worker has exited
+    def dead(self):
+        return [shard for shard, process in enumerate(self.processes)
+                if not process.is_alive()]
+
+    def stop(self, timeout=SHARD_STOP_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning('Terminating %s.', process.name)
+                process.terminate()
+
+
+# Raised in a worker's main thread when it has run out of time to stop
+class StopTimeout(Exception):
+    pass
+
+
+# Heroku sends SIGTERM to every process of the dyno at once. Workers keep
+# draining their queue until the router stops them, but raise StopTimeout
+# once `timeout` seconds have passed, so they can still save their state.
+def handle_sigterm(timeout=SHARD_STOP_TIMEOUT):
+    def stopping(signum, frame):
+        logger.info('Stopping within %ss.', timeout)
+        signal.alarm(max(1, math.ceil(timeout)))
+
+    def timed_out(signum, frame):
+        raise StopTimeout()
+
+    signal.signal(signal.SIGALRM, timed_out)
+    signal.signal(signal.SIGTERM, stopping)
+
+
+# Feeds the updates routed to this worker into its dispatcher until the
+# router stops it
+def serve(queue, bot, update_queue):
+    while True:
+        data = queue.get()
+        if data is None:
+            return
+        update_queue.put(Update.de_json(data, bot))
@@ -0,0 +1,83 @@
+# This class hands out collection time slots without overbooking the kitchen
+
+import os
+import threading
+import time
+from drafts import DRAFT_TTL
+
+# Orders the kitchen can prepare per slot, unless the slot sets its own
+SLOT_CAPACITY = int(os.environ.get('SLOT_CAPACITY', '30'))
+# Seconds the list of slots is reused before it is read again
+SLOT_CACHE_TTL = float(os.environ.get('SLOT_CACHE_TTL', '60'))
+# Seconds the order counts per slot are reused when showing free slots.
+# Reservations always check the live counts.
+SLOT_USAGE_TTL = float(os.environ.get('SLOT_USAGE_TTL', '5'))
+
+
+class SlotScheduler:
+    def __init__(self, db, capacity=SLOT_CAPACITY, hold_ttl=DRAFT_TTL):
+        self.db = db
+        self.capacity = capacity
+        # Reservations of carts untouched for this long no longer count
+        self.hold_ttl = hold_ttl
+        self.lock = threading.Lock()
+        # [(time, capacity)], in display order
+        self.slot_list = []
+        self.slots_loaded_at = None
+        # time -> orders and reservations
+        self.usage = {}
+        self.usage_loaded_at = None
+
+    def slots(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.slots_loaded_at is not None and \
+                    now - self.slots_loaded_at < SLOT_CACHE_TTL:
+                return self.slot_list
+        slot_list = [(slot, capacity if capacity is not None
+                      else self.capacity)
+                     for slot, capacity in self.db.check_slots()]
+        with self.lock:
+            self.slot_list = slot_list
+            self.slots_loaded_at = now
+        return slot_list
+
+    def is_slot(self, slot):
+        return any(slot == x for x, _ in self.slots())
+
+    def _usage(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.usage_loaded_at is not None and \
+                    now - self.usage_loaded_at < SLOT_USAGE_TTL:
+                return self.usage
+        usage = self.db.slot_usage(self.hold_ttl)
+        with self.lock:
+            self.usage = usage
+            self.usage_loaded_at = now
+        return usage
+
+    # Slots that still have room, in display order
+    def available(self):
+        usage = self._usage()
+        return [slot for slot, capacity in self.slots()
+                if usage.get(slot, 0) < capacity]
+
+    # Holds a place in `slot` for the user's cart until it is paid for,
+    # cancelled or abandoned. Returns False if the slot is full.
+    def reserve(self, user_id, slot):
+        capacity = dict(self.slots()).get(slot, self.capacity)
+        reserved = self.db.reserve_slot(user_id, slot, capacity,
+                                        self.hold_ttl)
+        with self.lock:
+            if reserved:
+                self.usage[slot] = self.usage.get(slot, 0) + 1
+            else:
+                # The cached counts were stale, so reload them next time
+                self.usage_loaded_at = None
+        return reserved
+
+    def release(self, user_id):
+        self.db.release_slot(user_id)
+        with self.lock:
+            self.usage_loaded_at = None
@@ -0,0 +1,236 @@
+# This class serves the same SQL commands from an embedded SQLite database,
+# for deployments that run a single bot process on one machine
+
+import json
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from dbhelper import DBHelper, statements, catalog, business_day, _order_rows
+from migrations import migrate, SQLITE_MIGRATIONS
+
+SQLITE_PATH = os.environ.get('SQLITE_PATH', './spread.db')
+# Seconds a statement waits for another connection's write to finish
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', '10'))
+# DELETE ... RETURNING arrived in 3.35, after aggregate FILTER and NULLS
+# FIRST in 3.30
+SQLITE_MIN_VERSION = (3, 35, 0)
+
+# Postgres-only expressions used by the shared queries, with their SQLite
+# equivalents. Timestamps are stored in UTC as `YYYY-MM-DD HH:MM:SS`.
+REWRITES = [
+    (re.compile(r'now\(\) - make_interval\(secs => %s\)'),
+     "datetime('now', '-' || ? || ' seconds')"),
+    (re.compile(r'now\(\)'), 'CURRENT_TIMESTAMP'),
+    # Writes are serialized by BEGIN IMMEDIATE instead of row locks
+    (re.compile(r' FOR UPDATE'), ''),
+    (re.compile(r'%s'), '?')
+]
+
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('DECIMAL', lambda value: Decimal(value.decode()))
+sqlite3.register_converter('DATE',
+                           lambda value: date.fromisoformat(value.decode()))
+sqlite3.register_converter(
+    'TIMESTAMP', lambda value: datetime.fromisoformat(value.decode())
+    .replace(tzinfo=timezone.utc))
+
+
+def translate(query):
+    for pattern, replacement in REWRITES:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+# Accepts the queries written for psycopg2
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, vars=None):
+        statements.add()
+        self.cursor.execute(translate(query), vars or ())
+
+    def executemany(self, query, vars_list):
+        statements.add()
+        self.cursor.executemany(translate(query), vars_list)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+
+class SQLiteHelper(DBHelper):
+    backend = 'sqlite'
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        # One connection per thread, which SQLite lets read concurrently
+        self.local = threading.local()
+        self.pool_lock = threading.Lock()
+        self.connections = []
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.in_use = 0
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT,
+                                   isolation_level=None,
+                                   detect_types=sqlite3.PARSE_DECLTYPES,
+                                   check_same_thread=False)
+            # Readers no longer wait for writers, and commits skip an fsync
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            # Menu edits are announced to other processes, which an
+            # embedded database does not have
+            conn.create_function('pg_notify', 2, lambda channel, payload: None)
+            self.local.conn = conn
+            with self.pool_lock:
+                self.connections.append(conn)
+        return conn
+
+    # `name` and `itersize` are accepted for compatibility, since SQLite
+    # cursors always step through rows as they are read. `immediate` takes
+    # the write lock up front.
+    @contextmanager
+    def transaction(self, name=None, itersize=2000, immediate=False):
+        conn = self._connection()
+        # Joins the transaction this thread already has open, such as a
+        # blob lookup while paging through orders
+        if conn.in_transaction:
+            yield SQLiteCursor(conn.cursor())
+            return
+        conn.execute("BEGIN IMMEDIATE;" if immediate else "BEGIN;")
+        with self.stats_lock:
+            self.checkouts += 1
+            self.in_use += 1
+        try:
+            yield SQLiteCursor(conn.cursor())
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            with self.stats_lock:
+                self.in_use -= 1
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'size': len(self.connections),
+                'in_use': self.in_use,
+                'checkouts': self.checkouts,
+                'wait_avg': 0.0,
+                'wait_max': 0.0,
+                'reconnects': 0,
+                'timeouts': 0,
+                'statements': statements.total
+            }
+
+    def setup(self):
+        if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+            raise RuntimeError('SQLite {} is too old, the sqlite backend '
+                               'needs {} or later.'.format(
+                                   sqlite3.sqlite_version,
+                                   '.'.join(map(str, SQLITE_MIN_VERSION))))
+        with self.transaction(immediate=True) as cursor:
+            migrate(cursor, SQLITE_MIGRATIONS, lock=False)
+
+    def close(self):
+        with self.pool_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+            self.local = threading.local()
+
+    def listen(self, channel):
+        raise NotImplementedError('SQLite has no notifications.')
+
+    # sqlite3 already caches the statements each connection has prepared
+    def _send(self, cursor, name, args):
+        cursor.execute(catalog.sql[name], args)
+
+    def reserve_slot(self, user_id, collection_time, capacity, max_age):
+        with self.transaction(immediate=True):
+            return super(SQLiteHelper, self).reserve_slot(
+                user_id, collection_time, capacity, max_age)
+
+    def place_order(self, draft, prices, receipt_sha256, receipt_size,
+                    receipt_thumb_sha256=None):
+        stmt = "INSERT INTO order_list (business_day, user_id, username, name, contact_number, item_ordered, quantity, location, remarks, collection_time, status, receipt_sha256, receipt_size, receipt_thumb_sha256) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"
+        rows = _order_rows(draft, prices, receipt_sha256, receipt_size,
+                           receipt_thumb_sha256)
+        release_args = (draft.user_id,)
+        with self.transaction(immediate=True) as cursor:
+            cursor.executemany(stmt, rows)
+            self._run(cursor, 'release_slot', release_args)
+
+    # SQLite has no GROUPING SETS, so the totals across locations are
+    # unioned in
+    def prep_totals(self, collection_time=None):
+        conditions = ["business_day = (%s)", "status = 'PAID'"]
+        args = [business_day()]
+        if collection_time is not None:
+            conditions.append("collection_time = (%s)")
+            args.append(collection_time)
+        stmt = "WITH lines AS (SELECT collection_time, location, item_ordered, remarks, sum(quantity) AS quantity FROM order_list WHERE {} GROUP BY collection_time, location, item_ordered, remarks ORDER BY remarks) SELECT collection_time, location_total, item_ordered, quantity, remarks FROM (SELECT collection_time, coalesce(location, '') AS location_total, item_ordered, sum(quantity) AS quantity, group_concat(quantity || 'x ' || remarks, '; ') FILTER (WHERE remarks <> 'N/A') AS remarks FROM lines GROUP BY collection_time, location, item_ordered UNION ALL SELECT collection_time, NULL, item_ordered, sum(quantity), NULL FROM lines GROUP BY collection_time, item_ordered) ORDER BY collection_time ASC, location_total ASC NULLS FIRST, item_ordered ASC;".format(' AND '.join(conditions))
+        with self.transaction() as cursor:
+            cursor.execute(stmt, args)
+            return cursor.fetchall()
+
+    # Without partitions, old orders are moved into order_history row by
+    # row. Returns the days archived and dropped in place of partitions.
+    def rotate_orders(self, days_ahead, retention_days, history_days):
+        today = business_day()
+        keep_from = today - timedelta(days=max(retention_days, 1) - 1)
+        dropped = []
+        with self.transaction(immediate=True) as cursor:
+            cursor.execute("SELECT DISTINCT business_day FROM order_list WHERE business_day < (%s) ORDER BY business_day;", (keep_from,))
+            archived = [str(row[0]) for row in cursor.fetchall()]
+            cursor.execute("INSERT INTO order_history SELECT * FROM order_list WHERE business_day < (%s);", (keep_from,))
+            cursor.execute("DELETE FROM order_list WHERE business_day < (%s);", (keep_from,))
+            if history_days:
+                drop_before = today - timedelta(days=history_days)
+                cursor.execute("SELECT DISTINCT business_day FROM order_history WHERE business_day < (%s) ORDER BY business_day;", (drop_before,))
+                dropped = [str(row[0]) for row in cursor.fetchall()]
+                cursor.execute("DELETE FROM order_history WHERE business_day < (%s);", (drop_before,))
+        return [], archived, dropped
+
+    # States are stored as JSON text
+    def check_state(self, namespace, key):
+        value = super(SQLiteHelper, self).check_state(namespace, key)
+        return json.loads(value) if value is not None else None
+
+    # There are no other processes to tell about the changes
+    def write_states(self, changes, source=None):
+        upsert_stmt = "INSERT INTO bot_state (namespace, key, value) VALUES (%s, %s, %s) ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, updated_at = now();"
+        delete_stmt = "DELETE FROM bot_state WHERE namespace = (%s) AND key = (%s);"
+        upserts = [(namespace, key, json.dumps(value))
+                   for namespace, key, value in changes if value is not None]
+        deletes = [(namespace, key)
+                   for namespace, key, value in changes if value is None]
+        with self.transaction(immediate=True) as cursor:
+            if upserts:
+                cursor.executemany(upsert_stmt, upserts)
+            if deletes:
+                cursor.executemany(delete_stmt, deletes)
+
+    def expire_states(self, namespace, max_age):
+        return [(key, json.loads(value)) for key, value in
+                super(SQLiteHelper, self).expire_states(namespace, max_age)]
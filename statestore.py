@@ -0,0 +1,341 @@
+# These classes persist conversation states and draft orders, so they
+# survive restarts and can be shared by several bot processes
+
+import json
+import logging
+import os
+import select
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from dbhelper import STATE_CHANNEL
+
+STATE_STORE = os.environ.get('STATE_STORE', 'postgres')
+STATE_STORE_PATH = os.environ.get('STATE_STORE_PATH', './state.json')
+# Seconds between batched writes to the store
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', '0.2'))
+# Loaded values kept per namespace. Values written by other processes are
+# dropped from the cache when they announce the change.
+STATE_CACHE_SIZE = int(os.environ.get('STATE_CACHE_SIZE', '10000'))
+# Longest wait between attempts to write state while the store is down
+STATE_RETRY_MAX = float(os.environ.get('STATE_RETRY_MAX', '30'))
+
+logger = logging.getLogger(__name__)
+
+
+class PostgresStateStore:
+    def __init__(self, db):
+        self.db = db
+        # Other bot processes may write to the same database
+        self.shared = db.backend == 'postgres'
+        # Tells this process's own change notifications apart
+        self.source = uuid.uuid4().hex
+
+    def load(self, namespace, key):
+        return self.db.check_state(namespace, key)
+
+    # `changes` is a list of (namespace, key, value), where None deletes
+    def save(self, changes):
+        self.db.write_states(changes, self.source if self.shared else None)
+
+    # Removes and returns the (key, value) pairs untouched for `max_age`
+    def expire(self, namespace, max_age):
+        return self.db.expire_states(namespace, max_age)
+
+
+# Single-process stand-in for local development
+class FileStateStore:
+    shared = False
+
+    def __init__(self, path=STATE_STORE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        # namespace -> key -> [value, updated_at]
+        self.data = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data = json.load(f)
+
+    def _write(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(temp_path, self.path)
+
+    def load(self, namespace, key):
+        with self.lock:
+            entry = self.data.get(namespace, {}).get(key)
+        return entry[0] if entry is not None else None
+
+    def save(self, changes):
+        now = time.time()
+        with self.lock:
+            for namespace, key, value in changes:
+                entries = self.data.setdefault(namespace, {})
+                if value is None:
+                    entries.pop(key, None)
+                else:
+                    entries[key] = [value, now]
+            self._write()
+
+    def expire(self, namespace, max_age):
+        cutoff = time.time() - max_age
+        with self.lock:
+            entries = self.data.get(namespace, {})
+            expired = [(key, entry[0]) for key, entry in entries.items()
+                       if entry[1] < cutoff]
+            for key, _ in expired:
+                del entries[key]
+            if expired:
+                self._write()
+        return expired
+
+
+def open_state_store(db):
+    if STATE_STORE == 'postgres':
+        return PostgresStateStore(db)
+    if STATE_STORE == 'file':
+        return FileStateStore()
+    raise ValueError('Unknown STATE_STORE {!r}.'.format(STATE_STORE))
+
+
+# Collects writes and sends them to the store in batches
+class StateWriter:
+    def __init__(self, store, interval=STATE_FLUSH_INTERVAL,
+                 retry_max=STATE_RETRY_MAX):
+        self.store = store
+        self.interval = interval
+        self.retry_max = retry_max
+        # Set by stop(), so a retry does not hold up shutting down
+        self.stopping = threading.Event()
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        # (namespace, key) -> value, kept readable until it is written
+        self.pending = OrderedDict()
+        self.running = False
+        self.thread = None
+
+    def put(self, namespace, key, value):
+        with self.cond:
+            self.pending[(namespace, key)] = value
+            self.pending.move_to_end((namespace, key))
+            self.cond.notify()
+
+    # Returns (True, value) if a write for the key has not been flushed yet
+    def lookup(self, namespace, key):
+        with self.cond:
+            if (namespace, key) in self.pending:
+                return True, self.pending[(namespace, key)]
+        return False, None
+
+    def flush(self):
+        with self.flush_lock:
+            with self.cond:
+                batch = list(self.pending.items())
+            if not batch:
+                return
+            self.store.save([(namespace, key, value)
+                             for (namespace, key), value in batch])
+            with self.cond:
+                for item, value in batch:
+                    # Keep anything that was overwritten during the write
+                    if self.pending.get(item, value) is value:
+                        self.pending.pop(item, None)
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait()
+                if not self.running:
+                    break
+            # Give other writes a moment to join this batch
+            time.sleep(self.interval)
+            try:
+                self.flush()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                delay = min(self.retry_max, self.interval * 2 ** failures)
+                if failures == 1:
+                    logger.exception('Failed to persist state, retrying in '
+                                     '%.1fs.', delay)
+                else:
+                    logger.warning('Failed to persist state %s times, '
+                                   'retrying in %.1fs: %s', failures, delay,
+                                   e)
+                self.stopping.wait(delay)
+
+    def start(self):
+        self.running = True
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name='state-writer',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+
+# Dictionary view of one namespace of the store, loaded lazily per key and
+# cached while `cache_valid` is set. Keys are stored JSON-encoded, so tuple
+# keys come back as lists when iterated.
+class PersistentDict(MutableMapping):
+    def __init__(self, namespace, store, writer, cache_valid,
+                 cache_size=STATE_CACHE_SIZE):
+        self.namespace = namespace
+        self.store = store
+        self.writer = writer
+        self.cache_valid = cache_valid
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        # JSON key -> value, or None if the store has none, least recently
+        # used first
+        self.cache = OrderedDict()
+        # Bumped by every invalidation, so a load that raced with one is not
+        # cached
+        self.generation = 0
+
+    def _remember(self, skey, value, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.cache[skey] = value
+            self.cache.move_to_end(skey)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def forget(self, skey=None):
+        with self.lock:
+            self.generation += 1
+            if skey is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(skey, None)
+
+    def __getitem__(self, key):
+        skey = json.dumps(key)
+        found, value = self.writer.lookup(self.namespace, skey)
+        generation = None
+        if not found and self.cache_valid.is_set():
+            with self.lock:
+                if skey in self.cache:
+                    found, value = True, self.cache[skey]
+                    self.cache.move_to_end(skey)
+                generation = self.generation
+        if not found:
+            value = self.store.load(self.namespace, skey)
+            if generation is not None:
+                self._remember(skey, value, generation)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        skey = json.dumps(key)
+        self._remember(skey, value)
+        self.writer.put(self.namespace, skey, value)
+
+    def __delitem__(self, key):
+        skey = json.dumps(key)
+        self._remember(skey, None)
+        self.writer.put(self.namespace, skey, None)
+
+    def __iter__(self):
+        with self.lock:
+            keys = [k for k, v in self.cache.items() if v is not None]
+        return (json.loads(k) for k in keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    # Removes and returns the values untouched for `max_age` seconds
+    def expire(self, max_age):
+        self.writer.flush()
+        expired = self.store.expire(self.namespace, max_age)
+        for skey, _ in expired:
+            self.forget(skey)
+        return [value for _, value in expired]
+
+
+class StatePersistence:
+    def __init__(self, store):
+        self.store = store
+        self.writer = StateWriter(store)
+        # namespace -> PersistentDict
+        self.mappings = {}
+        # A store shared with other processes is only cached while their
+        # change notifications are being received
+        self.cache_valid = threading.Event()
+        if not store.shared:
+            self.cache_valid.set()
+
+    def mapping(self, namespace):
+        mapping = PersistentDict(namespace, self.store, self.writer,
+                                 self.cache_valid)
+        self.mappings[namespace] = mapping
+        return mapping
+
+    def start(self):
+        self.writer.start()
+
+    def stop(self):
+        self.writer.stop()
+
+    # Drops the cached keys another process has written, as announced in
+    # the JSON `payload` of a notification
+    def invalidate(self, payload):
+        source, keys = json.loads(payload)
+        if source == self.store.source:
+            return
+        for namespace, skey in keys:
+            mapping = self.mappings.get(namespace)
+            if mapping is not None:
+                mapping.forget(skey)
+
+    def _invalidate_all(self):
+        for mapping in self.mappings.values():
+            mapping.forget()
+
+    def _listen_forever(self):
+        while True:
+            conn = None
+            try:
+                conn = self.store.db.listen(STATE_CHANNEL)
+                # Anything cached may have changed while disconnected
+                self._invalidate_all()
+                self.cache_valid.set()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.invalidate(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.warning('State listener disconnected: %s', e)
+                time.sleep(5)
+            finally:
+                self.cache_valid.clear()
+                self._invalidate_all()
+                if conn is not None:
+                    conn.close()
+
+    # Starts caching a shared store, following the other processes' writes
+    def listen(self):
+        if not self.store.shared:
+            return None
+        thread = threading.Thread(target=self._listen_forever,
+                                  name='state-listener', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,62 @@
+# These tests place draft orders whose menu changed while they were open
+
+import os
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+from drafts import DraftOrder
+from sqlitehelper import SQLiteHelper
+
+MENU = {'Laksa': Decimal('6.50'), 'Chicken Rice': Decimal('5.00'),
+        'Mee Goreng': Decimal('4.80')}
+
+
+def draft_order():
+    draft = DraftOrder(1001, 'alice', 'Alice')
+    draft.full_name = 'Alice Tan'
+    draft.contact_number = '91234567'
+    draft.collection_time = '12:00'
+    draft.location = 'Tembusu'
+    for item, quantity in [('Laksa', 2), ('Chicken Rice', 1),
+                           ('Mee Goreng', None)]:
+        draft.add_line(item).quantity = quantity
+    return draft
+
+
+class MenuChangeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = SQLiteHelper(os.path.join(self.directory, 'spread.db'))
+        self.db.setup()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def _paid_rows(self):
+        with self.db.transaction() as cursor:
+            cursor.execute("SELECT item_ordered, quantity FROM order_list WHERE status = 'PAID' ORDER BY id;")
+            return cursor.fetchall()
+
+    def test_pays_for_what_the_cart_priced(self):
+        draft = draft_order()
+        # Chicken Rice is taken off the menu after it was ordered
+        prices = dict(MENU)
+        del prices['Chicken Rice']
+        cart = draft.cart(prices)
+        self.assertEqual(cart.total, Decimal('13.00'))
+        self.db.place_order(draft, prices, 'ab' * 32, 100)
+        self.assertEqual(self._paid_rows(), [('Laksa', 2)])
+
+    def test_nothing_payable(self):
+        draft = draft_order()
+        prices = {'Mee Goreng': MENU['Mee Goreng']}
+        self.assertEqual(draft.cart(prices).total, 0)
+        self.assertEqual(draft.payable_lines(prices), [])
+        self.db.place_order(draft, prices, 'ab' * 32, 100)
+        self.assertEqual(self._paid_rows(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
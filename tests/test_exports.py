@@ -0,0 +1,92 @@
+# These tests write exports into memory and read them back
+
+import codecs
+import csv
+import io
+import unittest
+from datetime import date, datetime, timezone
+from exports import export, COLUMNS
+
+ROWS = [
+    (date(2021, 3, 1), 1, datetime(2021, 3, 1, 4, 30, tzinfo=timezone.utc),
+     '12:00', 'Tembusu', 1001, 'alice', 'Alice Tan', 91234567,
+     'Nasi Lemak', 2, 'Less spicy, no egg', 'PAID', 'ab' * 32),
+    (date(2021, 3, 1), 2, datetime(2021, 3, 1, 4, 31, tzinfo=timezone.utc),
+     '12:30', 'Cinnamon', 1002, None, 'Bob "B" Lim', 98765432,
+     'Mee Goreng 🍜', 1, 'N/A', 'PAID', 'cd' * 32)
+]
+# A customer whose name and remarks would run as formulas
+FORMULA_ROW = (date(2021, 3, 1), 3,
+               datetime(2021, 3, 1, 4, 32, tzinfo=timezone.utc), '13:00',
+               '@SUM(A1:A9)', 1003, 'eve', '=HYPERLINK("http://x", "y")',
+               -1, 'Laksa', 1, '-2+3', 'PAID', 'ef' * 32)
+
+
+class CsvExportTest(unittest.TestCase):
+    def test_writes_header_and_rows(self):
+        output, count = export(iter(ROWS), 'csv')
+        with output:
+            data = output.read()
+        self.assertEqual(count, len(ROWS))
+        self.assertTrue(data.startswith(codecs.BOM_UTF8))
+        lines = list(csv.reader(io.StringIO(data.decode('utf-8-sig'),
+                                            newline='')))
+        self.assertEqual(lines[0], COLUMNS)
+        self.assertEqual(lines[1][9:12],
+                         ['Nasi Lemak', '2', 'Less spicy, no egg'])
+        self.assertEqual(lines[2][6:10],
+                         ['', 'Bob "B" Lim', '98765432', 'Mee Goreng 🍜'])
+        self.assertEqual(len(lines), len(ROWS) + 1)
+
+    def test_empty_export_has_header(self):
+        output, count = export(iter([]), 'csv')
+        with output:
+            data = output.read()
+        self.assertEqual(count, 0)
+        self.assertEqual(data.decode('utf-8-sig').splitlines(),
+                         [','.join(COLUMNS)])
+
+    def test_escapes_formulas(self):
+        output, count = export(iter([FORMULA_ROW]), 'csv')
+        with output:
+            data = output.read()
+        lines = list(csv.reader(io.StringIO(data.decode('utf-8-sig'),
+                                            newline='')))
+        self.assertEqual(lines[1][4], "'@SUM(A1:A9)")
+        self.assertEqual(lines[1][7:9],
+                         ["'=HYPERLINK(\"http://x\", \"y\")", '-1'])
+        self.assertEqual(lines[1][11], "'-2+3")
+
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+
+@unittest.skipIf(openpyxl is None, 'openpyxl is not installed')
+class XlsxExportTest(unittest.TestCase):
+    def test_writes_header_and_rows(self):
+        output, count = export(iter(ROWS), 'xlsx')
+        with output:
+            workbook = openpyxl.load_workbook(io.BytesIO(output.read()))
+        rows = list(workbook['Orders'].values)
+        self.assertEqual(count, len(ROWS))
+        self.assertEqual(list(rows[0]), COLUMNS)
+        self.assertEqual(rows[1][9:12],
+                         ('Nasi Lemak', 2, 'Less spicy, no egg'))
+        self.assertEqual(len(rows), len(ROWS) + 1)
+
+    def test_escapes_formulas(self):
+        output, count = export(iter([FORMULA_ROW]), 'xlsx')
+        with output:
+            workbook = openpyxl.load_workbook(io.BytesIO(output.read()))
+        sheet = workbook['Orders']
+        self.assertNotIn('f', [cell.data_type for cell in sheet[2]])
+        self.assertEqual(sheet['E2'].value, "'@SUM(A1:A9)")
+        self.assertEqual(sheet['I2'].value, -1)
+        self.assertEqual(sheet['L2'].value, "'-2+3")
+
+
+if __name__ == '__main__':
+    unittest.main()
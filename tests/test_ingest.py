@@ -0,0 +1,143 @@
+# These tests process updates of several chats on a pool of workers
+
+import threading
+import time
+import unittest
+from queue import Queue
+from types import SimpleNamespace
+from telegram import Bot, Update
+from telegram.ext import ConversationHandler, Dispatcher, Filters, \
+    MessageHandler
+from ingest import ChatWorkerPool, ConcurrentConversationHandler
+
+ORDERING = 1
+
+
+def chat_update(chat_id, number):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id),
+                           number=number)
+
+
+# Stands in for the dispatcher whose updates the pool takes over
+class RecordingDispatcher:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.processed = {}
+        self.active = {}
+        self.overlaps = 0
+
+    def process_update(self, update):
+        chat_id = update.effective_chat.id
+        with self.lock:
+            self.active[chat_id] = self.active.get(chat_id, 0) + 1
+            if self.active[chat_id] > 1:
+                self.overlaps += 1
+        time.sleep(self.delay)
+        with self.lock:
+            self.active[chat_id] -= 1
+            self.processed.setdefault(chat_id, []).append(update.number)
+
+
+class ChatWorkerPoolTest(unittest.TestCase):
+    def _pool(self, dispatcher, workers=4):
+        pool = ChatWorkerPool(workers=workers)
+        pool.install(dispatcher)
+        pool.start()
+        self.addCleanup(pool.stop, 5)
+        return pool
+
+    def test_one_chat_in_order(self):
+        dispatcher = RecordingDispatcher(delay=0.002)
+        pool = self._pool(dispatcher)
+        for number in range(50):
+            pool.put(chat_update(1, number))
+        pool.stop(5)
+        self.assertEqual(dispatcher.processed, {1: list(range(50))})
+        self.assertEqual(dispatcher.overlaps, 0)
+
+    def test_chats_overlap(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        # Only returns once the other chat's update is being processed too
+        class WaitingDispatcher:
+            def process_update(self, update):
+                barrier.wait()
+
+        pool = self._pool(WaitingDispatcher(), workers=2)
+        pool.put(chat_update(1, 0))
+        pool.put(chat_update(2, 0))
+        pool.stop(5)
+        self.assertFalse(barrier.broken)
+
+    def test_many_chats_in_order(self):
+        dispatcher = RecordingDispatcher(delay=0.001)
+        pool = self._pool(dispatcher)
+        for number in range(20):
+            for chat_id in range(1, 6):
+                pool.put(chat_update(chat_id, number))
+        pool.stop(5)
+        self.assertEqual(dispatcher.processed,
+                         {chat_id: list(range(20)) for chat_id in range(1, 6)})
+        self.assertEqual(dispatcher.overlaps, 0)
+        self.assertEqual(pool.pending(), 0)
+
+
+class ConcurrentConversationHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.bot = Bot('123456:test')
+        self.dispatcher = Dispatcher(self.bot, Queue())
+        self.calls = []
+        self.handler = ConcurrentConversationHandler(
+            # A CommandHandler would ask Telegram for the bot's username
+            entry_points=[MessageHandler(Filters.command, self._order)],
+            states={ORDERING: [MessageHandler(Filters.text, self._item)]},
+            fallbacks=[])
+
+    def _order(self, bot, update):
+        self.calls.append(('order', update.effective_chat.id))
+        return ORDERING
+
+    def _item(self, bot, update):
+        self.calls.append(('item', update.effective_chat.id))
+        return ConversationHandler.END
+
+    def _message(self, chat_id, text):
+        message = {'message_id': 1, 'date': 0, 'text': text,
+                   'chat': {'id': chat_id, 'type': 'private'},
+                   'from': {'id': chat_id, 'first_name': 'User',
+                            'is_bot': False}}
+        return Update.de_json({'update_id': chat_id, 'message': message},
+                              self.bot)
+
+    # Chat 1 starts ordering while chat 2, already ordering, picks an item.
+    # Each worker checks its update before either handles it.
+    def test_chats_keep_their_own_state(self):
+        self.handler.update_state(ORDERING, (2, 2))
+        checked = threading.Event()
+        other_checked = threading.Event()
+        results = []
+
+        def first_chat():
+            update = self._message(1, '/order')
+            results.append(self.handler.check_update(update))
+            checked.set()
+            other_checked.wait(5)
+            self.handler.handle_update(update, self.dispatcher)
+
+        worker = threading.Thread(target=first_chat)
+        worker.start()
+        checked.wait(5)
+        update = self._message(2, 'Laksa')
+        results.append(self.handler.check_update(update))
+        other_checked.set()
+        worker.join(5)
+        self.handler.handle_update(update, self.dispatcher)
+
+        self.assertEqual(results, [True, True])
+        self.assertEqual(self.calls, [('order', 1), ('item', 2)])
+        self.assertEqual(self.handler.conversations, {(1, 1): ORDERING})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+# These tests apply the migrations. The Postgres ones need a real database,
+# which TEST_DATABASE_URL has to point at. They run in a schema of their own
+# that is dropped afterwards.
+
+import json
+import os
+import sqlite3
+import unittest
+from datetime import timedelta
+from benchmark import BASE_SCHEMA
+from migrations import migrate, MIGRATIONS, SQLITE_MIGRATIONS
+from sqlitehelper import SQLiteCursor
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+SCHEMA = 'spread_migration_test'
+# What SQLITE_MIGRATIONS add up to. Regenerate it with
+# `PYTHONPATH=. python tests/test_migrations.py --dump` after changing
+# them.
+SQLITE_SCHEMA_PATH = os.path.join(os.path.dirname(__file__),
+                                  'sqlite_schema.json')
+
+# Column types of the Postgres schema as SQLite declares them
+POSTGRES_TYPES = {
+    'integer': 'INTEGER',
+    'bigint': 'INTEGER',
+    'text': 'TEXT',
+    'numeric': 'DECIMAL',
+    'bytea': 'BLOB',
+    'date': 'DATE',
+    'timestamp with time zone': 'TIMESTAMP',
+    'jsonb': 'TEXT'
+}
+SQLITE_TYPES = {
+    'TIMESTAMPTZ': 'TIMESTAMP'
+}
+# Postgres partitions the orders by business day, so their primary keys
+# include it and order_history gets by without keys or indexes
+PARTITIONED = {'order_list', 'order_history'}
+
+
+# Tables of a SQLite database with their columns as (name, declared type,
+# NOT NULL), primary key and indexes
+def sqlite_schema(conn):
+    schema = {}
+    tables = [x[0] for x in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name;")]
+    for table in tables:
+        info = conn.execute("PRAGMA table_info({});".format(table)).fetchall()
+        indexes = {}
+        for x in conn.execute("PRAGMA index_list({});".format(table)):
+            name, unique, origin, partial = x[1], x[2], x[3], x[4]
+            if origin == 'pk':
+                continue
+            columns = [y[2] for y in conn.execute("PRAGMA index_info({});"
+                                                  .format(name))]
+            indexes[name] = {'columns': columns, 'unique': bool(unique),
+                             'partial': bool(partial)}
+        schema[table] = {
+            'columns': [[x[1], x[2], bool(x[3])] for x in info],
+            'primary_key': [x[1] for x in sorted(info, key=lambda x: x[5])
+                            if x[5]],
+            'indexes': indexes
+        }
+    return schema
+
+
+def migrated_sqlite_schema():
+    conn = sqlite3.connect(':memory:')
+    try:
+        migrate(SQLiteCursor(conn.cursor()), SQLITE_MIGRATIONS, lock=False)
+        return sqlite_schema(conn)
+    finally:
+        conn.close()
+
+
+# What both backends have to agree on, leaving out how SQLite spells types
+# and what partitioning changes
+def comparable(schema):
+    result = {}
+    for table, details in schema.items():
+        key = details['primary_key']
+        columns = {}
+        for name, type, notnull in details['columns']:
+            type = type.split()[0]
+            columns[name] = (SQLITE_TYPES.get(type, type),
+                             notnull or name in key)
+        result[table] = {
+            'columns': columns,
+            'primary_key': None if table in PARTITIONED else key,
+            'indexes': None if table == 'order_history'
+            else details['indexes']
+        }
+    return result
+
+
+class SQLiteMigrationTest(unittest.TestCase):
+    def test_matches_expected_schema(self):
+        with open(SQLITE_SCHEMA_PATH) as f:
+            expected = json.load(f)
+        self.assertEqual(migrated_sqlite_schema(), expected)
+
+
+@unittest.skipUnless(TEST_DATABASE_URL, 'TEST_DATABASE_URL is not set')
+class PostgresMigrationTest(unittest.TestCase):
+    def setUp(self):
+        import psycopg2
+        self.conn = psycopg2.connect(TEST_DATABASE_URL)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("DROP SCHEMA IF EXISTS {} CASCADE;".format(SCHEMA))
+        self.cursor.execute("CREATE SCHEMA {};".format(SCHEMA))
+        self.cursor.execute("SET search_path TO {};".format(SCHEMA))
+        for stmt in BASE_SCHEMA:
+            self.cursor.execute(stmt)
+
+    def tearDown(self):
+        self.conn.rollback()
+        self.cursor.execute("DROP SCHEMA IF EXISTS {} CASCADE;".format(SCHEMA))
+        self.conn.commit()
+        self.conn.close()
+
+    def test_applies_every_migration(self):
+        migrate(self.cursor)
+        self.cursor.execute("SELECT version FROM schema_migrations ORDER BY version;")
+        self.assertEqual([x[0] for x in self.cursor.fetchall()],
+                         [version for version, name, stmts in MIGRATIONS])
+
+    def test_is_idempotent(self):
+        migrate(self.cursor)
+        migrate(self.cursor)
+        self.cursor.execute("SELECT count(*) FROM schema_migrations;")
+        self.assertEqual(self.cursor.fetchone()[0], len(MIGRATIONS))
+
+    # Orders placed before the partitioning end up in the legacy partition
+    def test_keeps_existing_orders(self):
+        self.cursor.execute("INSERT INTO order_list (collection_time, user_id, item_ordered, quantity, status) VALUES ('12:00', 1, 'Laksa', 2, 'PAID');")
+        migrate(self.cursor)
+        self.cursor.execute("SELECT tableoid::regclass::text, user_id, item_ordered, quantity FROM order_list;")
+        self.assertEqual(self.cursor.fetchall(),
+                         [('order_list_legacy', 1, 'Laksa', 2)])
+
+    def test_orders_partitioned_by_business_day(self):
+        migrate(self.cursor)
+        self.cursor.execute("SELECT (now() AT TIME ZONE 'Asia/Singapore')::date;")
+        today = self.cursor.fetchone()[0]
+        self.cursor.execute("INSERT INTO order_list (business_day, user_id, status) VALUES (%s, 1, 'PAID'), (%s, 1, 'PAID') RETURNING tableoid::regclass::text;",
+                            (today, today + timedelta(days=1)))
+        self.assertEqual([x[0] for x in self.cursor.fetchall()],
+                         ['order_list_legacy', 'order_list_default'])
+        self.cursor.execute("SELECT a.attname FROM pg_index i JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) WHERE i.indrelid = 'order_list'::regclass AND i.indisprimary ORDER BY a.attname;")
+        self.assertEqual([x[0] for x in self.cursor.fetchall()],
+                         ['business_day', 'id'])
+
+    # SQLite databases start from a copy of the schema the migrations add up
+    # to, which has to keep up with them
+    def test_matches_sqlite_schema(self):
+        migrate(self.cursor)
+        self.cursor.execute("SELECT c.relname, a.attname, format_type(a.atttypid, a.atttypmod), a.attnotnull FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace JOIN pg_attribute a ON a.attrelid = c.oid WHERE n.nspname = (%s) AND c.relkind IN ('r', 'p') AND NOT c.relispartition AND a.attnum > 0 AND NOT a.attisdropped ORDER BY c.relname, a.attnum;",
+                            (SCHEMA,))
+        postgres = {}
+        for table, name, type, notnull in self.cursor.fetchall():
+            details = postgres.setdefault(
+                table, {'columns': [], 'primary_key': [], 'indexes': {}})
+            details['columns'].append([name, POSTGRES_TYPES[type], notnull])
+        self.cursor.execute("SELECT t.relname, i.relname, x.indisprimary, x.indisunique, x.indpred IS NOT NULL, array(SELECT a.attname FROM unnest(x.indkey) WITH ORDINALITY AS k (attnum, ord) JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum ORDER BY k.ord) FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid JOIN pg_class t ON t.oid = x.indrelid JOIN pg_namespace n ON n.oid = t.relnamespace WHERE n.nspname = (%s) AND NOT t.relispartition;",
+                            (SCHEMA,))
+        for table, name, primary, unique, partial, columns in \
+                self.cursor.fetchall():
+            if primary:
+                postgres[table]['primary_key'] = columns
+            else:
+                postgres[table]['indexes'][name] = {
+                    'columns': columns, 'unique': unique, 'partial': partial}
+        self.assertEqual(comparable(migrated_sqlite_schema()),
+                         comparable(postgres))
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['--dump']:
+        with open(SQLITE_SCHEMA_PATH, 'w') as f:
+            json.dump(migrated_sqlite_schema(), f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        unittest.main()
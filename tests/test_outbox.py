@@ -0,0 +1,79 @@
+# These tests deliver uploads through an Outbox to a fake Bot API that fails
+# the first attempt
+
+import unittest
+from io import BytesIO
+from telegram import InputFile
+from telegram.error import BadRequest, RetryAfter, TimedOut
+from outbox import Outbox, QueuedBot
+
+PAYLOAD = bytes(range(256)) * 4
+
+
+# Stands in for telegram.utils.request.Request, raising `error` on the first
+# call and recording every method called and the size of every upload
+class FlakyTelegram:
+    def __init__(self, error):
+        self.error = error
+        self.calls = []
+        self.uploads = []
+
+    def post(self, url, data, timeout=None):
+        self.calls.append(url.rsplit('/', 1)[1])
+        for value in data.values():
+            if isinstance(value, InputFile):
+                self.uploads.append(len(value.input_file_content))
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return {'message_id': len(self.uploads), 'date': 0,
+                'chat': {'id': int(data['chat_id']), 'type': 'private'}}
+
+
+class RetryUploadTest(unittest.TestCase):
+    def _send(self, error):
+        outbox = Outbox(workers=1)
+        telegram = FlakyTelegram(error)
+        bot = QueuedBot('123456:test', outbox, request=telegram)
+        sent = []
+        outbox.start()
+        bot.send_photo(chat_id=1, photo=BytesIO(PAYLOAD),
+                       on_sent=sent.append)
+        outbox.stop(timeout=10)
+        self.assertEqual(len(sent), 1)
+        return telegram.uploads
+
+    def test_retry_after_uploads_whole_file(self):
+        self.assertEqual(self._send(RetryAfter(0)),
+                         [len(PAYLOAD), len(PAYLOAD)])
+
+    def test_network_error_uploads_whole_file(self):
+        self.assertEqual(self._send(TimedOut()),
+                         [len(PAYLOAD), len(PAYLOAD)])
+
+
+
+class FallbackTest(unittest.TestCase):
+    # A stale file_id is replaced by an upload before the next message goes
+    def test_retries_in_place(self):
+        outbox = Outbox(workers=2)
+        telegram = FlakyTelegram(BadRequest('Wrong file identifier'))
+        bot = QueuedBot('123456:test', outbox, request=telegram)
+        sent = []
+        errors = []
+        outbox.start()
+        bot.send_photo(chat_id=1, photo='stale-file-id',
+                       on_error=errors.append,
+                       fallback=lambda: {'photo': BytesIO(PAYLOAD),
+                                         'on_sent': sent.append})
+        bot.send_message(chat_id=1, text='Next')
+        outbox.stop(timeout=10)
+        self.assertEqual(telegram.calls, ['sendPhoto', 'sendPhoto',
+                                          'sendMessage'])
+        self.assertEqual(telegram.uploads, [len(PAYLOAD)])
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+# These tests check the payment references and QR codes of orders
+
+import unittest
+from drafts import DraftOrder
+from paynow import PaymentQR, payload
+
+
+class PaymentReferenceTest(unittest.TestCase):
+    def test_differs_per_order(self):
+        qr = PaymentQR()
+        first, second = DraftOrder(1001), DraftOrder(1001)
+        self.assertNotEqual(qr.reference(first), qr.reference(second))
+        self.assertTrue(qr.reference(first).startswith('SPREAD1001-'))
+        self.assertLessEqual(len(qr.reference(first)), 25)
+
+    def test_survives_saving_the_draft(self):
+        draft = DraftOrder(1001)
+        data = draft.to_dict()
+        self.assertEqual(DraftOrder.from_dict(data).order_code,
+                         draft.order_code)
+        # Drafts saved before order codes existed get one
+        del data['order_code']
+        self.assertIsNotNone(DraftOrder.from_dict(data).order_code)
+
+
+class RenderCacheTest(unittest.TestCase):
+    def test_honours_cache_size(self):
+        qr = PaymentQR(cache_size=2)
+        for amount in ['1.00', '2.00', '3.00', '1.00']:
+            image = qr.render(payload(amount, 'SPREAD1', proxy='T00SS0001A'))
+            self.assertTrue(image.startswith(b'\x89PNG'))
+        info = qr.render.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (0, 4, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# These tests read the start of collection times for the prep schedule
+
+import unittest
+from datetime import date, datetime
+from prep import PrepSchedule, slot_start
+
+DAY = date(2021, 3, 1)
+
+
+class SlotStartTest(unittest.TestCase):
+    def test_24_hour_times(self):
+        for slot, hour, minute in [('12:30', 12, 30),
+                                   ('12:30 - 13:00', 12, 30),
+                                   ('9.30', 9, 30), ('0930', 9, 30)]:
+            self.assertEqual(slot_start(slot, DAY),
+                             datetime(2021, 3, 1, hour, minute), slot)
+
+    def test_am_pm_times(self):
+        for slot, hour, minute in [('1:30 PM', 13, 30),
+                                   ('1.30pm - 2pm', 13, 30), ('12pm', 12, 0), ('12:15 a.m.', 0, 15),
+                                   ('11:45 AM - 12:15 PM', 11, 45)]:
+            self.assertEqual(slot_start(slot, DAY),
+                             datetime(2021, 3, 1, hour, minute), slot)
+
+    def test_unrecognizable_times(self):
+        for slot in ['Lunch', '7', '13:00 PM', '']:
+            self.assertIsNone(slot_start(slot, DAY), slot)
+
+
+class PrepScheduleTest(unittest.TestCase):
+    def test_reports_unparseable_slot_once(self):
+        schedule = PrepSchedule(lead_minutes=30)
+        now = datetime(2021, 3, 1, 12, 45)
+        with self.assertLogs('prep', 'WARNING') as logs:
+            self.assertEqual(schedule.due(['1:00 PM', 'Lunch'], now),
+                             ['1:00 PM'])
+            self.assertEqual(schedule.due(['1:00 PM', 'Lunch'], now), [])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("'Lunch'", logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
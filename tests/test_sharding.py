@@ -0,0 +1,30 @@
+# These tests check how a worker process stops after SIGTERM
+
+import os
+import signal
+import time
+import unittest
+import sharding
+
+
+class HandleSigtermTest(unittest.TestCase):
+    def setUp(self):
+        self.handlers = {signum: signal.getsignal(signum)
+                         for signum in (signal.SIGTERM, signal.SIGALRM)}
+
+    def tearDown(self):
+        signal.alarm(0)
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+
+    def test_raises_once_time_is_up(self):
+        sharding.handle_sigterm(timeout=1)
+        os.kill(os.getpid(), signal.SIGTERM)
+        # Still serving right after SIGTERM
+        time.sleep(0.1)
+        with self.assertRaises(sharding.StopTimeout):
+            time.sleep(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
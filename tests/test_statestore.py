@@ -0,0 +1,92 @@
+# These tests check when persisted states are read from the store
+
+import json
+import threading
+import time
+import unittest
+from statestore import StatePersistence, StateWriter
+
+
+# Store that counts its reads and can be made to fail
+class CountingStore:
+    def __init__(self, shared=False):
+        self.shared = shared
+        self.source = 'this-process'
+        self.data = {}
+        self.loads = 0
+        self.saves = 0
+        self.down = False
+
+    def load(self, namespace, key):
+        self.loads += 1
+        return self.data.get((namespace, key))
+
+    def save(self, changes):
+        self.saves += 1
+        if self.down:
+            raise IOError('store is down')
+        for namespace, key, value in changes:
+            self.data[(namespace, key)] = value
+
+    def expire(self, namespace, max_age):
+        return []
+
+
+class StateCacheTest(unittest.TestCase):
+    def test_loads_each_key_once(self):
+        store = CountingStore()
+        state = StatePersistence(store)
+        conversations = state.mapping('conversation:order')
+        for _ in range(5):
+            self.assertIsNone(conversations.get((1, 1)))
+        conversations[(1, 1)] = 2
+        state.writer.flush()
+        self.assertEqual(conversations[(1, 1)], 2)
+        self.assertEqual(store.loads, 1)
+
+    def test_shared_store_is_read_until_listening(self):
+        store = CountingStore(shared=True)
+        state = StatePersistence(store)
+        drafts = state.mapping('drafts')
+        drafts.get(1)
+        drafts.get(1)
+        self.assertEqual(store.loads, 2)
+
+    def test_other_processes_writes_are_reloaded(self):
+        store = CountingStore(shared=True)
+        state = StatePersistence(store)
+        drafts = state.mapping('drafts')
+        state.cache_valid.set()
+        store.data[('drafts', '1')] = {'lines': []}
+        drafts.get(1)
+        # This process's own announcements change nothing
+        state.invalidate(json.dumps(['this-process', [['drafts', '1']]]))
+        drafts.get(1)
+        self.assertEqual(store.loads, 1)
+        store.data[('drafts', '1')] = {'lines': [1]}
+        state.invalidate(json.dumps(['other-process', [['drafts', '1']]]))
+        self.assertEqual(drafts.get(1), {'lines': [1]})
+        self.assertEqual(store.loads, 2)
+
+
+class StateWriterTest(unittest.TestCase):
+    def test_backs_off_while_store_is_down(self):
+        store = CountingStore()
+        store.down = True
+        writer = StateWriter(store, interval=0.01, retry_max=10)
+        writer.start()
+        writer.put('drafts', '1', {'lines': []})
+        time.sleep(0.5)
+        attempts = store.saves
+        store.down = False
+        stopper = threading.Thread(target=writer.stop)
+        stopper.start()
+        stopper.join(5)
+        # 0.02s, 0.04s, ... between attempts instead of 0.01s
+        self.assertLessEqual(attempts, 6)
+        self.assertFalse(stopper.is_alive())
+        self.assertEqual(store.data, {('drafts', '1'): {'lines': []}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# This class adds plain HTTP endpoints, such as health checks, next to the
+# Telegram webhook served by the Updater
+
+import json
+import telegram.ext.updater
+from telegram.utils.webhookhandler import WebhookHandler
+
+
+class RoutingWebhookHandler(WebhookHandler):
+    # Path -> callable returning (status, content type, body bytes)
+    routes = {}
+    # Callable returning False while incoming updates should be refused
+    admission = None
+
+    def do_POST(self):
+        if self.admission is not None and not self.admission():
+            # Telegram keeps the update and delivers it again later
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super(RoutingWebhookHandler, self).do_POST()
+
+    def do_GET(self):
+        route = self.routes.get(self.path.split('?', 1)[0])
+        if route is None:
+            # Keep answering anything else the way the stock handler does
+            return super(RoutingWebhookHandler, self).do_GET()
+        try:
+            status, content_type, body = route()
+        except Exception:
+            self.logger.exception('Route %s failed.', self.path)
+            status, content_type, body = 500, 'text/plain', b'error\n'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def json_response(status, payload):
+    return status, 'application/json', json.dumps(payload).encode('utf-8')
+
+
+def add_route(path, handler):
+    RoutingWebhookHandler.routes[path] = handler
+
+
+def set_admission(check):
+    RoutingWebhookHandler.admission = staticmethod(check)
+
+
+# Must be called before Updater.start_webhook(), which looks the handler up
+# by name when it creates the server
+def install():
+    telegram.ext.updater.WebhookHandler = RoutingWebhookHandler